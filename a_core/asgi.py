@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
@@ -19,10 +20,21 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'a_core.settings')
 django_asgi_app = get_asgi_application()
 
 from a_rtchat import routing
+from a_rtchat.access import media_access
+from a_rtchat.presence import lifespan, start_with_server
+from a_core.media import MediaFiles, StaticFiles
+from a_core.middleware import RequestSizeLimit
+
+if settings.WEBSOCKET_DEFLATE:
+    from a_core.websocket import enable_permessage_deflate
+    enable_permessage_deflate()
+
+start_with_server()
 
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    "http": RequestSizeLimit(StaticFiles(MediaFiles(django_asgi_app, access=media_access))),
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
     ),
+    "lifespan": lifespan,
 })
\ No newline at end of file
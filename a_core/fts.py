@@ -0,0 +1,130 @@
+import re
+
+from django.db import connections
+
+WORD = re.compile(r'\w+')
+
+
+def match_query(text, max_terms=16):
+    # Every word is quoted and prefix-matched, so user input is never parsed
+    # as FTS5 query syntax. Returns '' when there is nothing to search for.
+    words = WORD.findall(text or '')[:max_terms]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class FTSIndex:
+    # An SQLite FTS5 table living in the main database, keyed by the rowid
+    # of the model it indexes. Writes share the caller's transaction, so the
+    # index rolls back together with the rows it describes. On other database
+    # vendors writes are no-ops and `supported` is False.
+
+    def __init__(self, table, columns, unindexed=(), weights=None, using='default'):
+        self.table = table
+        self.columns = tuple(columns)
+        self.unindexed = tuple(unindexed)
+        self.weights = weights or {}
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    @property
+    def supported(self):
+        return self.connection.vendor == 'sqlite'
+
+    def cursor(self):
+        # The table is created on first use, once per connection and database.
+        # Inside a transaction it only counts as created once that commits,
+        # since a rollback takes the CREATE with it.
+        connection = self.connection
+        cursor = connection.cursor()
+        ready = connection.__dict__.setdefault('_fts_tables', set())
+        key = (self.table, str(connection.settings_dict['NAME']))
+        if key not in ready:
+            columns = list(self.columns) + [f'{column} UNINDEXED' for column in self.unindexed]
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5('
+                f"{', '.join(columns)}, tokenize = 'porter unicode61 remove_diacritics 2')"
+            )
+            connection.on_commit(lambda: ready.add(key))
+        return cursor
+
+    def replace(self, rowid, **values):
+        if not self.supported:
+            return
+        names = self.columns + self.unindexed
+        with self.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [rowid])
+            cursor.execute(
+                f"INSERT INTO {self.table} (rowid, {', '.join(names)}) VALUES ({', '.join(['%s'] * (len(names) + 1))})",
+                [rowid] + [values.get(name) or '' for name in names],
+            )
+
+    def replace_many(self, rows):
+        # rows: iterable of (rowid, values) pairs
+        if not self.supported:
+            return
+        rows = list(rows)
+        if not rows:
+            return
+        names = self.columns + self.unindexed
+        with self.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [[rowid] for rowid, _ in rows])
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, {', '.join(names)}) VALUES ({', '.join(['%s'] * (len(names) + 1))})",
+                [[rowid] + [values.get(name) or '' for name in names] for rowid, values in rows],
+            )
+
+    def update(self, rowid, **values):
+        if not self.supported:
+            return
+        assignments = ', '.join(f'{name} = %s' for name in values)
+        with self.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {self.table} SET {assignments} WHERE rowid = %s',
+                [value or '' for value in values.values()] + [rowid],
+            )
+
+    def get(self, rowid, *names):
+        if not self.supported:
+            return None
+        with self.cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(names)} FROM {self.table} WHERE rowid = %s", [rowid])
+            row = cursor.fetchone()
+        return dict(zip(names, row)) if row else None
+
+    def delete(self, *rowids):
+        if not self.supported or not rowids:
+            return
+        with self.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [[rowid] for rowid in rowids])
+
+    def clear(self):
+        if not self.supported:
+            return
+        with self.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def search(self, query, limit, offset=0, where='', params=(), newest_first=False):
+        # Rowids matching an FTS5 query (see match_query), best bm25 first, or
+        # highest rowid first with newest_first, which needs no scoring pass
+        # and stops after `limit` hits. `where` is an extra SQL condition, such
+        # as a rowid bound for keyset paging.
+        if not self.supported or not query:
+            return []
+        weights = ', '.join(
+            str(float(self.weights.get(name, 1))) for name in self.columns
+        )
+        if self.unindexed:
+            weights += ', ' + ', '.join('0.0' for _ in self.unindexed)
+        sql = f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s'
+        if where:
+            sql += f' AND ({where})'
+        if newest_first:
+            sql += ' ORDER BY rowid DESC LIMIT %s OFFSET %s'
+        else:
+            sql += f' ORDER BY bm25({self.table}, {weights}), rowid LIMIT %s OFFSET %s'
+        with self.cursor() as cursor:
+            cursor.execute(sql, [query, *params, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
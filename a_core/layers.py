@@ -0,0 +1,334 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import random
+import socket
+import string
+import tempfile
+import time
+from copy import deepcopy
+from pathlib import Path
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+SOCKET_BUFFER = 4 * 1024 * 1024
+# Messages are sent as a 4-byte big-endian length and that many bytes of JSON
+HEADER = 4
+MAX_MESSAGE = SOCKET_BUFFER
+
+
+class Peer:
+    # Connection to another process's socket. Frames the kernel will not
+    # take yet wait in `buffer` and go out as the socket drains.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.loop = None
+        self.waiters = []
+
+    def wake(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    # Channel layer for several worker processes on one host, without an
+    # external service. Each process is an InMemoryChannelLayer for its own
+    # channels and groups, plus a listening Unix stream socket named after
+    # its node id in CONFIG['path']. Channel names carry the node id, so
+    # send() goes straight to the owning process; group_send() delivers
+    # locally and sends one message to every other process, which delivers
+    # to its own members. Messages are JSON encoded and length framed over
+    # one connection per peer, so they arrive in order and none are lost in
+    # transit. A peer that reads slowly has its messages buffered here; past
+    # `write_buffer` bytes senders wait for it to drain, and a peer that
+    # does not drain within `write_timeout` seconds is disconnected and its
+    # buffer dropped. As with the in-memory layer, a full channel drops
+    # messages on delivery.
+
+    def __init__(self, path=None, write_buffer=SOCKET_BUFFER, write_timeout=10, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path or os.path.join(tempfile.gettempdir(), 'channels-unix'))
+        self.node = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        self.address = str(self.path / f'{self.node}.sock')
+        self.write_buffer = write_buffer
+        self.write_timeout = write_timeout
+        self._peers = []
+        self._peers_mtime = None
+        self._sock = None
+        self._inbound = {}
+        self._outbound = {}
+        self._reader_loop = None
+
+    # Process socket
+
+    def _bind(self):
+        # Only processes that own channels need an address; a process that
+        # just sends (a management command, a sync view) never listens.
+        if self._sock is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.address)
+            sock.listen(128)
+            sock.setblocking(False)
+            self._sock = sock
+            atexit.register(self._unlink)
+        loop = asyncio.get_running_loop()
+        if self._reader_loop is not loop:
+            # The layer outlives event loops (async_to_sync runs one per
+            # call outside a server), so the readers follow the current one
+            old = self._reader_loop
+            if old is not None and not old.is_closed():
+                old.remove_reader(self._sock)
+                for conn in self._inbound:
+                    old.remove_reader(conn)
+            loop.add_reader(self._sock, self._accept)
+            for conn in self._inbound:
+                loop.add_reader(conn, self._read, conn)
+            self._reader_loop = loop
+
+    def _unlink(self):
+        try:
+            os.unlink(self.address)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            conn.setblocking(False)
+            self._inbound[conn] = bytearray()
+            self._reader_loop.add_reader(conn, self._read, conn)
+
+    def _close_inbound(self, conn):
+        if self._reader_loop is not None and not self._reader_loop.is_closed():
+            self._reader_loop.remove_reader(conn)
+        self._inbound.pop(conn, None)
+        conn.close()
+
+    def _read(self, conn):
+        buffer = self._inbound[conn]
+        closed = False
+        while not closed:
+            try:
+                data = conn.recv(SOCKET_BUFFER)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                data = b''
+            # An empty read is the peer closing, after everything it sent
+            closed = not data
+            buffer += data
+        while len(buffer) >= HEADER:
+            length = int.from_bytes(buffer[:HEADER], 'big')
+            if length > MAX_MESSAGE:
+                logger.warning('Closed a channel layer connection sending a %d byte frame', length)
+                closed = True
+                break
+            if len(buffer) < HEADER + length:
+                break
+            data = bytes(buffer[HEADER:HEADER + length])
+            del buffer[:HEADER + length]
+            self._receive_packet(data)
+        if closed:
+            self._close_inbound(conn)
+
+    def _receive_packet(self, data):
+        try:
+            packet = json.loads(data)
+            op = packet['op']
+            if op == 'send':
+                channel, message = packet['channel'], packet['message']
+            elif op == 'group':
+                group, message = packet['group'], packet['message']
+            else:
+                raise ValueError(op)
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Dropped malformed channel layer message')
+            return
+        if op == 'send':
+            self._deliver(channel, message)
+        else:
+            for channel in list(self.groups.get(group, ())):
+                self._deliver(channel, deepcopy(message))
+
+    def _deliver(self, channel, message):
+        queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+        try:
+            queue.put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            pass
+
+    # Connections to peers
+
+    def _connect(self, address):
+        # The open connection to `address`, or None when nothing listens there
+        peer = self._outbound.get(address)
+        if peer is not None:
+            return peer
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        # Local connects complete at once unless the listener's backlog is full
+        sock.settimeout(1)
+        try:
+            sock.connect(address)
+        except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+            sock.close()
+            return None
+        sock.setblocking(False)
+        peer = self._outbound[address] = Peer(sock)
+        return peer
+
+    def _disconnect(self, address):
+        peer = self._outbound.pop(address, None)
+        if peer is None:
+            return
+        if peer.loop is not None and not peer.loop.is_closed():
+            peer.loop.remove_writer(peer.sock)
+        peer.sock.close()
+        peer.wake()
+
+    def _watch(self, address, peer):
+        # Writes wait for the socket on the running loop
+        loop = asyncio.get_running_loop()
+        if peer.loop is not loop:
+            if peer.loop is not None and not peer.loop.is_closed():
+                peer.loop.remove_writer(peer.sock)
+            peer.loop = loop
+            loop.add_writer(peer.sock, self._flush, address, peer)
+        return loop
+
+    def _flush(self, address, peer):
+        while peer.buffer:
+            try:
+                sent = peer.sock.send(peer.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # The peer went away; what it had not read is gone with it
+                self._disconnect(address)
+                return
+            del peer.buffer[:sent]
+        if not peer.buffer and peer.loop is not None:
+            if not peer.loop.is_closed():
+                peer.loop.remove_writer(peer.sock)
+            peer.loop = None
+        if len(peer.buffer) <= self.write_buffer:
+            peer.wake()
+
+    async def _send_packet(self, address, packet):
+        # Queues one framed message for `address`; returns False when no
+        # process listens there any more. Waits while the peer's buffer is
+        # over `write_buffer`, and raises ChannelFull if it stays there.
+        if len(packet) > MAX_MESSAGE:
+            raise ValueError(f'Channel layer message of {len(packet)} bytes is too large')
+        frame = len(packet).to_bytes(HEADER, 'big') + packet
+        for _ in range(2):
+            peer = self._connect(address)
+            if peer is None:
+                return False
+            peer.buffer += frame
+            loop = self._watch(address, peer)
+            self._flush(address, peer)
+            if self._outbound.get(address) is peer:
+                break
+            # The connection broke (the peer restarted its listener, or
+            # exited); reconnect once for this message
+        else:
+            return False
+        if len(peer.buffer) > self.write_buffer:
+            waiter = loop.create_future()
+            peer.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, self.write_timeout)
+            except asyncio.TimeoutError:
+                logger.warning('Channel layer peer %s stopped reading, disconnected it', address)
+                self._disconnect(address)
+                raise ChannelFull(address)
+        return True
+
+    def _peer_addresses(self):
+        # Re-listed only when a process has come or gone since the last call
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime != self._peers_mtime:
+            self._peers = [str(p) for p in self.path.glob('*.sock') if str(p) != self.address]
+            self._peers_mtime = mtime
+        return self._peers
+
+    def _node_of(self, channel):
+        if '!' not in channel:
+            return None
+        return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific.'):
+        self._bind()
+        return '%s%s!%s' % (
+            prefix,
+            self.node,
+            ''.join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    async def send(self, channel, message):
+        node = self._node_of(channel)
+        if node is None or node == self.node:
+            return await super().send(channel, message)
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        packet = json.dumps({'op': 'send', 'channel': channel, 'message': message}).encode()
+        await self._send_packet(str(self.path / f'{node}.sock'), packet)
+
+    async def receive(self, channel):
+        self._bind()
+        return await super().receive(channel)
+
+    async def group_add(self, group, channel):
+        self._bind()
+        await super().group_add(group, channel)
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        packet = json.dumps({'op': 'group', 'group': group, 'message': message}).encode()
+        for address in self._peer_addresses():
+            try:
+                if not await self._send_packet(address, packet):
+                    # Left behind by a process that died without cleaning up
+                    Path(address).unlink(missing_ok=True)
+            except ChannelFull:
+                logger.warning('Channel layer peer %s is full, dropped a message for %s', address, group)
+
+    async def close(self):
+        # Gives buffered messages up to write_timeout to go out first
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.write_timeout
+        for address, peer in list(self._outbound.items()):
+            while peer.buffer and self._outbound.get(address) is peer and loop.time() < deadline:
+                self._watch(address, peer)
+                waiter = loop.create_future()
+                peer.waiters.append(waiter)
+                await asyncio.wait([waiter], timeout=0.05)
+            self._disconnect(address)
+        if self._sock is not None:
+            for conn in list(self._inbound):
+                self._close_inbound(conn)
+            if self._reader_loop is not None and not self._reader_loop.is_closed():
+                self._reader_loop.remove_reader(self._sock)
+            self._sock.close()
+            self._sock = None
+            self._reader_loop = None
+            self._unlink()
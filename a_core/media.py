@@ -0,0 +1,300 @@
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from http.cookies import SimpleCookie
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.utils.module_loading import import_string
+
+from .metrics import registry
+from .storage import BLOB_DIR, stat_version
+
+# Never served: the blob store behind every name, and partial chunked uploads
+DENIED_DIRS = (BLOB_DIR, 'uploads')
+CHUNK_SIZE = 256 * 1024
+IMMUTABLE = 365 * 24 * 3600
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+responses = registry.counter('file_responses_total', 'Media and static file responses by status', ('files', 'status'))
+sent_bytes = registry.counter('file_sent_bytes_total', 'Media and static file body bytes sent', ('files',))
+
+
+def url_prefix(url):
+    return '/' + urlparse(url).path.strip('/') + '/'
+
+
+def file_name(path, denied=()):
+    # The storage name for a request path below the URL prefix, or None for
+    # anything that could step outside the root or into a denied directory
+    parts = path.split('/')
+    if not parts or parts[0] in denied:
+        return None
+    for part in parts:
+        if not part or part.startswith('.') or '\\' in part or '\0' in part:
+            return None
+    return '/'.join(parts)
+
+
+def request_headers(scope):
+    return {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+
+
+def accepts(header, coding):
+    # Whether an Accept-Encoding value allows `coding` (q=0 refuses it)
+    for item in header.split(','):
+        token, _, params = item.partition(';')
+        if token.strip().lower() == coding:
+            try:
+                return float(params.strip().lower().removeprefix('q=') or 1) > 0
+            except ValueError:
+                return True
+    return False
+
+
+def session_user(scope):
+    # The logged-in user of an http scope, from the session cookie
+    cookies = SimpleCookie()
+    for key, value in scope['headers']:
+        if key == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+    engine = import_string(settings.SESSION_ENGINE)
+    session = engine.SessionStore(session_key.value if session_key else None)
+    return get_user(SimpleNamespace(session=session))
+
+
+def byte_range(header, size):
+    # (start, end) inclusive for a single satisfiable range, 'unsatisfiable',
+    # or None to send the whole file (no header, or several ranges)
+    match = RANGE.match(header.replace(' ', ''))
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'unsatisfiable'
+    return start, end
+
+
+class FileServer:
+    # Base for the ASGI file apps below, which sit in front of Django. serve()
+    # handles single byte ranges (If-Range included), a strong ETag with
+    # If-None-Match and If-Modified-Since, and HEAD. The body goes out
+    # through the ASGI zero-copy extension where the server offers it, else
+    # in CHUNK_SIZE reads off the event loop; daphne offers none, so it
+    # streams.
+
+    files = None
+
+    def __init__(self, app):
+        self.app = app
+
+    async def not_allowed(self, scope, send):
+        if scope['method'] in ('GET', 'HEAD'):
+            return False
+        await self.respond(send, 405, [(b'allow', b'GET, HEAD')])
+        return True
+
+    async def serve(self, scope, send, f, name, cache_control, extra_headers=(), content_encoding=None):
+        # Sends the open file `f`, stored as `name`; with content_encoding
+        # set, f holds that encoding of `name`
+        info = os.fstat(f.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            return await self.respond(send, 404)
+        headers = request_headers(scope)
+        etag = f'"{stat_version(info)}"'
+        size = info.st_size
+
+        content_type, encoding = mimetypes.guess_type(name)
+        response_headers = [
+            (b'etag', etag.encode()),
+            (b'last-modified', formatdate(info.st_mtime, usegmt=True).encode()),
+            (b'cache-control', cache_control.encode()),
+            (b'accept-ranges', b'bytes'),
+            (b'x-content-type-options', b'nosniff'),
+        ] + list(extra_headers)
+        if content_encoding is not None:
+            response_headers.append((b'content-encoding', content_encoding.encode()))
+
+        if self.not_modified(headers, etag, info.st_mtime):
+            return await self.respond(send, 304, response_headers)
+
+        status = 200
+        start, end = 0, size - 1
+        requested_range = headers.get('range')
+        if requested_range and headers.get('if-range', etag) == etag:
+            found = byte_range(requested_range, size)
+            if found == 'unsatisfiable':
+                return await self.respond(send, 416, [(b'content-range', f'bytes */{size}'.encode())])
+            if found is not None:
+                status = 206
+                start, end = found
+                response_headers.append((b'content-range', f'bytes {start}-{end}/{size}'.encode()))
+        length = end - start + 1 if size else 0
+
+        if encoding is None:
+            response_headers.append((b'content-type', (content_type or 'application/octet-stream').encode()))
+        else:
+            # .gz and the like are served as the bytes they are
+            response_headers.append((b'content-type', b'application/octet-stream'))
+        response_headers.append((b'content-length', str(length).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+        responses.inc(files=self.files, status=status)
+        if scope['method'] == 'HEAD' or length == 0:
+            return await send({'type': 'http.response.body', 'body': b''})
+
+        if 'http.response.zerocopy' in (scope.get('extensions') or {}):
+            await send({'type': 'http.response.zerocopy', 'file': f, 'offset': start, 'count': length})
+        else:
+            offset = start
+            while offset <= end:
+                chunk = await asyncio.to_thread(os.pread, f.fileno(), min(CHUNK_SIZE, end - offset + 1), offset)
+                if not chunk:
+                    # Cut short under us; the response is already started
+                    break
+                offset += len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset <= end})
+            if offset <= end:
+                await send({'type': 'http.response.body', 'body': b''})
+        sent_bytes.inc(length, files=self.files)
+
+    def not_modified(self, headers, etag, mtime):
+        if_none_match = headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # Weak comparison, as RFC 9110 asks for If-None-Match
+            return '*' in tags or etag in tags or f'W/{etag}' in tags
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def respond(self, send, status, headers=()):
+        responses.inc(files=self.files, status=status)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': list(headers) + [(b'content-length', b'0')],
+        })
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+class MediaFiles(FileServer):
+    # Serves uploads below MEDIA_URL without a trip through the Django
+    # stack, cached for a year as immutable when the URL's ?v= matches the
+    # file (storage.url() adds it).
+    #
+    # `access(name, load_user)` runs in a thread and returns 'public',
+    # 'private' (send with private caching) or None (answer 404, the same as
+    # a missing file); load_user() resolves the session user on demand.
+
+    files = 'media'
+
+    def __init__(self, app, access=None):
+        super().__init__(app)
+        self.access = access
+
+    async def __call__(self, scope, receive, send):
+        prefix = url_prefix(settings.MEDIA_URL)
+        if (scope['type'] != 'http' or not getattr(settings, 'SERVE_MEDIA', True)
+                or not scope['path'].startswith(prefix)):
+            return await self.app(scope, receive, send)
+        if await self.not_allowed(scope, send):
+            return
+
+        name = file_name(scope['path'][len(prefix):], DENIED_DIRS)
+        visibility = 'public'
+        if name is not None and self.access is not None:
+            visibility = await database_sync_to_async(self.access)(name, lambda: session_user(scope))
+        if name is None or visibility is None:
+            return await self.respond(send, 404)
+        try:
+            fd = os.open(os.path.join(settings.MEDIA_ROOT, name), os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError:
+            return await self.respond(send, 404)
+        with os.fdopen(fd, 'rb') as f:
+            requested = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('v', [None])[0]
+            if requested == stat_version(os.fstat(f.fileno())):
+                cache_control = f'{visibility}, max-age={IMMUTABLE}, immutable'
+            else:
+                cache_control = f"{visibility}, max-age={getattr(settings, 'MEDIA_CACHE_SECONDS', 3600)}"
+            extra_headers = [(b'vary', b'Cookie')] if visibility == 'private' else []
+            await self.serve(scope, send, f, name, cache_control, extra_headers)
+
+
+class StaticFiles(FileServer):
+    # Serves collectstatic output below STATIC_URL. Names with a content
+    # hash (the values of the staticfiles.json manifest) are cached for a
+    # year as immutable, anything else for STATIC_CACHE_SECONDS; clients
+    # that accept gzip get the .gz variant collectstatic wrote, if any.
+    # Files missing from STATIC_ROOT are left to Django, so runserver's
+    # finder-based serving still works before collectstatic.
+
+    files = 'static'
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.hashed = None
+
+    def hashed_names(self):
+        if self.hashed is None:
+            from django.contrib.staticfiles.storage import staticfiles_storage
+            self.hashed = frozenset(getattr(staticfiles_storage, 'hashed_files', {}).values())
+        return self.hashed
+
+    async def __call__(self, scope, receive, send):
+        prefix = url_prefix(settings.STATIC_URL)
+        if (scope['type'] != 'http' or not getattr(settings, 'SERVE_STATIC', True)
+                or not settings.STATIC_ROOT or not scope['path'].startswith(prefix)):
+            return await self.app(scope, receive, send)
+        if await self.not_allowed(scope, send):
+            return
+        name = file_name(scope['path'][len(prefix):])
+        if name is None:
+            return await self.respond(send, 404)
+        path = os.path.join(settings.STATIC_ROOT, name)
+        flags = os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0)
+        try:
+            fd = os.open(path, flags)
+        except OSError:
+            return await self.app(scope, receive, send)
+
+        extra_headers = []
+        content_encoding = None
+        try:
+            gzip_fd = os.open(path + '.gz', flags)
+        except OSError:
+            pass
+        else:
+            # Shared caches must keep the two variants apart
+            extra_headers.append((b'vary', b'Accept-Encoding'))
+            if accepts(request_headers(scope).get('accept-encoding', ''), 'gzip'):
+                os.close(fd)
+                fd, content_encoding = gzip_fd, 'gzip'
+            else:
+                os.close(gzip_fd)
+
+        if name in self.hashed_names():
+            cache_control = f'public, max-age={IMMUTABLE}, immutable'
+        else:
+            cache_control = f"public, max-age={getattr(settings, 'STATIC_CACHE_SECONDS', 3600)}"
+        with os.fdopen(fd, 'rb') as f:
+            await self.serve(scope, send, f, name, cache_control, extra_headers, content_encoding)
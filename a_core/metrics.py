@@ -0,0 +1,200 @@
+import math
+import threading
+from bisect import bisect_left
+
+# In-process metrics in the Prometheus text format. Every daphne worker keeps
+# its own numbers; a scraper reads each worker separately. Label sets are
+# capped per metric so a stray label value cannot grow memory without bound:
+# past MAX_SERIES new label sets are folded into one 'other' series.
+
+MAX_SERIES = 500
+OTHER = 'other'
+
+EVENT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        if key not in self.series and len(self.series) >= MAX_SERIES:
+            key = (OTHER,) * len(self.labelnames)
+        return key
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {format_value(value)}' for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = list(self.series.items())
+        return [(self.name, self.label_text(key), value) for key, value in series]
+
+
+class Gauge(Metric):
+    # Set directly, or computed at scrape time by a callback returning
+    # {label tuple: value} (see set_function)
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self.function = function
+
+    def cap(self, values):
+        # Computed series keep the largest MAX_SERIES values
+        series = sorted(values.items(), key=lambda item: item[1], reverse=True)
+        if len(series) > MAX_SERIES:
+            rest = sum(value for _, value in series[MAX_SERIES - 1:])
+            series = series[:MAX_SERIES - 1] + [((OTHER,) * len(self.labelnames), rest)]
+        return series
+
+    def samples(self):
+        if self.function is not None:
+            series = self.cap(self.function())
+        else:
+            with self.lock:
+                series = list(self.series.items())
+        return [(self.name, self.label_text(key if isinstance(key, tuple) else (key,)), value) for key, value in series]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        with self.lock:
+            key = self.key(labels)
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0, 0]
+            self._add(series, value)
+
+    def labels(self, **labels):
+        # The series for one label set, for hot paths: observing through it
+        # skips building the label key
+        with self.lock:
+            key = self.key(labels)
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0, 0])
+        return BoundHistogram(self, series)
+
+    def _add(self, series, value):
+        # Bucket counts are stored per bucket and summed into the cumulative
+        # Prometheus form at scrape time, so an observation is one increment
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        with self.lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self.series.items()]
+        samples = []
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', self.label_text(key, [('le', format_value(float(bound)))]), cumulative))
+            samples.append((f'{self.name}_sum', self.label_text(key), total))
+            samples.append((f'{self.name}_count', self.label_text(key), count))
+        return samples
+
+
+class BoundHistogram:
+
+    def __init__(self, histogram, series):
+        self.histogram = histogram
+        self.series = series
+
+    def observe(self, value):
+        with self.histogram.lock:
+            self.histogram._add(self.series, value)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # Registering the same name twice returns the first metric, so
+        # modules can declare their metrics at import time
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,155 @@
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import Template
+
+from .metrics import QUERY_BUCKETS, SIZE_BUCKETS, registry
+
+requests_total = registry.counter(
+    'http_requests_total', 'HTTP requests by url pattern, method and status', ('route', 'method', 'status'))
+request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Time spent in the view and the middleware below MetricsMiddleware', ('route',))
+db_queries = registry.histogram(
+    'http_db_queries', 'SQL queries run per request', ('route',), buckets=QUERY_BUCKETS)
+db_seconds = registry.histogram(
+    'http_db_duration_seconds', 'Time spent in SQL queries per request', ('route',))
+template_seconds = registry.histogram(
+    'http_template_duration_seconds', 'Time spent rendering templates per request', ('route',))
+response_bytes = registry.histogram(
+    'http_response_size_bytes', 'Response body size', ('route',), buckets=SIZE_BUCKETS)
+
+# The stats of the request being handled, for the template timer
+current = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.templates = 0.0
+        self.rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - started
+            self.queries += 1
+
+
+def timed_render(render):
+    # Wraps the template backend's render(), which runs once per
+    # render()/render_to_string() call; {% include %}s render inside it.
+    # The rendering flag keeps a render_to_string() inside a template tag
+    # from being counted twice.
+    def wrapper(self, context=None, request=None):
+        stats = current.get()
+        if stats is None or stats.rendering:
+            return render(self, context, request)
+        stats.rendering = True
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            stats.templates += time.perf_counter() - started
+            stats.rendering = False
+    wrapper.timed = True
+    return wrapper
+
+
+def install_template_timer():
+    # Called from a_home's AppConfig.ready() when METRICS_TEMPLATE_TIMING is
+    # on; without it http_template_duration_seconds stays at zero
+    if not getattr(Template.render, 'timed', False):
+        Template.render = timed_render(Template.render)
+
+
+class MetricsMiddleware:
+    # Per-route latency, SQL query count and time, template time and response
+    # size, exported by a_home.views.metrics_view. Sync only: the view and
+    # this middleware then share a thread, and with it the DB connections
+    # the execute wrapper is installed on.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = current.set(stats)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        elapsed = time.perf_counter() - started
+
+        # Labelled by url pattern rather than path or url name: patterns are a
+        # fixed set, and some url names are used twice
+        match = request.resolver_match
+        route = '/' + match.route if match else 'unresolved'
+        requests_total.inc(route=route, method=request.method, status=response.status_code)
+        request_seconds.observe(elapsed, route=route)
+        db_queries.observe(stats.queries, route=route)
+        db_seconds.observe(stats.db, route=route)
+        template_seconds.observe(stats.templates, route=route)
+        if not response.streaming:
+            response_bytes.observe(len(response.content), route=route)
+        elif response.has_header('Content-Length'):
+            response_bytes.observe(int(response['Content-Length']), route=route)
+        return response
+
+
+class RequestSizeLimit:
+    # ASGI middleware in front of Django: answers 413 to a request whose
+    # body is over MAX_REQUEST_BODY_SIZE, going by Content-Length before
+    # Django reads and spools any of it, or by counting for bodies sent
+    # without one. Daphne itself has buffered the body by then; the limit
+    # for that belongs in the proxy in front of it.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        limit = getattr(settings, 'MAX_REQUEST_BODY_SIZE', None)
+        if limit is None:
+            return await self.app(scope, receive, send)
+        length = dict(scope['headers']).get(b'content-length', b'')
+        if length.isdigit() and int(length) > limit:
+            return await self.refuse(send)
+
+        received = 0
+        over = False
+
+        async def limited_receive():
+            nonlocal received, over
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # Django stops reading and sends nothing
+                    over = True
+                    return {'type': 'http.disconnect'}
+            return message
+
+        await self.app(scope, limited_receive, send)
+        if over:
+            await self.refuse(send)
+
+    async def refuse(self, send):
+        body = b'Request body too large'
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -55,10 +55,12 @@ SITE_ID = 1
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'a_core.middleware.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'a_home.profiling.ProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     #'allauth.account.middleware.AccountMiddleware', # This line was commented out in the original, keeping it that way.
@@ -108,6 +110,16 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Several daphne workers on one host: deliver between them over Unix
+# stream sockets in CHANNEL_LAYER_PATH, no external service needed
+if os.environ.get('CHANNEL_LAYER') == 'unix':
+    CHANNEL_LAYERS['default'] = {
+        "BACKEND": "a_core.layers.UnixSocketChannelLayer",
+        "CONFIG": {
+            "path": os.environ.get('CHANNEL_LAYER_PATH', '/tmp/mentorconnect-channels'),
+        },
+    }
+
 #CHANNEL_LAYERS = {
 #    "default": {
 #        "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -117,6 +129,80 @@ CHANNEL_LAYERS = {
 #    },
 #}
 
+# Realtime chat
+# 'render_once' renders each chat message once per broadcast and ships the
+# html in the channel-layer event; 'per_socket' re-queries and re-renders it
+# in every connected consumer.
+RTCHAT_BROADCAST_MODE = os.environ.get('RTCHAT_BROADCAST_MODE', 'render_once')
+# 'sync' (WebsocketConsumer) or 'async' (AsyncWebsocketConsumer) chatroom consumer
+RTCHAT_CONSUMER = os.environ.get('RTCHAT_CONSUMER', 'sync')
+# Online counts are broadcast at most once per debounce window and written
+# to ChatGroup.users_online every persist interval (seconds)
+RTCHAT_PRESENCE_DEBOUNCE = 0.5
+RTCHAT_PRESENCE_PERSIST_INTERVAL = 30
+# Every row of users_online is checked against the live sockets of all
+# workers one heartbeat interval after startup and then this often (seconds)
+RTCHAT_PRESENCE_REPAIR_INTERVAL = 3600
+# Sockets get a heartbeat every interval and are closed, and dropped from
+# presence, when nothing has come back within the idle timeout (seconds)
+RTCHAT_HEARTBEAT_INTERVAL = 25
+RTCHAT_IDLE_TIMEOUT = 75
+# Write-behind: chat messages get a reserved id and are broadcast at once,
+# then inserted with bulk_create in batches of up to BATCH_SIZE or every
+# MAX_DELAY seconds. DURABILITY 'async' broadcasts before the batch commits,
+# 'commit' waits for it (group commit). Buffered messages are flushed at exit.
+RTCHAT_WRITE_BEHIND = os.environ.get('RTCHAT_WRITE_BEHIND', 'False').lower() == 'true'
+RTCHAT_WRITE_BEHIND_DURABILITY = os.environ.get('RTCHAT_WRITE_BEHIND_DURABILITY', 'async')
+RTCHAT_WRITE_BEHIND_BATCH_SIZE = 200
+RTCHAT_WRITE_BEHIND_MAX_DELAY = 0.05
+# The chat page asks for compact JSON frames (?protocol=json) and renders
+# messages itself instead of receiving html fragments
+RTCHAT_COMPACT_PROTOCOL = os.environ.get('RTCHAT_COMPACT_PROTOCOL', 'False').lower() == 'true'
+# Negotiate permessage-deflate on websockets (patches daphne's factory, see
+# a_core/websocket.py). Each socket keeps its own compressor, about
+# 2**(WINDOW_BITS + 2) + 2**(MEM_LEVEL + 9) bytes.
+WEBSOCKET_DEFLATE = os.environ.get('WEBSOCKET_DEFLATE', 'False').lower() == 'true'
+WEBSOCKET_DEFLATE_WINDOW_BITS = 12
+WEBSOCKET_DEFLATE_MEM_LEVEL = 5
+# Chat files are capped at MAX_FILE_SIZE (a_users/constants.py). The chat
+# page sends files over one chunk as a resumable series of chunk requests;
+# unfinished uploads are kept for PARTIAL_TTL seconds, at most MAX_PARTIAL
+# per user
+CHAT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+CHAT_UPLOAD_PARTIAL_TTL = 24 * 3600
+CHAT_UPLOAD_MAX_PARTIAL = 3
+# Larger request bodies get a 413 before Django reads them (a_core.asgi)
+MAX_REQUEST_BODY_SIZE = 11 * 1024 * 1024
+# Messages per chat history page (initial load and each infinite-scroll fetch)
+CHAT_HISTORY_PAGE_SIZE = 30
+
+# Mentor directory on the home page: cards per page and how long a rendered
+# page stays cached (pages are also invalidated on every Profile save)
+MENTOR_DIRECTORY_PAGE_SIZE = 24
+MENTOR_DIRECTORY_CACHE_TIMEOUT = 300
+# Pages are cached per process; the version that invalidates them lives in
+# this cache, which must be shared by all workers (see CACHES)
+MENTOR_DIRECTORY_VERSION_CACHE = 'shared'
+# Mentor search uses an FTS5 table in the SQLite database, kept current from
+# Profile saves (rebuild with `manage.py rebuild_mentor_search`). Resume text
+# is extracted in a background thread; PDFs need pypdf.
+
+# Request metrics (a_core.middleware.MetricsMiddleware) are served at
+# /metrics/ to staff, or to a scraper sending this bearer token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Template render time per request wraps Django's template backend render()
+# at startup (a_home.apps); turn off to leave Django's templates untouched
+METRICS_TEMPLATE_TIMING = True
+# cProfile runs (a_home.profiling), stored as ProfilerRun and downloadable
+# from the admin. Staff profile one request with ?_profile=1 or an
+# "X-Profile: 1" header; these rates profile a random fraction of all
+# requests and chat consumer events (0 is off)
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', '0'))
+PROFILER_WEBSOCKET_SAMPLE_RATE = float(os.environ.get('PROFILER_WEBSOCKET_SAMPLE_RATE', '0'))
+# View budget tests (a_core.testing) multiply their time budgets by this;
+# raise it on slow or shared CI machines
+TEST_BUDGET_TIME_SCALE = float(os.environ.get('TEST_BUDGET_TIME_SCALE', '1'))
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
@@ -128,6 +214,20 @@ DATABASES = {
 }
 
 
+# 'default' is per process. 'shared' is seen by every process on the host,
+# for the few keys that must agree across workers; point it at Redis or
+# Memcached when workers run on several hosts.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('SHARED_CACHE_DIR', BASE_DIR / 'cache'),
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -164,9 +264,34 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [ BASE_DIR / 'static' ]
+# collectstatic output: content-hashed names plus .gz variants, served by
+# a_core.media.StaticFiles in front of Django (SERVE_STATIC=False when a
+# proxy serves it)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+SERVE_STATIC = os.environ.get('SERVE_STATIC', 'True').lower() == 'true'
+# For static names without a content hash (e.g. files added outside collectstatic)
+STATIC_CACHE_SECONDS = 3600
 
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media' 
+# Media is served by a_core.media.MediaFiles in front of Django (ranges,
+# ETags, private chat attachments checked); turn off when a proxy serves it.
+# URLs without the current ?v= version are cached for MEDIA_CACHE_SECONDS.
+SERVE_MEDIA = os.environ.get('SERVE_MEDIA', 'True').lower() == 'true'
+MEDIA_CACHE_SECONDS = 3600
+
+# Uploads are stored once per distinct content under media/cas and linked
+# to their names (see a_core/storage.py); `manage.py dedupe_media` folds in
+# files saved before and removes unreferenced blobs. Static files are
+# hashed and gzipped by collectstatic.
+STORAGES = {
+    'default': {
+        'BACKEND': 'a_core.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'a_core.storage.CompressedManifestStaticFilesStorage',
+    },
+}
 
 
 
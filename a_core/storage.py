@@ -0,0 +1,232 @@
+import errno
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.storage import FileSystemStorage
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = 'cas'
+# Hard links are not possible across filesystems, on some filesystems at
+# all, or past the per-inode link limit; those saves fall back to a copy
+NO_LINK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP}
+# Static files worth a .gz variant; images other than svg/ico are already
+# compressed
+COMPRESSIBLE = ('.css', '.js', '.mjs', '.map', '.json', '.svg', '.ico', '.txt', '.xml', '.html')
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError as exc:
+        if exc.errno not in NO_LINK:
+            raise
+        with open(source, 'rb') as src, open(destination, 'xb') as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def stat_version(stat):
+    # Identifies a stored file's bytes: names are only ever created as links
+    # to a finished blob and never written in place, and inode, size and
+    # mtime together are not reused by a different blob in practice
+    key = f'{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+def collect_garbage(location):
+    # Removes blobs that no stored name links to any more. Returns (blobs,
+    # bytes) removed. A save that races with this and loses its blob just
+    # writes the blob again (see ContentAddressedStorage._save).
+    removed = freed = 0
+    root = os.path.join(location, BLOB_DIR)
+    for directory, _, files in os.walk(root):
+        if os.path.basename(directory) == 'tmp':
+            continue
+        for filename in files:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+                if stat.st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+                    freed += stat.st_size
+            except FileNotFoundError:
+                pass
+    return removed, freed
+
+
+class BlobCollector:
+    # Runs collect_garbage in a daemon thread `delay` seconds after the first
+    # delete since the last run, so a burst of deletes costs one sweep
+
+    def __init__(self, storage, delay=60):
+        self.storage = storage
+        self.delay = delay
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def schedule(self):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.run)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def run(self):
+        with self.lock:
+            self.timer = None
+        try:
+            removed, freed = collect_garbage(self.storage.location)
+        except Exception:
+            logger.exception('Media blob garbage collection failed')
+            return
+        if removed:
+            logger.info('Removed %s unreferenced media blobs (%s bytes)', removed, freed)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    # FileSystemStorage that keeps each distinct file once. Content is hashed
+    # (SHA-256) while it is written, stored as cas/<ab>/<digest>, and every
+    # saved name is a hard link to that blob. Names, URLs and paths stay the
+    # same as before, and deleting a name (django_cleanup included) only
+    # removes that link. A blob's link count less one is the number of names
+    # using it; BlobCollector drops blobs left with none.
+
+    def __init__(self, *args, gc_delay=60, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collector = BlobCollector(self, gc_delay)
+
+    def blob_path(self, digest):
+        return os.path.join(self.location, BLOB_DIR, digest[:2], digest)
+
+    def references(self, name):
+        # How many stored names share this name's content, itself included
+        return os.stat(self.path(name)).st_nlink - 1
+
+    def version(self, name):
+        return stat_version(os.stat(self.path(name)))
+
+    def url(self, name):
+        # Carries the version, so a media URL names exactly one content and
+        # can be cached as immutable (see a_core/media.py). Names freed by a
+        # delete may later hold other content under a new version.
+        url = super().url(name)
+        try:
+            return f'{url}?v={self.version(name)}'
+        except OSError:
+            return url
+
+    def store_blob(self, content):
+        # Returns the path of the blob holding `content`. Uploads Django has
+        # already spooled to disk are hashed in place and linked, not copied
+        # again; anything else is hashed while it is written to cas/tmp.
+        tmp_dir = os.path.join(self.location, BLOB_DIR, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        if hasattr(content, 'temporary_file_path'):
+            source = content.temporary_file_path()
+            blob = self.blob_path(file_digest(source))
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    link_or_copy(source, blob)
+                    os.chmod(blob, self.file_permissions_mode or 0o644)
+                except FileExistsError:
+                    pass
+            return blob
+
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+            os.chmod(tmp, self.file_permissions_mode or 0o644)
+            blob = self.blob_path(digest.hexdigest())
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(tmp, blob)
+            except FileExistsError:
+                pass
+            except OSError as exc:
+                if exc.errno not in NO_LINK:
+                    raise
+                os.replace(tmp, blob)
+            return blob
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _save(self, name, content):
+        blob = self.store_blob(content)
+        while True:
+            full_path = self.path(name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            try:
+                link_or_copy(blob, full_path)
+            except FileExistsError:
+                name = self.get_available_name(name)
+                continue
+            except FileNotFoundError:
+                # Collected between store_blob and here
+                blob = self.store_blob(content)
+                continue
+            return str(name).replace('\\', '/')
+
+    def delete(self, name):
+        super().delete(name)
+        self.collector.schedule()
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # collectstatic writes content-hashed copies (style.3f2a9c1b7e4d.css)
+    # with staticfiles.json mapping names to them, as usual, and then a .gz
+    # next to every compressible file that gzip makes at least 5% smaller.
+    # a_core.media.StaticFiles serves the hashed names as immutable and
+    # picks the .gz for clients that accept it.
+    #
+    # Before collectstatic has run (tests, a fresh checkout) names that are
+    # not in the manifest resolve to themselves instead of raising.
+
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        for name in set(paths) | set(self.hashed_files.values()):
+            if name.endswith(COMPRESSIBLE):
+                self.compress(name)
+
+    def compress(self, name):
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # mtime=0 so the same input always gives the same bytes
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) > len(data) * 0.95:
+            if os.path.exists(path + '.gz'):
+                os.remove(path + '.gz')
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(compressed)
+        os.chmod(tmp, self.file_permissions_mode or 0o644)
+        os.replace(tmp, path + '.gz')
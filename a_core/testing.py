@@ -0,0 +1,102 @@
+import re
+import time
+from collections import Counter
+from importlib import import_module
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+SEED = {'users': 200, 'groups': 10, 'private_chats': 100, 'messages': 20_000, 'seed': 7}
+
+
+class Budget:
+    # The most SQL queries and wall time (best of a few runs) one request to
+    # a view may take. `user` and `kwargs` are called with the test case, so
+    # they can pick objects out of the seeded data.
+
+    def __init__(self, queries, ms, user=None, kwargs=None, path=None, method='get', data=None,
+                 content_type=None, headers=None, status=(200, 302)):
+        self.queries = queries
+        self.ms = ms
+        self.user = user
+        self.kwargs = kwargs
+        self.path = path
+        self.method = method
+        self.data = data
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.status = status
+
+
+def normalize(sql):
+    # Same statement with different parameters counts as a repeat
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    return re.sub(r'IN \((?:\?, )*\?\)', 'IN (...)', sql)
+
+
+def query_report(name, budget, queries):
+    counts = Counter(normalize(query['sql']) for query in queries)
+    lines = [f'{name}: {len(queries)} queries, budget is {budget.queries} ({len(queries) - budget.queries} extra)']
+    for sql, count in counts.most_common():
+        marker = '+' if count > 1 else ' '
+        lines.append(f'{marker} {count:>4} x {sql}')
+    return '\n'.join(lines)
+
+
+class BudgetTests:
+    # Mixed into a TestCase: runs every view of `urlconf` against a seeded
+    # dataset and fails when one goes over its Budget. Subclasses list a
+    # Budget for each url name; a url without one fails too, so new views
+    # cannot skip the check. Not a TestCase itself, so importing it does not
+    # add a test of its own. Time budgets are multiplied by
+    # TEST_BUDGET_TIME_SCALE for slower machines.
+    urlconf = None
+    budgets = {}
+    repeat = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', stdout=StringIO(), **SEED)
+
+    def test_every_url_has_a_budget(self):
+        names = {pattern.name for pattern in import_module(self.urlconf).urlpatterns if pattern.name}
+        self.assertEqual(names - set(self.budgets), set(), 'views without a budget')
+
+    def test_budgets(self):
+        for name, budget in self.budgets.items():
+            with self.subTest(view=name):
+                self.check_budget(name, budget)
+
+    def check_budget(self, name, budget):
+        if budget.user is not None:
+            self.client.force_login(budget.user(self))
+        else:
+            self.client.logout()
+        path = budget.path or reverse(name, kwargs=budget.kwargs(self) if budget.kwargs else None)
+        extra = {'content_type': budget.content_type} if budget.content_type else {}
+
+        timings = []
+        queries = []
+        for _ in range(self.repeat):
+            # Each run starts from the same data, whatever the view changes;
+            # the query count is the worst run's, usually the cold first one
+            data = budget.data(self) if callable(budget.data) else budget.data
+            with transaction.atomic():
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = getattr(self.client, budget.method)(path, data, headers=budget.headers, **extra)
+                    timings.append((time.perf_counter() - started) * 1000)
+                transaction.set_rollback(True)
+            if len(captured.captured_queries) > len(queries):
+                queries = captured.captured_queries
+
+        self.assertIn(response.status_code, budget.status, f'{name}: unexpected status')
+        if len(queries) > budget.queries:
+            self.fail(query_report(name, budget, queries))
+        limit = budget.ms * getattr(settings, 'TEST_BUDGET_TIME_SCALE', 1)
+        self.assertLessEqual(min(timings), limit, f'{name}: {min(timings):.0f}ms, budget is {limit:.0f}ms')
@@ -19,7 +19,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf.urls.static import static
 from django.conf import settings
-from a_home.views import home_view
+from a_home.views import home_view, mentor_search_view, metrics_view
 from a_users.views import profile_view
 from django.urls import path, include
 
@@ -27,6 +27,8 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),
     path('', home_view, name='home'),
+    path('search/', mentor_search_view, name='mentor-search'),
+    path('metrics/', metrics_view, name='metrics'),
     path('chat/', include('a_rtchat.urls')),
     path('profile/', include('a_users.urls')),  # This should include all a_users URLs
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -0,0 +1,44 @@
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def accept_deflate(offers):
+    # Accepts the client's first permessage-deflate offer. Our side keeps its
+    # context between messages (repeated JSON keys and markup compress away)
+    # but with a small window and memory level, since every socket holds a
+    # compressor for as long as it is open.
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            window_bits = getattr(settings, 'WEBSOCKET_DEFLATE_WINDOW_BITS', 12)
+            if offer.request_max_window_bits:
+                window_bits = min(window_bits, offer.request_max_window_bits)
+            return PerMessageDeflateOfferAccept(
+                offer,
+                window_bits=window_bits,
+                mem_level=getattr(settings, 'WEBSOCKET_DEFLATE_MEM_LEVEL', 5),
+            )
+    return None
+
+
+def enable_permessage_deflate():
+    # Daphne builds its autobahn factory without compression and has no
+    # option for it, so the options it sets are extended here. Must run
+    # before the server starts, i.e. when the ASGI application is imported.
+    from daphne.ws_protocol import WebSocketFactory
+
+    if getattr(WebSocketFactory, 'deflate_enabled', False):
+        return
+    set_protocol_options = WebSocketFactory.setProtocolOptions
+
+    def setProtocolOptions(self, *args, **kwargs):
+        kwargs.setdefault('perMessageCompressionAccept', accept_deflate)
+        return set_protocol_options(self, *args, **kwargs)
+
+    WebSocketFactory.setProtocolOptions = setProtocolOptions
+    WebSocketFactory.deflate_enabled = True
+    logger.info('permessage-deflate enabled for websockets')
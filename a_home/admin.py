@@ -1,3 +1,37 @@
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+from .models import ProfilerRun
 
 # Register your models here.
+@admin.register(ProfilerRun)
+class ProfilerRunAdmin(admin.ModelAdmin):
+    list_display = ['created', 'kind', 'target', 'duration_ms', 'user', 'download']
+    list_filter = ['kind']
+    search_fields = ['target']
+    readonly_fields = ['kind', 'target', 'user', 'duration_ms', 'created', 'download', 'summary']
+    exclude = ['stats']
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        urls = [
+            path('<int:pk>/download/', self.admin_site.admin_view(self.download_view), name='a_home_profilerrun_download'),
+        ]
+        return urls + super().get_urls()
+
+    @admin.display(description='pstats')
+    def download(self, run):
+        return format_html('<a href="{}">Download .prof</a>', reverse('admin:a_home_profilerrun_download', args=[run.pk]))
+
+    def download_view(self, request, pk):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        run = get_object_or_404(ProfilerRun, pk=pk)
+        response = HttpResponse(bytes(run.stats), content_type='application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="profile-{run.pk}.prof"'
+        return response
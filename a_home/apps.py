@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class AHomeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'a_home'
+
+    def ready(self):
+        import a_home.signals
+        from django.conf import settings
+        if getattr(settings, 'METRICS_TEMPLATE_TIMING', True):
+            from a_core.middleware import install_template_timer
+            install_template_timer()
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# name: (width, height, crop). Sizes are 2x the largest box each is shown in:
+# avatar_sm for w-8/w-10, avatar_md for w-14/w-16, avatar_lg for w-36 and
+# chat for the max-w-72 image bubbles.
+DEFAULT_SIZES = {
+    'avatar_sm': (64, 64, True),
+    'avatar_md': (128, 128, True),
+    'avatar_lg': (288, 288, True),
+    'chat': (576, 576, False),
+}
+
+DERIVATIVES_DIR = 'derivatives'
+
+# Derivative names recently seen to exist, so repeat renders skip the stat;
+# least recently used first, at most KNOWN_LIMIT of them
+KNOWN_LIMIT = 10000
+_known = OrderedDict()
+_lock = threading.Lock()
+# Held across the exists/save pair so a derivative is only written once
+_save_lock = threading.Lock()
+
+
+def get_sizes():
+    return getattr(settings, 'MEDIA_DERIVATIVE_SIZES', DEFAULT_SIZES)
+
+
+def remember(name):
+    with _lock:
+        _known[name] = True
+        _known.move_to_end(name)
+        while len(_known) > KNOWN_LIMIT:
+            _known.popitem(last=False)
+
+
+def known(name):
+    with _lock:
+        if name not in _known:
+            return False
+        _known.move_to_end(name)
+        return True
+
+
+def forget(name):
+    with _lock:
+        _known.pop(name, None)
+
+
+def derivative_name(source_name, size):
+    # Keyed by source file name and size; upload names are never reused while
+    # the file exists, and derivatives are removed with their source.
+    digest = hashlib.sha1(source_name.encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(source_name))[0][:40]
+    return f'{DERIVATIVES_DIR}/{size}/{digest[:2]}/{stem}-{digest}'
+
+
+def render_derivative(source, size):
+    width, height, crop = get_sizes()[size]
+    with Image.open(source) as image:
+        if getattr(image, 'is_animated', False):
+            return None, None
+        # Bake in the EXIF orientation; the re-encode drops EXIF and other metadata
+        image = ImageOps.exif_transpose(image)
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+        buffer = BytesIO()
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.convert('RGBA').save(buffer, 'PNG', optimize=True)
+            extension = '.png'
+        else:
+            image.convert('RGB').save(buffer, 'JPEG', quality=82, optimize=True, progressive=True)
+            extension = '.jpg'
+    return buffer.getvalue(), extension
+
+
+def get_derivative(fieldfile, size):
+    # Returns the storage name of the derivative, generating it on first use.
+    # Falls back to None (serve the original) for animations and bad files.
+    base = derivative_name(fieldfile.name, size)
+    for extension in ('.jpg', '.png'):
+        if known(base + extension):
+            return base + extension
+    for extension in ('.jpg', '.png'):
+        if default_storage.exists(base + extension):
+            remember(base + extension)
+            return base + extension
+
+    try:
+        with fieldfile.open('rb') as source:
+            data, extension = render_derivative(source, size)
+    except Exception:
+        logger.warning('Could not build %s derivative of %s', size, fieldfile.name, exc_info=True)
+        return None
+    if data is None:
+        return None
+
+    name = base + extension
+    with _save_lock:
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(data))
+    remember(name)
+    return name
+
+
+def derivative_url(fieldfile, size):
+    if not fieldfile:
+        return ''
+    name = get_derivative(fieldfile, size)
+    if name is None:
+        return fieldfile.url
+    return default_storage.url(name)
+
+
+def delete_derivatives(source_name):
+    for size in get_sizes():
+        base = derivative_name(source_name, size)
+        for extension in ('.jpg', '.png'):
+            forget(base + extension)
+            if default_storage.exists(base + extension):
+                default_storage.delete(base + extension)
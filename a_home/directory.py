@@ -0,0 +1,96 @@
+import hashlib
+import secrets
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.templatetags.static import static
+
+from a_users.constants import EXPERTISE_CHOICES, WORKING_STATUS_CHOICES
+from a_users.models import Profile
+from .derivatives import derivative_url
+
+VERSION_KEY = 'mentor-directory:version'
+
+FILTERS = {
+    'working_status': dict(WORKING_STATUS_CHOICES),
+    'expertise': dict(EXPERTISE_CHOICES),
+    'organization': None,
+}
+
+
+def clean_filters(params):
+    filters = {}
+    for name, choices in FILTERS.items():
+        value = (params.get(name) or '').strip()
+        if value and (choices is None or value in choices):
+            filters[name] = value
+    return filters
+
+
+def version_cache():
+    # Pages may sit in a per-process cache, but the version has to be seen
+    # by every worker or a Profile save only invalidates its own process
+    return caches[getattr(settings, 'MENTOR_DIRECTORY_VERSION_CACHE', 'default')]
+
+
+def get_version():
+    return version_cache().get_or_set(VERSION_KEY, secrets.token_hex(8), None)
+
+
+def invalidate():
+    # A new version orphans every cached page at once; they expire on their
+    # own. A fresh random value rather than incr(), which is a read and a
+    # write on most shared backends and can lose a concurrent bump.
+    version_cache().set(VERSION_KEY, secrets.token_hex(8), None)
+
+
+def card(profile):
+    # Plain values only, so pages cache cheaply and render without queries
+    return {
+        'user_id': profile.user_id,
+        'username': profile.user.username,
+        'name': profile.displayname or profile.user.username,
+        'info': profile.info,
+        'avatar': derivative_url(profile.image, 'avatar_md') if profile.image else static('images/avatar.svg'),
+    }
+
+
+def mentor_page(filters, cursor=None):
+    # One page of mentor cards and the cursor for the next one. Paging is by
+    # id, so every page is an index range scan on (user_type, <filter>, id)
+    # and costs the same at any depth.
+    page_size = getattr(settings, 'MENTOR_DIRECTORY_PAGE_SIZE', 24)
+    try:
+        after = int(cursor) if cursor else 0
+    except ValueError:
+        after = 0
+
+    key = 'mentor-directory:{}:{}'.format(
+        get_version(),
+        hashlib.sha1(repr((sorted(filters.items()), after)).encode()).hexdigest(),
+    )
+    page = cache.get(key)
+    if page is None:
+        mentors = (
+            Profile.objects.filter(user_type='MENTOR', id__gt=after, **filters)
+            .select_related('user')
+            .only('id', 'user_id', 'displayname', 'info', 'image', 'user__username')
+            .order_by('id')[:page_size + 1]
+        )
+        mentors = list(mentors)
+        next_cursor = mentors[page_size - 1].id if len(mentors) > page_size else None
+        page = ([card(mentor) for mentor in mentors[:page_size]], next_cursor)
+        cache.set(key, page, getattr(settings, 'MENTOR_DIRECTORY_CACHE_TIMEOUT', 300))
+    return page
+
+
+def organizations():
+    key = f'mentor-directory:{get_version()}:organizations'
+    values = cache.get(key)
+    if values is None:
+        values = list(
+            Profile.objects.filter(user_type='MENTOR').exclude(organization__isnull=True).exclude(organization='')
+            .order_by('organization').values_list('organization', flat=True).distinct()
+        )
+        cache.set(key, values, getattr(settings, 'MENTOR_DIRECTORY_CACHE_TIMEOUT', 300))
+    return values
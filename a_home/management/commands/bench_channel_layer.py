@@ -0,0 +1,158 @@
+import asyncio
+import json
+import multiprocessing
+import shutil
+import statistics
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from a_core.layers import UnixSocketChannelLayer
+
+GROUP = 'bench'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def receive_all(layer, sockets, expected, timeout, ready=None):
+    # `sockets` channels in GROUP, each reading `expected` messages; returns
+    # send-to-receive latencies in seconds
+    channels = [await layer.new_channel() for _ in range(sockets)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    if ready is not None:
+        ready.set()
+    latencies = []
+
+    async def reader(channel):
+        for _ in range(expected):
+            message = await layer.receive(channel)
+            latencies.append(time.time() - message['sent'])
+
+    tasks = [asyncio.ensure_future(reader(channel)) for channel in channels]
+    await asyncio.wait(tasks, timeout=timeout)
+    for task in tasks:
+        task.cancel()
+    return latencies
+
+
+def worker(path, sockets, expected, timeout, ready, results):
+    layer = UnixSocketChannelLayer(path=path, capacity=expected + 10)
+    latencies = asyncio.run(receive_all(layer, sockets, expected, timeout, ready))
+    results.put(latencies)
+
+
+async def send_all(layer, messages, rate, payload):
+    started = time.perf_counter()
+    for i in range(messages):
+        await layer.group_send(GROUP, {'type': 'bench', 'sent': time.time(), 'payload': payload})
+        if rate:
+            delay = started + (i + 1) / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif i % 50 == 0:
+            await asyncio.sleep(0)
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Benchmark group_send fan-out: InMemoryChannelLayer in one process vs UnixSocketChannelLayer across processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+        parser.add_argument('--sockets', type=int, default=50, help='Receiving channels per process')
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--rate', type=float, default=0, help='Messages per second, 0 for as fast as possible')
+        parser.add_argument('--size', type=int, default=512, help='Payload bytes per message')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds receivers wait for their messages')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def handle(self, *args, **options):
+        payload = 'x' * options['size']
+        results = [self.bench_inmemory(options, payload), self.bench_unix(options, payload)]
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                '{backend:<10} processes={processes:<3} receivers={receivers:<6} '
+                'sent/s={send_rate:>9.0f} delivered={delivered}/{expected} '
+                'deliveries/s={delivery_rate:>9.0f} p50={p50_ms:.2f}ms p99={p99_ms:.2f}ms'.format(**result)
+            )
+
+    def summary(self, backend, processes, receivers, options, elapsed, latencies, total):
+        return {
+            'backend': backend,
+            'processes': processes,
+            'receivers': receivers,
+            'messages': options['messages'],
+            'expected': receivers * options['messages'],
+            'delivered': len(latencies),
+            'send_rate': options['messages'] / elapsed,
+            'delivery_rate': len(latencies) / total,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_ms': (statistics.fmean(latencies) * 1000) if latencies else 0.0,
+        }
+
+    def bench_inmemory(self, options, payload):
+        # One process is all the in-memory layer can serve, so it gets the
+        # same total number of receivers
+        receivers = options['sockets'] * options['processes']
+        layer = InMemoryChannelLayer(capacity=options['messages'] + 10)
+
+        async def run():
+            receiving = asyncio.ensure_future(receive_all(layer, receivers, options['messages'], options['timeout']))
+            await asyncio.sleep(0.1)
+            started = time.perf_counter()
+            elapsed = await send_all(layer, options['messages'], options['rate'], payload)
+            latencies = await receiving
+            return elapsed, latencies, time.perf_counter() - started
+
+        elapsed, latencies, total = asyncio.run(run())
+        return self.summary('inmemory', 1, receivers, options, elapsed, latencies, total)
+
+    def bench_unix(self, options, payload):
+        path = tempfile.mkdtemp(prefix='bench-channels-')
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        workers = []
+        try:
+            for _ in range(options['processes']):
+                ready = context.Event()
+                process = context.Process(
+                    target=worker, args=(path, options['sockets'], options['messages'], options['timeout'], ready, results)
+                )
+                process.start()
+                ready.wait(30)
+                workers.append(process)
+
+            layer = UnixSocketChannelLayer(path=path)
+
+            async def run():
+                elapsed = await send_all(layer, options['messages'], options['rate'], payload)
+                # Sends what the receivers have not taken yet
+                await layer.close()
+                return elapsed
+
+            started = time.perf_counter()
+            elapsed = asyncio.run(run())
+            latencies = []
+            for _ in workers:
+                latencies += results.get(timeout=options['timeout'] + 30)
+            total = time.perf_counter() - started
+        finally:
+            for process in workers:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+            shutil.rmtree(path, ignore_errors=True)
+        receivers = options['sockets'] * options['processes']
+        return self.summary('unix', options['processes'], receivers, options, elapsed, latencies, total)
@@ -0,0 +1,70 @@
+import os
+import tempfile
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from a_core.storage import BLOB_DIR, collect_garbage, file_digest, link_or_copy
+
+# Media subdirectories that hold no stored names: the blobs themselves and
+# in-progress chunked uploads
+SKIP_DIRS = (BLOB_DIR, 'uploads')
+
+
+class Command(BaseCommand):
+    help = 'Move media saved before content-addressed storage into blobs, hard-linking duplicates, and remove unreferenced blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be linked and removed without changing anything')
+
+    def handle(self, *args, **options):
+        storage = default_storage
+        if not hasattr(storage, 'blob_path'):
+            self.stderr.write('The default storage is not a_core.storage.ContentAddressedStorage')
+            return
+        dry_run = options['dry_run']
+        location = storage.location
+        adopted = linked = saved = 0
+        seen = {}
+
+        for directory, dirs, files in os.walk(location):
+            if directory == location:
+                dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+            for filename in files:
+                path = os.path.join(directory, filename)
+                stat = os.lstat(path)
+                # Links to a blob already have a link count of two or more
+                if not os.path.isfile(path) or os.path.islink(path) or stat.st_nlink > 1:
+                    continue
+                digest = file_digest(path)
+                blob = storage.blob_path(digest)
+                if os.path.exists(blob) or digest in seen:
+                    linked += 1
+                    saved += stat.st_size
+                else:
+                    adopted += 1
+                seen[digest] = True
+                if dry_run:
+                    continue
+                if not os.path.exists(blob):
+                    # The first copy of this content becomes the blob
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    link_or_copy(path, blob)
+                    continue
+                # Swap the file for a link to the blob in one step, so the
+                # name never goes missing
+                fd, tmp = tempfile.mkstemp(dir=directory)
+                os.close(fd)
+                os.remove(tmp)
+                try:
+                    link_or_copy(blob, tmp)
+                    os.replace(tmp, path)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+
+        removed, freed = (0, 0) if dry_run else collect_garbage(location)
+        prefix = 'Dry run: ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}adopted {adopted} files, linked {linked} duplicates ({saved} bytes), '
+            f'removed {removed} unreferenced blobs ({freed} bytes)'))
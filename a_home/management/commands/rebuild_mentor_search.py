@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from a_home import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the mentor full-text search index, re-extracting resume text'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-resumes', action='store_true', help='Index profile fields only')
+
+    def handle(self, *args, **options):
+        if not search.index.supported:
+            self.stderr.write('Mentor search needs an SQLite database with FTS5')
+            return
+        count = search.rebuild(extract=not options['skip_resumes'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} mentors'))
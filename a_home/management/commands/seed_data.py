@@ -0,0 +1,229 @@
+import random
+import time
+from datetime import date, datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+import shortuuid
+from allauth.account.models import EmailAddress
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from a_home import directory
+from a_rtchat.models import ChatGroup, GroupMessage
+from a_users.constants import EXPERTISE_CHOICES, WORKING_STATUS_CHOICES
+from a_users.models import Profile
+
+EMAIL_DOMAIN = 'seed.example.com'
+# Generated timestamps run up to midnight (UTC) of this day, so a seed gives
+# the same data on any day it is run
+END_DATE = date(2025, 1, 1)
+
+PRESETS = {
+    'small': {'users': 500, 'groups': 20, 'private_chats': 300, 'messages': 50_000},
+    'medium': {'users': 10_000, 'groups': 200, 'private_chats': 5_000, 'messages': 1_000_000},
+    'large': {'users': 50_000, 'groups': 1_000, 'private_chats': 25_000, 'messages': 5_000_000},
+}
+
+FIRST_NAMES = [
+    'Aarav', 'Priya', 'Rohan', 'Ananya', 'Vikram', 'Sneha', 'Arjun', 'Kavya', 'Rahul', 'Isha',
+    'James', 'Maria', 'Chen', 'Fatima', 'Lucas', 'Amara', 'Noah', 'Sofia', 'Omar', 'Yuki',
+]
+LAST_NAMES = [
+    'Sharma', 'Patel', 'Iyer', 'Gupta', 'Reddy', 'Khan', 'Singh', 'Das', 'Nair', 'Mehta',
+    'Smith', 'Garcia', 'Wang', 'Okafor', 'Silva', 'Kim', 'Müller', 'Rossi', 'Haddad', 'Tanaka',
+]
+ORGANIZATIONS = [
+    'Google', 'Microsoft', 'Amazon', 'Infosys', 'TCS', 'Flipkart', 'Zoho', 'Atlassian',
+    'Razorpay', 'Swiggy', 'Freshworks', 'Adobe', 'Intuit', 'Stripe', 'Shopify',
+]
+DESIGNATIONS = [
+    'Software Engineer', 'Senior Software Engineer', 'Staff Engineer', 'Engineering Manager',
+    'Data Scientist', 'ML Engineer', 'Product Designer', 'Security Analyst', 'Cloud Architect',
+    'Mobile Developer', 'Frontend Developer', 'Backend Developer',
+]
+TOPICS = [
+    'python', 'django', 'react', 'kubernetes', 'aws', 'system design', 'interviews', 'resume',
+    'machine learning', 'sql', 'career growth', 'open source', 'android', 'security', 'figma',
+]
+WORDS = (
+    'hey thanks sure can we talk about the project tomorrow I think this approach works better '
+    'let me check the docs and get back to you sounds good what about deployment did you try '
+    'running the tests again great idea please share the link meeting at five works for me'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Bulk-generate users, profiles, chat rooms, memberships and messages for scale testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--preset', choices=PRESETS, default='small')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--users', type=int)
+        parser.add_argument('--groups', type=int)
+        parser.add_argument('--private-chats', type=int)
+        parser.add_argument('--messages', type=int)
+        parser.add_argument('--mentor-ratio', type=float, default=0.3)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--end', type=date.fromisoformat, default=END_DATE,
+                            help=f'Day the generated history ends, YYYY-MM-DD (default {END_DATE})')
+        parser.add_argument('--skip-search-index', action='store_true',
+                            help='Do not rebuild the mentor and message search indexes')
+
+    def handle(self, *args, **options):
+        sizes = dict(PRESETS[options['preset']])
+        for name in sizes:
+            if options[name] is not None:
+                sizes[name] = options[name]
+        if User.objects.filter(email__endswith='@' + EMAIL_DOMAIN).exists():
+            raise CommandError('Seed data is already present; run against a fresh database')
+
+        self.seed = options['seed']
+        self.rng = random.Random(self.seed)
+        self.batch_size = options['batch_size']
+        self.end = datetime.combine(options['end'], dt_time(), dt_timezone.utc)
+        started = time.monotonic()
+
+        user_ids = self.step('users', self.create_users, sizes['users'], options['mentor_ratio'])
+        groups = self.step('rooms', self.create_rooms, user_ids, sizes['groups'], sizes['private_chats'])
+        self.step('messages', self.create_messages, groups, user_ids, sizes['messages'])
+        if not options['skip_search_index']:
+            output = {'stdout': self.stdout, 'stderr': self.stderr}
+            self.step('mentor search index', call_command, 'rebuild_mentor_search', skip_resumes=True, **output)
+            self.step('message search index', call_command, 'rebuild_message_search', **output)
+        directory.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Seeded {sizes} in {time.monotonic() - started:.0f}s'))
+
+    def step(self, label, function, *args, **kwargs):
+        started = time.monotonic()
+        result = function(*args, **kwargs)
+        self.stdout.write(f'{label}: {time.monotonic() - started:.1f}s')
+        return result
+
+    def bulk(self, model, objects, **kwargs):
+        # bulk_create skips save() and signals, so everything the signals
+        # would have created (profiles, search rows) is created explicitly.
+        # Primary keys are set on the objects (SQLite 3.35+, PostgreSQL).
+        with transaction.atomic():
+            return model.objects.bulk_create(objects, batch_size=self.batch_size, **kwargs)
+
+    def create_users(self, count, mentor_ratio):
+        rng = self.rng
+        password = make_password('password')
+        users = []
+        for i in range(count):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            username = f'{first}.{last}{i + 1}'.lower()
+            users.append(User(
+                username=username, email=f'{username}@{EMAIL_DOMAIN}', password=password,
+                first_name=first, last_name=last,
+                date_joined=self.end - timedelta(days=rng.randint(30, 730)),
+            ))
+        self.bulk(User, users)
+        self.bulk(EmailAddress, [
+            EmailAddress(user_id=user.pk, email=user.email, verified=True, primary=True) for user in users
+        ])
+
+        expertise = [value for value, _ in EXPERTISE_CHOICES]
+        working_status = [value for value, _ in WORKING_STATUS_CHOICES]
+        profiles = []
+        for user in users:
+            mentor = rng.random() < mentor_ratio
+            topics = ', '.join(rng.sample(TOPICS, 3))
+            profile = Profile(
+                user_id=user.pk,
+                displayname=f'{user.first_name} {user.last_name}'[:20],
+                user_type='MENTOR' if mentor else 'MENTEE',
+                terms_accepted=True,
+                info=f'Happy to help with {topics}.' if mentor else f'Learning {topics}.',
+            )
+            if mentor:
+                profile.organization = rng.choice(ORGANIZATIONS)
+                profile.designation = rng.choice(DESIGNATIONS)
+                profile.working_status = rng.choice(working_status)
+                profile.expertise = rng.choice(expertise)
+            profiles.append(profile)
+        self.bulk(Profile, profiles)
+        return [user.pk for user in users]
+
+    def create_rooms(self, user_ids, group_count, private_count):
+        # Returns [(group_id, [member ids]), ...]; the public chat has no
+        # members, anyone may post in it
+        rng = self.rng
+        public, _ = ChatGroup.objects.get_or_create(group_name='public-chat')
+        rooms = [ChatGroup(groupchat_name=f'{rng.choice(TOPICS).title()} Circle {i + 1}', admin_id=rng.choice(user_ids))
+                 for i in range(group_count)]
+        pairs = set()
+        while len(pairs) < min(private_count, len(user_ids) * (len(user_ids) - 1) // 2):
+            low, high = sorted(rng.sample(user_ids, 2))
+            pairs.add((low, high))
+        pairs = sorted(pairs)
+        rooms += [ChatGroup(is_private=True, private_key=f'{low}:{high}') for low, high in pairs]
+        for i, room in enumerate(rooms):
+            # Name-based, so the same seed gives the same room URLs
+            room.group_name = shortuuid.uuid(name=f'seed-{self.seed}-room-{i}')
+        self.bulk(ChatGroup, rooms)
+
+        memberships = []
+        groups = [(public.id, [])]
+        for room in rooms[:group_count]:
+            members = rng.sample(user_ids, min(len(user_ids), rng.randint(5, 200)))
+            if room.admin_id not in members:
+                members.append(room.admin_id)
+            groups.append((room.pk, members))
+        for room, (low, high) in zip(rooms[group_count:], pairs):
+            groups.append((room.pk, [low, high]))
+        Through = ChatGroup.members.through
+        for group_id, members in groups:
+            memberships += [Through(chatgroup_id=group_id, user_id=user_id) for user_id in members]
+        self.bulk(Through, memberships)
+        return groups
+
+    def create_messages(self, groups, user_ids, count):
+        # Activity is skewed like real chat: the public room and a few busy
+        # groups get most of the traffic, most private chats only a little
+        rng = self.rng
+        weights = [50] + [rng.paretovariate(1.2) for _ in groups[1:]]
+        per_group = [0] * len(groups)
+        for index in rng.choices(range(len(groups)), weights=weights, k=count):
+            per_group[index] += 1
+
+        span = 365 * 24 * 3600
+        start = self.end - timedelta(seconds=span)
+        batch = []
+        written = 0
+        for (group_id, members), total in zip(groups, per_group):
+            if not total:
+                continue
+            authors = members or user_ids
+            offsets = sorted(rng.random() * span for _ in range(total))
+            for offset in offsets:
+                batch.append((
+                    group_id,
+                    rng.choice(authors),
+                    ' '.join(rng.choices(WORDS, k=rng.randint(3, 20))),
+                    start + timedelta(seconds=offset),
+                ))
+                if len(batch) >= self.batch_size * 10:
+                    written += self.insert_messages(batch)
+                    batch = []
+                    self.stdout.write(f'  {written}/{count} messages', ending='\r')
+        if batch:
+            written += self.insert_messages(batch)
+        self.stdout.write(f'  {written}/{count} messages')
+
+    def insert_messages(self, rows):
+        # Plain text messages are the bulk of the data; inserting them as
+        # rows rather than model instances is several times faster
+        meta = GroupMessage._meta
+        columns = [meta.get_field(name).column for name in ('group', 'author', 'body', 'created', 'file_is_image')]
+        adapt = connection.ops.adapt_datetimefield_value
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(meta.db_table),
+            ', '.join(connection.ops.quote_name(column) for column in columns),
+            ', '.join(['%s'] * len(columns)),
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, [(group_id, author_id, body, adapt(created), False) for group_id, author_id, body, created in rows])
+        return len(rows)
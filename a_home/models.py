@@ -1,3 +1,25 @@
 from django.db import models
+from django.contrib.auth.models import User
 
 # Create your models here.
+class ProfilerRun(models.Model):
+    # One profiled request or consumer event (see a_home.profiling). The
+    # pstats data stays in the database rather than MEDIA_ROOT, so it is
+    # only reachable through the admin.
+    KIND_CHOICES = [
+        ('http', 'HTTP request'),
+        ('websocket', 'Websocket event'),
+    ]
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    target = models.CharField(max_length=255)
+    user = models.ForeignKey(User, related_name='profiler_runs', blank=True, null=True, on_delete=models.SET_NULL)
+    duration_ms = models.FloatField()
+    summary = models.TextField()
+    stats = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return f'{self.kind} {self.target} ({self.duration_ms:.0f} ms)'
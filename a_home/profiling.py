@@ -0,0 +1,119 @@
+import cProfile
+import functools
+import io
+import logging
+import marshal
+import pstats
+import random
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Staff turn profiling on for one request with ?_profile=1 or this header
+QUERY_PARAM = '_profile'
+HEADER = 'X-Profile'
+SUMMARY_LINES = 40
+
+
+def sampled(rate):
+    return rate > 0 and random.random() < rate
+
+
+def start():
+    # Returns None when the profiler cannot run here, e.g. because another
+    # profile is active in this interpreter (Python 3.12+ allows only one)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+
+def save(profiler, kind, target, user, duration):
+    from .models import ProfilerRun
+
+    profiler.create_stats()
+    # The format pstats.Stats() and snakeviz load from a .prof file; taken
+    # first, because building a Stats from the profiler empties it
+    stats = marshal.dumps(profiler.stats)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(SUMMARY_LINES)
+    return ProfilerRun.objects.create(
+        kind=kind,
+        target=target[:255],
+        user=user if user is not None and user.is_authenticated else None,
+        duration_ms=duration * 1000,
+        summary=summary.getvalue(),
+        stats=stats,
+    )
+
+
+def requested(request):
+    # The flag is checked first so other requests never load the user here
+    if request.GET.get(QUERY_PARAM) != '1' and request.headers.get(HEADER) != '1':
+        return False
+    return request.user.is_staff
+
+
+class ProfilerMiddleware:
+    # Runs a request under cProfile when a staff user asks for it, or for a
+    # PROFILER_SAMPLE_RATE fraction of all requests, and stores the result
+    # as a ProfilerRun (downloadable from the admin). Asked-for runs return
+    # their id in the X-Profile-Id header. Sync only, so the view runs on the
+    # thread being profiled.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        asked = requested(request)
+        if not asked and not sampled(getattr(settings, 'PROFILER_SAMPLE_RATE', 0)):
+            return self.get_response(request)
+        profiler = start()
+        if profiler is None:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        duration = time.perf_counter() - started
+        try:
+            run = save(profiler, 'http', f'{request.method} {request.get_full_path()}', request.user, duration)
+        except Exception:
+            logger.exception('Could not store the profile of %s', request.path)
+            return response
+        if asked:
+            response['X-Profile-Id'] = str(run.pk)
+        return response
+
+
+def profiled(event):
+    # For sync consumer methods, or the sync functions async consumers run
+    # through database_sync_to_async: profiles a
+    # PROFILER_WEBSOCKET_SAMPLE_RATE fraction of calls
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(consumer, *args, **kwargs):
+            if not sampled(getattr(settings, 'PROFILER_WEBSOCKET_SAMPLE_RATE', 0)):
+                return method(consumer, *args, **kwargs)
+            profiler = start()
+            if profiler is None:
+                return method(consumer, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return method(consumer, *args, **kwargs)
+            finally:
+                profiler.disable()
+                duration = time.perf_counter() - started
+                target = f"{getattr(consumer, 'chatroom_name', '')} {event}".strip()
+                try:
+                    save(profiler, 'websocket', target, getattr(consumer, 'user', None), duration)
+                except Exception:
+                    logger.exception('Could not store the profile of %s', target)
+        return wrapper
+    return decorator
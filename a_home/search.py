@@ -0,0 +1,158 @@
+import io
+import logging
+import queue
+import re
+import threading
+import zipfile
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from a_core.fts import FTSIndex, match_query
+from a_users.models import Profile
+from .directory import card
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+# Resume text is kept next to the name of the file it came from, so a profile
+# save only re-extracts when a new resume was uploaded
+index = FTSIndex(
+    'a_home_mentor_search',
+    columns=('name', 'organization', 'designation', 'info', 'resume'),
+    unindexed=('resume_name',),
+    weights={'name': 10, 'organization': 5, 'designation': 5, 'info': 2, 'resume': 1},
+)
+
+MAX_RESUME_CHARS = 100_000
+
+
+def profile_values(profile):
+    return {
+        'name': ' '.join(filter(None, [profile.displayname, profile.user.username])),
+        'organization': profile.organization,
+        'designation': profile.designation,
+        'info': profile.info,
+    }
+
+
+def index_profile(profile):
+    # Returns True when the resume still needs to be (re-)extracted
+    if profile.user_type != 'MENTOR':
+        index.delete(profile.id)
+        return False
+    resume_name = profile.resume.name or ''
+    current = index.get(profile.id, 'resume', 'resume_name')
+    if current and current['resume_name'] == resume_name:
+        resume = current['resume']
+    else:
+        resume, current = '', None
+    index.replace(profile.id, resume=resume, resume_name=resume_name if current else '', **profile_values(profile))
+    return bool(resume_name) and not current
+
+
+def extract_text(fieldfile):
+    name = fieldfile.name.lower()
+    with fieldfile.open('rb') as f:
+        data = f.read()
+    if name.endswith('.docx'):
+        with zipfile.ZipFile(io.BytesIO(data)) as docx:
+            xml = docx.read('word/document.xml').decode('utf-8', 'ignore')
+        xml = re.sub(r'</w:p>|<w:br/>|<w:tab/>', '\n', xml)
+        text = re.sub(r'<[^>]+>', '', xml)
+    elif name.endswith('.pdf'):
+        if PdfReader is None:
+            logger.warning('pypdf is not installed, skipping %s', fieldfile.name)
+            return ''
+        reader = PdfReader(io.BytesIO(data))
+        text = '\n'.join(page.extract_text() or '' for page in reader.pages)
+    elif name.endswith('.txt'):
+        text = data.decode('utf-8', 'ignore')
+    else:
+        return ''
+    return ' '.join(text.split())[:MAX_RESUME_CHARS]
+
+
+def extract_resume(profile_id):
+    profile = Profile.objects.filter(id=profile_id, user_type='MENTOR').only('id', 'resume').first()
+    if profile is None or not profile.resume:
+        return
+    try:
+        text = extract_text(profile.resume)
+    except Exception:
+        logger.exception('Could not extract text from %s', profile.resume.name)
+        text = ''
+    index.update(profile.id, resume=text, resume_name=profile.resume.name)
+
+
+class ResumeExtractor:
+    # A single background thread, so resume parsing never runs in a request
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, profile_id):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='mentor-search-resumes', daemon=True)
+                self.thread.start()
+        self.queue.put(profile_id)
+
+    def _run(self):
+        while True:
+            profile_id = self.queue.get()
+            close_old_connections()
+            try:
+                extract_resume(profile_id)
+            except Exception:
+                logger.exception('Resume extraction failed for profile %s', profile_id)
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+
+extractor = ResumeExtractor()
+
+
+def profile_saved(profile):
+    if index_profile(profile):
+        transaction.on_commit(lambda: extractor.submit(profile.id))
+
+
+def search_mentors(query, page=1):
+    # One page of mentor cards ranked by relevance, and the next page number
+    page_size = getattr(settings, 'MENTOR_DIRECTORY_PAGE_SIZE', 24)
+    ids = index.search(match_query(query), limit=page_size + 1, offset=(page - 1) * page_size)
+    next_page = page + 1 if len(ids) > page_size else None
+    ids = ids[:page_size]
+    profiles = Profile.objects.filter(id__in=ids, user_type='MENTOR').select_related('user').only(
+        'id', 'user_id', 'displayname', 'info', 'image', 'user__username'
+    )
+    by_id = {profile.id: profile for profile in profiles}
+    return [card(by_id[i]) for i in ids if i in by_id], next_page
+
+
+def rebuild(extract=True, batch_size=500):
+    mentors = Profile.objects.filter(user_type='MENTOR').select_related('user').order_by('id')
+    count = 0
+    batch = []
+    with transaction.atomic():
+        index.clear()
+        for profile in mentors.iterator(chunk_size=batch_size):
+            batch.append((profile.id, profile_values(profile)))
+            if len(batch) >= batch_size:
+                index.replace_many(batch)
+                count += len(batch)
+                batch = []
+        index.replace_many(batch)
+        count += len(batch)
+    if extract:
+        for profile_id in mentors.exclude(resume='').exclude(resume__isnull=True).values_list('id', flat=True):
+            extract_resume(profile_id)
+    return count
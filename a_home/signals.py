@@ -0,0 +1,31 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django_cleanup.signals import cleanup_post_delete
+from a_users.models import Profile
+from . import directory, search
+from .derivatives import delete_derivatives
+
+
+# Drop cached thumbnails together with the upload they were made from
+@receiver(cleanup_post_delete)
+def cleanup_derivatives(sender, file_name, **kwargs):
+    if file_name:
+        delete_derivatives(file_name)
+
+
+# Any profile change can move a mentor into, out of or around the directory
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_mentor_directory(sender, **kwargs):
+    directory.invalidate()
+
+
+# Keep the mentor search index in step with every profile write
+@receiver(post_save, sender=Profile)
+def index_mentor(sender, instance, **kwargs):
+    search.profile_saved(instance)
+
+
+@receiver(post_delete, sender=Profile)
+def unindex_mentor(sender, instance, **kwargs):
+    search.index.delete(instance.id)
@@ -0,0 +1,19 @@
+from django import template
+from django.templatetags.static import static
+from a_home.derivatives import derivative_url
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail(fieldfile, size='chat'):
+    # {{ message.file|thumbnail:'chat' }}
+    return derivative_url(fieldfile, size)
+
+
+@register.filter
+def avatar(profile, size='avatar_sm'):
+    # {{ user.profile|avatar:'avatar_md' }}; same fallback as Profile.avatar
+    if profile and profile.image:
+        return derivative_url(profile.image, size)
+    return static('images/avatar.svg')
@@ -1,3 +1,556 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import pstats
+import shutil
+import socket
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from channels.exceptions import ChannelFull
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from a_core.layers import HEADER, UnixSocketChannelLayer
+from a_core import metrics
+from a_core.media import StaticFiles
+from a_core.middleware import db_queries, request_seconds, requests_total, response_bytes, template_seconds
+from a_core.storage import BLOB_DIR, ContentAddressedStorage, collect_garbage
+from a_users.models import Profile
+from PIL import Image
+from . import derivatives, directory
+from .models import ProfilerRun
+from .profiling import profiled
+from .search import extract_resume, search_mentors
+from .templatetags.media_tags import avatar, thumbnail
+
+
+def frame(data):
+    return len(data).to_bytes(HEADER, 'big') + data
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    # Two layers on one path stand in for two worker processes
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='channels-test-')
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+
+    def layer(self, **kwargs):
+        return UnixSocketChannelLayer(path=self.path, capacity=2000, **kwargs)
+
+    async def test_group_send_delivers_everything_in_order(self):
+        sender, worker = self.layer(), self.layer()
+        channels = [await worker.new_channel() for _ in range(3)]
+        for channel in channels:
+            await worker.group_add('room', channel)
+        # Well past what the old datagram queue held before dropping
+        for i in range(1000):
+            await sender.group_send('room', {'type': 'chat', 'i': i, 'text': 'x' * 512})
+        for channel in channels:
+            self.assertEqual([(await worker.receive(channel))['i'] for _ in range(1000)], list(range(1000)))
+        await sender.close()
+        await worker.close()
+
+    async def test_send_goes_to_the_owning_process(self):
+        sender, worker = self.layer(), self.layer()
+        channel = await worker.new_channel()
+        await sender.send(channel, {'type': 'heartbeat_expired'})
+        self.assertEqual(await worker.receive(channel), {'type': 'heartbeat_expired'})
+        await sender.close()
+        await worker.close()
+
+    async def test_malformed_messages_are_skipped(self):
+        worker = self.layer()
+        channel = await worker.new_channel()
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(worker.address)
+        good = {'op': 'send', 'channel': channel, 'message': {'type': 'ok'}}
+        for data in (b'not json', b'[1]', b'{"op": "send"}', b'{"op": "unknown"}', json.dumps(good).encode()):
+            client.sendall(frame(data))
+        client.close()
+        with self.assertLogs('a_core.layers', 'WARNING') as logs:
+            self.assertEqual(await worker.receive(channel), {'type': 'ok'})
+        self.assertEqual(len(logs.output), 4)
+        await worker.close()
+
+    async def test_peer_that_stops_reading_gets_channel_full(self):
+        # A listener that never accepts: the kernel buffers fill, then ours
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stuck.bind(f'{self.path}/stuck.sock')
+        stuck.listen(1)
+        self.addCleanup(stuck.close)
+        sender = self.layer(write_buffer=64 * 1024, write_timeout=0.1)
+        with self.assertLogs('a_core.layers', 'WARNING'), self.assertRaises(ChannelFull):
+            for _ in range(10_000):
+                await sender.send('specific.stuck!abc', {'type': 'chat', 'text': 'x' * 64 * 1024})
+        self.assertEqual(sender._outbound, {})
+        await sender.close()
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='cas-test-')
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        self.storage = ContentAddressedStorage(location=self.location, base_url='/media/', gc_delay=3600)
+
+    def tearDown(self):
+        # Deletes schedule a background sweep; the tests sweep themselves
+        if self.storage.collector.timer is not None:
+            self.storage.collector.timer.cancel()
+
+    def blobs(self):
+        return [name for _, _, files in os.walk(os.path.join(self.location, BLOB_DIR)) for name in files]
+
+    def test_same_content_is_stored_once(self):
+        first = self.storage.save('files/a.pdf', ContentFile(b'same bytes'))
+        second = self.storage.save('files/b.pdf', ContentFile(b'same bytes'))
+        other = self.storage.save('files/c.pdf', ContentFile(b'other bytes'))
+        self.assertEqual(os.stat(self.storage.path(first)).st_ino, os.stat(self.storage.path(second)).st_ino)
+        self.assertEqual(self.storage.references(first), 2)
+        self.assertEqual(self.storage.references(other), 1)
+        self.assertEqual(len(self.blobs()), 2)
+        # A taken name still gets a name of its own
+        third = self.storage.save('files/a.pdf', ContentFile(b'same bytes'))
+        self.assertNotEqual(third, first)
+        self.assertEqual(self.storage.references(first), 3)
+
+    def test_url_changes_with_the_content(self):
+        name = self.storage.save('avatars/me.png', ContentFile(b'old'))
+        old_url = self.storage.url(name)
+        self.assertRegex(old_url, r'^/media/avatars/me\.png\?v=[0-9a-f]{16}$')
+        self.storage.delete(name)
+        self.storage.save(name, ContentFile(b'new'))
+        self.assertNotEqual(self.storage.url(name), old_url)
+
+    def test_blob_is_collected_after_its_last_name_goes(self):
+        first = self.storage.save('files/a.pdf', ContentFile(b'shared'))
+        second = self.storage.save('files/b.pdf', ContentFile(b'shared'))
+        self.storage.delete(first)
+        self.assertEqual(collect_garbage(self.location), (0, 0))
+        self.storage.delete(second)
+        self.assertEqual(collect_garbage(self.location), (1, len(b'shared')))
+        self.assertEqual(self.blobs(), [])
+
+    def test_dedupe_media_links_files_saved_before(self):
+        for name in ('files/a.pdf', 'files/b.pdf', 'resumes/c.pdf'):
+            os.makedirs(os.path.join(self.location, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.location, name), 'wb') as f:
+                f.write(b'uploaded twice' if name.startswith('files/') else b'once')
+        with override_settings(MEDIA_ROOT=self.location):
+            out = io.StringIO()
+            call_command('dedupe_media', stdout=out)
+            paths = [default_storage.path(name) for name in ('files/a.pdf', 'files/b.pdf')]
+        self.assertIn('adopted 2 files, linked 1 duplicates (14 bytes)', out.getvalue())
+        self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+        self.assertEqual(os.stat(paths[0]).st_nlink, 3)
+        self.assertEqual(len(self.blobs()), 2)
+
+
+async def not_found(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 418, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+class StaticFilesTests(SimpleTestCase):
+    script = b'function hello() { return "hello"; }\n' * 100
+
+    def setUp(self):
+        source, root = tempfile.mkdtemp(prefix='static-src-'), tempfile.mkdtemp(prefix='static-root-')
+        for directory in (source, root):
+            self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        with open(os.path.join(source, 'app.js'), 'wb') as f:
+            f.write(self.script)
+        with open(os.path.join(source, 'noise.txt'), 'wb') as f:
+            f.write(os.urandom(2048))
+        settings_override = override_settings(
+            STATIC_ROOT=root, STATICFILES_DIRS=[source],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.hashed = staticfiles_storage.stored_name('app.js')
+        self.root = root
+        self.app = StaticFiles(not_found)
+
+    async def get(self, path, accept_encoding=None):
+        headers = [(b'accept-encoding', accept_encoding.encode())] if accept_encoding else []
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': headers}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+        return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_collectstatic_gzips_only_what_shrinks(self):
+        self.assertNotEqual(self.hashed, 'app.js')
+        with gzip.open(os.path.join(self.root, self.hashed + '.gz')) as f:
+            self.assertEqual(f.read(), self.script)
+        self.assertFalse(any(name.startswith('noise') and name.endswith('.gz') for name in os.listdir(self.root)))
+
+    async def test_gzip_goes_to_clients_that_accept_it(self):
+        path = '/static/' + self.hashed
+        status, headers, body = await self.get(path, 'br, gzip;q=0.8')
+        self.assertEqual((status, headers['content-encoding'], headers['vary']), (200, 'gzip', 'Accept-Encoding'))
+        self.assertEqual(gzip.decompress(body), self.script)
+        self.assertIn('immutable', headers['cache-control'])
+        for accept_encoding in (None, 'br', 'gzip;q=0'):
+            status, headers, body = await self.get(path, accept_encoding)
+            self.assertNotIn('content-encoding', headers)
+            self.assertEqual((headers['vary'], body), ('Accept-Encoding', self.script))
+
+    async def test_unhashed_and_missing_names(self):
+        _, headers, _ = await self.get('/static/app.js')
+        self.assertNotIn('immutable', headers['cache-control'])
+        # Left to Django, which finds files that were never collected
+        self.assertEqual((await self.get('/static/other.css'))[0], 418)
+        self.assertEqual((await self.get('/static/../settings.py'))[0], 404)
+
+
+class MentorSearchTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='search-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def mentor(self, username, **fields):
+        profile = User.objects.create_user(username).profile
+        for name, value in dict(user_type='MENTOR', **fields).items():
+            setattr(profile, name, value)
+        profile.save()
+        return profile
+
+    def usernames(self, query):
+        return [card['username'] for card in search_mentors(query)[0]]
+
+    def test_ranks_name_matches_above_bio_matches(self):
+        self.mentor('bio', info='I used to work with Priya on payments')
+        self.mentor('priya', displayname='Priya', organization='Razorpay')
+        self.assertEqual(self.usernames('priya'), ['priya', 'bio'])
+        # Prefixes match, and query syntax in the input is taken as words
+        self.assertEqual(self.usernames('razor'), ['priya'])
+        self.assertEqual(self.usernames('"razor)*'), ['priya'])
+
+    def test_follows_profile_changes(self):
+        profile = self.mentor('kim', organization='Stripe')
+        profile.user_type = 'MENTEE'
+        profile.save()
+        self.assertEqual(self.usernames('stripe'), [])
+        profile.user_type = 'MENTOR'
+        profile.save()
+        self.assertEqual(self.usernames('stripe'), ['kim'])
+        profile.delete()
+        self.assertEqual(self.usernames('stripe'), [])
+
+    def test_finds_resume_text(self):
+        profile = self.mentor('ada', resume=SimpleUploadedFile('cv.txt', b'Compilers and kubernetes operators'))
+        self.assertEqual(self.usernames('kubernetes'), [])
+        # Normally run by the background extractor after commit
+        extract_resume(profile.id)
+        self.assertEqual(self.usernames('kubernetes'), ['ada'])
+        # Saving again keeps the extracted text while the resume is unchanged
+        profile.info = 'Mentoring since 2019'
+        profile.save()
+        self.assertEqual(self.usernames('kubernetes'), ['ada'])
+
+
+class MentorDirectoryTests(TestCase):
+
+    def setUp(self):
+        shared = tempfile.mkdtemp(prefix='shared-cache-')
+        self.addCleanup(shutil.rmtree, shared, ignore_errors=True)
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': shared},
+        }
+        settings_override = override_settings(CACHES=caches, MENTOR_DIRECTORY_PAGE_SIZE=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(cache.clear)
+        self.shared = shared
+        self.mentors = [
+            self.mentor('ana', organization='Stripe', expertise='web_dev'),
+            self.mentor('ben', organization='Stripe', expertise='data_science'),
+            self.mentor('cai', organization='Adobe', expertise='web_dev'),
+            self.mentor('dev', organization='', expertise='web_dev'),
+            self.mentor('eli', organization='Zoho', expertise='ui_ux'),
+        ]
+        self.mentee = User.objects.create_user('mentee').profile
+        self.mentee.organization = 'Hidden'
+        self.mentee.save()
+
+    def mentor(self, username, **fields):
+        profile = User.objects.create_user(username).profile
+        for name, value in dict(user_type='MENTOR', **fields).items():
+            setattr(profile, name, value)
+        profile.save()
+        return profile
+
+    def usernames(self, filters=None, cursor=None):
+        cards, next_cursor = directory.mentor_page(filters or {}, cursor)
+        return [card['username'] for card in cards], next_cursor
+
+    def test_clean_filters_keeps_known_choices_only(self):
+        params = {'working_status': 'EMPLOYED', 'expertise': 'astrology', 'organization': ' Stripe ', 'user_type': 'MENTEE'}
+        self.assertEqual(directory.clean_filters(params), {'working_status': 'EMPLOYED', 'organization': 'Stripe'})
+
+    def test_pages_follow_the_id_cursor(self):
+        names, cursor = [], None
+        while True:
+            page, cursor = self.usernames(cursor=cursor)
+            names += page
+            if cursor is None:
+                break
+        self.assertEqual(names, ['ana', 'ben', 'cai', 'dev', 'eli'])
+        self.assertEqual(self.usernames(cursor='junk'), self.usernames())
+
+    def test_filters_combine(self):
+        self.assertEqual(self.usernames({'organization': 'Stripe', 'expertise': 'web_dev'}), (['ana'], None))
+        self.assertEqual(self.usernames({'expertise': 'web_dev'}), (['ana', 'cai'], self.mentors[2].id))
+        self.assertEqual(directory.organizations(), ['Adobe', 'Stripe', 'Zoho'])
+
+    def test_profile_saves_and_deletes_invalidate_cached_pages(self):
+        self.assertEqual(self.usernames()[0], ['ana', 'ben'])
+        ana = self.mentors[0]
+        ana.user_type = 'MENTEE'
+        ana.save()
+        self.assertEqual(self.usernames()[0], ['ben', 'cai'])
+        self.mentors[1].delete()
+        self.assertEqual(self.usernames()[0], ['cai', 'dev'])
+
+    def test_invalidation_from_another_process_reaches_this_one(self):
+        self.assertEqual(directory.organizations(), ['Adobe', 'Stripe', 'Zoho'])
+        # Changed without signals, then invalidated through a cache of its own
+        # on the same directory, as another worker would
+        Profile.objects.filter(id=self.mentors[2].id).update(organization='Figma')
+        self.assertEqual(directory.organizations(), ['Adobe', 'Stripe', 'Zoho'])
+        FileBasedCache(self.shared, {}).set(directory.VERSION_KEY, 'elsewhere', None)
+        self.assertEqual(directory.organizations(), ['Figma', 'Stripe', 'Zoho'])
+
+
+def observations(histogram, **labels):
+    # (count, sum) of one histogram series; the registry is shared by the
+    # whole test run, so tests compare before and after
+    series = histogram.series.get(histogram.key(labels))
+    return (series[2], series[1]) if series else (0, 0)
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_user('ops', password='pw', is_staff=True)
+        self.user = User.objects.create_user('member', password='pw')
+
+    def test_request_is_counted_under_its_url_pattern(self):
+        self.client.force_login(self.staff)
+        labels = {'route': '/metrics/', 'method': 'GET', 'status': 200}
+        before = requests_total.series.get(requests_total.key(labels), 0)
+        queries, seconds = observations(db_queries, route='/metrics/'), observations(request_seconds, route='/metrics/')
+        response = self.client.get('/metrics/')
+        self.assertEqual(requests_total.series[requests_total.key(labels)], before + 1)
+        self.assertEqual(observations(request_seconds, route='/metrics/')[0], seconds[0] + 1)
+        count, total = observations(db_queries, route='/metrics/')
+        # The session and the user are loaded from the database
+        self.assertEqual(count, queries[0] + 1)
+        self.assertGreaterEqual(total - queries[1], 2)
+        self.assertIn('http_requests_total{route="/metrics/",method="GET",status="200"}', response.content.decode())
+
+    def test_routes_are_patterns_not_paths(self):
+        self.client.force_login(self.user)
+        self.client.get('/chat/chat/room/first-room')
+        self.client.get('/chat/chat/room/second-room')
+        self.client.get('/no/such/page')
+        routes = {key[0] for key in requests_total.series}
+        self.assertIn('/chat/chat/room/<chatroom_name>', routes)
+        self.assertIn('unresolved', routes)
+        self.assertFalse([route for route in routes if 'first-room' in route or 'second-room' in route])
+
+    def test_template_and_response_size_are_recorded(self):
+        rendering = observations(template_seconds, route='/')
+        sizes = observations(response_bytes, route='/')
+        response = self.client.get('/')
+        count, total = observations(template_seconds, route='/')
+        self.assertEqual(count, rendering[0] + 1)
+        self.assertGreater(total, rendering[1])
+        self.assertEqual(observations(response_bytes, route='/'), (sizes[0] + 1, sizes[1] + len(response.content)))
+
+    def test_label_sets_past_the_cap_fold_into_other(self):
+        counter = metrics.Counter('test_capped_total', 'Capped', ('room',))
+        gauge = metrics.Gauge('test_capped', 'Capped', ('room',))
+        gauge.set_function(lambda: {('a',): 1, ('b',): 5, ('c',): 2, ('d',): 3})
+        with mock.patch.object(metrics, 'MAX_SERIES', 2):
+            for room in ['a', 'b', 'c', 'd', 'a']:
+                counter.inc(room=room)
+            samples = gauge.samples()
+        self.assertEqual(counter.series, {('a',): 2, ('b',): 1, ('other',): 2})
+        self.assertEqual([(labels, value) for _, labels, value in samples],
+                         [('{room="b"}', 5), ('{room="other"}', 6)])
+
+    def test_anonymous_and_members_are_refused(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    def test_scraper_token(self):
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics/', headers={'Authorization': 'Bearer '}).status_code, 404)
+        with override_settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics/', headers={'Authorization': 'Bearer guess'}).status_code, 404)
+            response = self.client.get('/metrics/', headers={'Authorization': 'Bearer s3cret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+
+class ProfilerTests(TestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_superuser('profiler', password='pw')
+        self.user = User.objects.create_user('curious', password='pw')
+
+    def test_members_cannot_ask_for_a_profile(self):
+        self.client.force_login(self.user)
+        self.assertNotIn('X-Profile-Id', self.client.get('/?_profile=1'))
+        self.assertNotIn('X-Profile-Id', self.client.get('/', headers={'X-Profile': '1'}))
+        self.client.logout()
+        self.assertNotIn('X-Profile-Id', self.client.get('/?_profile=1'))
+        self.assertFalse(ProfilerRun.objects.exists())
+
+    def test_staff_request_is_profiled_and_stored(self):
+        self.client.force_login(self.staff)
+        response = self.client.get('/', {'_profile': '1'})
+        run = ProfilerRun.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual((run.kind, run.target, run.user), ('http', 'GET /?_profile=1', self.staff))
+        self.assertIn('home_view', run.summary)
+        response = self.client.get('/search/', headers={'X-Profile': '1'})
+        self.assertEqual(ProfilerRun.objects.get(pk=response['X-Profile-Id']).target, 'GET /search/')
+
+    @override_settings(PROFILER_SAMPLE_RATE=1)
+    def test_sampled_requests_are_stored_without_an_id_header(self):
+        response = self.client.get('/')
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(ProfilerRun.objects.get().user, None)
+
+    @override_settings(PROFILER_WEBSOCKET_SAMPLE_RATE=1)
+    def test_sampled_consumer_events_are_stored(self):
+        class Consumer:
+            chatroom_name = 'room'
+            user = self.user
+
+            @profiled('receive')
+            def receive(self, text):
+                return text.upper()
+
+        self.assertEqual(Consumer().receive('hi'), 'HI')
+        run = ProfilerRun.objects.get()
+        self.assertEqual((run.kind, run.target, run.user), ('websocket', 'room receive', self.user))
+
+    def test_admin_download_is_a_pstats_file(self):
+        self.client.force_login(self.staff)
+        run = ProfilerRun.objects.get(pk=self.client.get('/?_profile=1')['X-Profile-Id'])
+        url = reverse('admin:a_home_profilerrun_download', args=[run.pk])
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="profile-{run.pk}.prof"')
+        with tempfile.NamedTemporaryFile(suffix='.prof') as prof:
+            prof.write(response.content)
+            prof.flush()
+            stats = pstats.Stats(prof.name)
+        self.assertTrue(any(name == 'home_view' for _, _, name in stats.stats))
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+
+def image_file(name, size=(800, 600), mode='RGB', fmt='JPEG'):
+    data = io.BytesIO()
+    Image.new(mode, size, 'red').save(data, fmt)
+    return ContentFile(data.getvalue(), name=name)
+
+
+class DerivativeTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='derivatives-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(derivatives._known.clear)
+        derivatives._known.clear()
+        self.profile = User.objects.create_user('pictured').profile
+        self.profile.image.save('me.jpg', image_file('me.jpg'))
+
+    def tearDown(self):
+        if default_storage.collector.timer is not None:
+            default_storage.collector.timer.cancel()
+
+    def opened(self, name):
+        with default_storage.open(name) as derivative:
+            image = Image.open(derivative)
+            image.load()
+        return image
+
+    def test_sizes_and_formats(self):
+        small = self.opened(derivatives.get_derivative(self.profile.image, 'avatar_sm'))
+        self.assertEqual((small.size, small.format), ((64, 64), 'JPEG'))
+        chat = self.opened(derivatives.get_derivative(self.profile.image, 'chat'))
+        self.assertEqual(chat.size, (576, 432))
+        self.profile.image.save('clear.png', image_file('clear.png', mode='RGBA', fmt='PNG'))
+        name = derivatives.get_derivative(self.profile.image, 'avatar_md')
+        self.assertTrue(name.endswith('.png'))
+        self.assertEqual(self.opened(name).size, (128, 128))
+
+    def test_derivatives_are_built_once(self):
+        name = derivatives.get_derivative(self.profile.image, 'avatar_sm')
+        with mock.patch.object(derivatives, 'render_derivative') as render:
+            self.assertEqual(derivatives.get_derivative(self.profile.image, 'avatar_sm'), name)
+            # Another process finds it in storage
+            derivatives._known.clear()
+            self.assertEqual(derivatives.get_derivative(self.profile.image, 'avatar_sm'), name)
+        render.assert_not_called()
+        derivatives.delete_derivatives(self.profile.image.name)
+        self.assertFalse(default_storage.exists(name))
+        self.assertNotIn(name, derivatives._known)
+
+    def test_known_names_are_bounded(self):
+        with mock.patch.object(derivatives, 'KNOWN_LIMIT', 2):
+            for size in ['avatar_sm', 'avatar_md', 'avatar_sm', 'avatar_lg']:
+                derivatives.get_derivative(self.profile.image, size)
+        self.assertEqual(list(derivatives._known), [
+            derivatives.derivative_name(self.profile.image.name, size) + '.jpg' for size in ['avatar_sm', 'avatar_lg']])
+
+    def test_unreadable_images_fall_back_to_the_original(self):
+        self.profile.image.save('broken.jpg', ContentFile(b'not an image'))
+        with self.assertLogs('a_home.derivatives', 'WARNING'):
+            self.assertIsNone(derivatives.get_derivative(self.profile.image, 'avatar_sm'))
+            self.assertEqual(avatar(self.profile, 'avatar_sm'), self.profile.image.url)
+
+    def test_filters(self):
+        name = derivatives.derivative_name(self.profile.image.name, 'avatar_lg') + '.jpg'
+        self.assertEqual(avatar(self.profile, 'avatar_lg'), default_storage.url(name))
+        self.assertEqual(avatar(self.profile), default_storage.url(name.replace('avatar_lg', 'avatar_sm')))
+        self.assertEqual(thumbnail(self.profile.image), default_storage.url(name.replace('avatar_lg', 'chat')))
+        self.assertEqual(avatar(None), staticfiles_storage.url('images/avatar.svg'))
+        self.profile.image = None
+        self.assertEqual(avatar(self.profile), staticfiles_storage.url('images/avatar.svg'))
+        self.assertEqual(thumbnail(self.profile.image), '')
@@ -1,7 +1,64 @@
+import hmac
+from urllib.parse import urlencode
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
-from a_users.models import Profile
+from django.urls import reverse
+from a_users.constants import EXPERTISE_CHOICES, WORKING_STATUS_CHOICES
+from .directory import clean_filters, mentor_page, organizations
+from .search import search_mentors
+from a_core.metrics import registry
 
 def home_view(request):
-    # Get all profiles where user_type is 'MENTOR'
-    mentors = Profile.objects.filter(user_type='MENTOR')
-    return render(request, 'home.html', {'mentors': mentors})
\ No newline at end of file
+    # Mentor directory: one cached, cursor-paginated page at a time
+    filters = clean_filters(request.GET)
+    mentors, next_cursor = mentor_page(filters, request.GET.get('cursor'))
+    context = {
+        'mentors': mentors,
+        'next_cursor': next_cursor,
+        'filters': filters,
+        'more_url': reverse('home') + '?' + urlencode({**filters, 'cursor': next_cursor}),
+    }
+    if request.htmx:
+        return render(request, 'partials/mentor_cards.html', context)
+
+    context.update({
+        'working_status_choices': WORKING_STATUS_CHOICES,
+        'expertise_choices': EXPERTISE_CHOICES,
+        'organizations': organizations(),
+    })
+    return render(request, 'home.html', context)
+
+
+def mentor_search_view(request):
+    # Ranked full-text search over mentor profiles and resumes, as an htmx
+    # partial for the mentor grid; a blank query shows the directory again
+    query = request.GET.get('q', '').strip()
+    if not query:
+        mentors, next_cursor = mentor_page({})
+        more_url = reverse('home') + '?' + urlencode({'cursor': next_cursor})
+        return render(request, 'partials/mentor_cards.html', {
+            'mentors': mentors, 'next_cursor': next_cursor, 'more_url': more_url,
+        })
+
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    mentors, next_page = search_mentors(query, page)
+    return render(request, 'partials/mentor_cards.html', {
+        'mentors': mentors,
+        'next_cursor': next_page,
+        'more_url': reverse('mentor-search') + '?' + urlencode({'q': query, 'page': next_page}),
+        'query': query,
+    })
+
+
+def metrics_view(request):
+    # Prometheus text format, for staff or a scraper sending
+    # "Authorization: Bearer <METRICS_TOKEN>". Anyone else gets a 404.
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    bearer = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not request.user.is_staff and not (token and hmac.compare_digest(bearer, token)):
+        raise Http404()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,49 @@
+import os
+
+from a_home.derivatives import DERIVATIVES_DIR, derivative_name
+from .models import ChatGroup, GroupMessage
+
+ATTACHMENT_DIR = 'files/'
+
+
+def thumbnail_group(name):
+    # (group id, is_private) of the chat message whose file `name` is a
+    # thumbnail of, or None
+    parts = name.split('/')
+    if len(parts) != 4 or parts[0] != DERIVATIVES_DIR:
+        return None
+    # derivatives/<size>/<ab>/<stem>-<digest>.<ext>: the digest is a hash of
+    # the source name, so match it against the messages whose file name
+    # starts with the stem (an index range scan, not a LIKE)
+    base = os.path.splitext(name)[0]
+    stem = os.path.basename(base).rpartition('-')[0]
+    prefix = ATTACHMENT_DIR + stem
+    candidates = GroupMessage.objects.filter(
+        file__gte=prefix, file__lt=prefix + '\U0010ffff',
+    ).values_list('file', 'group_id', 'group__is_private')
+    for file, group_id, is_private in candidates:
+        if derivative_name(file, parts[1]) == base:
+            return group_id, is_private
+    return None
+
+
+def media_access(name, load_user):
+    # For a_core.media.MediaFiles: attachments of private chats and their
+    # thumbnails only go to members of the chat. Files under files/ that no
+    # message holds any more are not served.
+    if name.startswith(ATTACHMENT_DIR):
+        group = GroupMessage.objects.filter(file=name).values_list('group_id', 'group__is_private').first()
+        if group is None:
+            return None
+    else:
+        group = thumbnail_group(name)
+        if group is None:
+            # Avatars, resumes and their thumbnails
+            return 'public'
+    group_id, is_private = group
+    if not is_private:
+        return 'public'
+    user = load_user()
+    if user.is_authenticated and ChatGroup.members.through.objects.filter(chatgroup_id=group_id, user_id=user.pk).exists():
+        return 'private'
+    return None
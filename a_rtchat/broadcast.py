@@ -0,0 +1,98 @@
+import json
+
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from a_home.derivatives import derivative_url
+from a_home.templatetags.media_tags import avatar
+from .models import ChatGroup
+
+
+def render_message(message, user):
+    context = {
+        'message' : message,
+        'user' : user,
+    }
+    return render_to_string("a_rtchat/partials/chat_message_p.html", context=context)
+
+
+def dumps(frame):
+    return json.dumps(frame, separators=(',', ':'))
+
+
+def message_frames(message):
+    # The compact protocol's frame for a message, without and with its
+    # author's details (see chat.html's renderMessage); each socket gets the
+    # details with the first message it sees from that author
+    frame = {
+        'type': 'message',
+        'id': message.id,
+        'author': message.author_id,
+        'created': int(message.created.timestamp() * 1000),
+    }
+    if message.body:
+        frame['body'] = message.body
+    elif message.file:
+        frame['file'] = {'url': message.file.url, 'name': message.filename, 'size': message.file_size}
+        if message.is_image:
+            frame['file'].update(thumb=derivative_url(message.file, 'chat'), image=True)
+            if message.file_width:
+                frame['file'].update(width=message.file_width, height=message.file_height)
+    author = message.author
+    user = {'name': author.profile.name, 'username': author.username, 'avatar': avatar(author.profile, 'avatar_sm')}
+    return {'json': dumps(frame), 'json_author': dumps(dict(frame, user=user))}
+
+
+def message_event(message):
+    # 'render_once' renders the two bubble variants here, once per message, so
+    # every socket in the group only has to pick one. 'per_socket' keeps the
+    # old behaviour of re-fetching and re-rendering in each consumer. JSON
+    # frames are only built when the chat page asks for them; a socket that
+    # wants them anyway renders its own (see consumers.MessageFrames).
+    event = {
+        'type': 'message_handler',
+        'message_id': message.id,
+        'author_id': message.author_id,
+    }
+    if getattr(settings, 'RTCHAT_BROADCAST_MODE', 'render_once') == 'render_once':
+        event['html_author'] = render_message(message, message.author)
+        event['html'] = render_message(message, None)
+        if getattr(settings, 'RTCHAT_COMPACT_PROTOCOL', False):
+            event.update(message_frames(message))
+    return event
+
+
+def pick_message_html(event, user):
+    if 'html' not in event:
+        return None
+    if user is not None and event['author_id'] == user.id:
+        return event['html_author']
+    return event['html']
+
+
+def pick_message_json(event, sent_authors):
+    if 'json' not in event:
+        return None
+    if event['author_id'] in sent_authors:
+        return event['json']
+    sent_authors.add(event['author_id'])
+    return event['json_author']
+
+
+def online_count_event(chatroom_name, online_ids):
+    # Rendered once per (debounced) presence change; members and their
+    # profiles are loaded in two queries instead of once per socket.
+    chat_group = ChatGroup.objects.filter(group_name=chatroom_name).prefetch_related('members__profile').first()
+    if chat_group is None:
+        return None
+    context = {
+        'online_count' : len(online_ids),
+        'online_ids' : online_ids,
+        'chat_group' : chat_group,
+    }
+    return {
+        'type': 'online_count_handler',
+        'online_count': len(online_ids),
+        'html': render_to_string("a_rtchat/partials/online_count.html", context),
+        'json': dumps({'type': 'online', 'count': len(online_ids), 'ids': sorted(online_ids)}),
+    }
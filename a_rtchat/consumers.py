@@ -1,28 +1,70 @@
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
 from django.shortcuts import get_object_or_404
-from django.template.loader import render_to_string
 from asgiref.sync import async_to_sync
+import asyncio
 import json
+from urllib.parse import parse_qs
 from .models import *
+from .broadcast import message_event, message_frames, pick_message_html, pick_message_json, render_message
+from .presence import presence
+from .writebehind import save_message
+from .metrics import Timer
+from a_home.profiling import profiled
 
-class ChatroomConsumer(WebsocketConsumer):
+# Server heartbeat; the chat page answers with {"type": "pong"}
+PING = json.dumps({'type': 'ping'})
+
+
+class MessageFrames:
+    # What a socket is sent for a chat message. Sockets opened with
+    # ?protocol=json get compact JSON frames (broadcast.message_frames),
+    # which the chat page renders itself, instead of html fragments.
+
+    def start_protocol(self):
+        self.compact = parse_qs(self.scope.get('query_string', b'').decode()).get('protocol') == ['json']
+        self.sent_authors = set()
+
+    def pick_message(self, event):
+        # From the rendered-once event; None in 'per_socket' mode
+        if self.compact:
+            return pick_message_json(event, self.sent_authors)
+        return pick_message_html(event, self.user)
+
+    def frame_message(self, message, event):
+        if self.compact:
+            return pick_message_json(dict(event, **message_frames(message)), self.sent_authors)
+        return render_message(message, self.user)
+
+    def online_frame(self, event):
+        return event['json'] if self.compact else event['html']
+
+
+class ChatroomConsumer(MessageFrames, WebsocketConsumer):
+    @profiled('connect')
     def connect(self):
+        timer = Timer('connect')
     # Get the actual User instance instead of the lazy object
         self.user = self.scope["user"]._wrapped if hasattr(self.scope["user"], "_wrapped") else self.scope["user"]
         self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name'] 
+        self.start_protocol()
         self.chatroom = get_object_or_404(ChatGroup, group_name=self.chatroom_name)
+        timer.lap('lookup')
 
         async_to_sync(self.channel_layer.group_add)(
             self.chatroom_name,
             self.channel_name
         )
+        timer.lap('group_add')
 
-        # Now add the resolved user instance
-        if self.user not in self.chatroom.users_online.all():
-            self.chatroom.users_online.add(self.user)
-            self.update_online_count()
+        # Presence is tracked in memory and persisted in the background
+        if self.user.is_authenticated:
+            async_to_sync(presence.join)(self.chatroom_name, self.user.id, self.channel_name)
+        timer.lap('presence')
 
         self.accept()
+        timer.lap('accept')
+        timer.done()
 
 
 
@@ -34,87 +76,166 @@ class ChatroomConsumer(WebsocketConsumer):
             self.chatroom_name, self.channel_name
         )
 
-    # Remove and update online users with resolved user instance
-        if self.user in self.chatroom.users_online.all():
-            self.chatroom.users_online.remove(self.user)
-            self.update_online_count()
+        async_to_sync(presence.leave)(self.channel_name)
 
 
 
+    @profiled('receive')
     def receive(self, text_data):
+        timer = Timer('receive')
+        presence.touch(self.channel_name)
         text_data_json = json.loads(text_data)
+        if text_data_json.get('type') == 'pong':
+            return
         body = text_data_json['body']
+        timer.lap('parse')
         
-        message = GroupMessage.objects.create(
+        message = GroupMessage(
             body = body,
             author = self.user, 
             group = self.chatroom 
         )
+        pending = save_message(message)
+        if pending is not None:
+            pending.result()
+        timer.lap('insert')
          
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-        }
+        event = message_event(message)
+        timer.lap('render')
 
         async_to_sync(self.channel_layer.group_send)(
             self.chatroom_name, event
         )
+        timer.lap('group_send')
+        timer.done()
 
 
+    @profiled('message_handler')
     def message_handler(self, event):
-        message_id = event['message_id']
-        message = GroupMessage.objects.get(id=message_id)
-        context = {
-            'message' : message,
-            'users' : self.user
-        }
+        timer = Timer('message_handler')
+        text = self.pick_message(event)
+        if text is None:
+            message = GroupMessage.objects.select_related('author__profile').get(id=event['message_id'])
+            timer.lap('fetch')
+            text = self.frame_message(message, event)
+        timer.lap('render')
+        self.send(text_data=text)
+        timer.lap('send')
+        timer.done()
 
-        html = render_to_string("a_rtchat/partials/chat_message_p.html", context = context)
-        self.send(text_data=html)
 
+    def online_count_handler(self, event):
+        timer = Timer('online_count_handler')
+        # Rendered once by the presence broadcaster
+        self.send(text_data=self.online_frame(event))
+        timer.lap('send')
+        timer.done()
 
-    def update_online_count(self):
-        online_count = self.chatroom.users_online.count()
-        
-        event = {
-            'type': 'online_count_handler',
-            'online_count': online_count
-        }
-        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
 
+    def heartbeat_handler(self, event):
+        self.send(text_data=PING)
 
-    def online_count_handler(self, event):
-        online_count = event['online_count']
 
-        context = {
-            'online_count' : online_count,
-            'chat_group' : self.chatroom,
-        }
+    def heartbeat_expired(self, event):
+        # Sent by the presence reaper when no pong came back in time
+        self.close()
 
-        html = render_to_string("a_rtchat/partials/online_count.html", context)
-        self.send(text_data=html) 
 
 
-# a_rtchat/consumers.py
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+class AsyncChatroomConsumer(MessageFrames, AsyncWebsocketConsumer):
+    # Same protocol as ChatroomConsumer, but channel-layer calls are awaited
+    # directly and each event does its ORM work in a single thread hop.
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
-        # Only allow authenticated users
-        if self.scope["user"].is_authenticated:
-            self.accept()
-            # Get the room name from the URL
-            self.room_name = self.scope['url_route']['kwargs']['room_name']
-            self.room_group_name = f'chat_{self.room_name}'
-            
-            # Join room group
-            async_to_sync(self.channel_layer.group_add)(
-                self.room_group_name,
-                self.channel_name
-            )
-            
-            if hasattr(self, 'chatroom') and self.chatroom:
-                self.chatroom.users_online.add(self.scope["user"])
-        else:
-            self.close()
\ No newline at end of file
+    async def connect(self):
+        timer = Timer('connect')
+        self.user = self.scope["user"]._wrapped if hasattr(self.scope["user"], "_wrapped") else self.scope["user"]
+        self.chatroom_name = self.scope['url_route']['kwargs']['chatroom_name']
+        self.chatroom = None
+        self.start_protocol()
+
+        self.chatroom = await self.get_chatroom()
+        timer.lap('lookup')
+        if self.chatroom is None:
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(self.chatroom_name, self.channel_name)
+        timer.lap('group_add')
+        if self.user.is_authenticated:
+            await presence.join(self.chatroom_name, self.user.id, self.channel_name)
+        timer.lap('presence')
+
+        await self.accept()
+        timer.lap('accept')
+        timer.done()
+
+    async def disconnect(self, close_code):
+        if self.chatroom is None:
+            return
+
+        await self.channel_layer.group_discard(self.chatroom_name, self.channel_name)
+
+        await presence.leave(self.channel_name)
+
+    async def receive(self, text_data):
+        timer = Timer('receive')
+        presence.touch(self.channel_name)
+        text_data_json = json.loads(text_data)
+        if text_data_json.get('type') == 'pong':
+            return
+        body = text_data_json['body']
+        timer.lap('parse')
+
+        # Insert and render share one thread hop, so they are timed together
+        event, pending = await self.create_message(body)
+        if pending is not None:
+            await asyncio.wrap_future(pending)
+        timer.lap('insert')
+        await self.channel_layer.group_send(self.chatroom_name, event)
+        timer.lap('group_send')
+        timer.done()
+
+    async def message_handler(self, event):
+        timer = Timer('message_handler')
+        text = self.pick_message(event)
+        if text is None:
+            # Fetch and render share one thread hop
+            text = await self.render_message(event)
+        timer.lap('render')
+        await self.send(text_data=text)
+        timer.lap('send')
+        timer.done()
+
+    async def online_count_handler(self, event):
+        timer = Timer('online_count_handler')
+        await self.send(text_data=self.online_frame(event))
+        timer.lap('send')
+        timer.done()
+
+    async def heartbeat_handler(self, event):
+        await self.send(text_data=PING)
+
+    async def heartbeat_expired(self, event):
+        await self.close()
+
+    @database_sync_to_async
+    @profiled('connect')
+    def get_chatroom(self):
+        return ChatGroup.objects.filter(group_name=self.chatroom_name).first()
+
+    @database_sync_to_async
+    @profiled('receive')
+    def create_message(self, body):
+        message = GroupMessage(
+            body = body,
+            author = self.user,
+            group = self.chatroom
+        )
+        pending = save_message(message)
+        return message_event(message), pending
+
+    @database_sync_to_async
+    @profiled('message_handler')
+    def render_message(self, event):
+        message = GroupMessage.objects.select_related('author__profile').get(id=event['message_id'])
+        return self.frame_message(message, event)
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(message):
+    micros = (message.created - EPOCH) // timedelta(microseconds=1)
+    return f'{micros}-{message.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        micros, message_id = cursor.split('-')
+        return EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def history_page(chat_group, cursor=None, page_size=None):
+    # Keyset pagination over (created, id): every page is a range scan on
+    # groupmessage_history_idx, however far back it is. Returns the page
+    # oldest-first, ready to render, plus the cursor for the next older page.
+    page_size = page_size or getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 30)
+    messages = chat_group.chat_messages.select_related('author__profile').order_by('-created', '-id')
+
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        created, message_id = position
+        # The OR alone is no index range for SQLite; created__lte bounds
+        # the scan on (group, created) and the OR picks within it
+        messages = messages.filter(created__lte=created).filter(
+            Q(created__lt=created) | Q(created=created, id__lt=message_id))
+
+    page = list(messages[:page_size + 1])
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    page = page[:page_size]
+    page.reverse()
+    return page, next_cursor
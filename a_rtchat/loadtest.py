@@ -0,0 +1,235 @@
+import asyncio
+import random
+import re
+import resource
+import statistics
+import time
+import tracemalloc
+import zlib
+from datetime import datetime, timezone
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .models import ChatGroup
+
+# Chat bodies carry the sender and a perf_counter_ns timestamp, which the
+# receivers read back out of the rendered message html or JSON frame
+BODY = re.compile(r'bench (\d+) (\d+) (\d+)')
+
+
+class QueryCounter:
+    # Counts SQL statements on every connection, including the ones opened
+    # by database_sync_to_async worker threads
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        for connection in connections.all(initialized_only=True):
+            connection.execute_wrappers.append(self)
+        connection_created.connect(self.connected)
+
+    def uninstall(self):
+        connection_created.disconnect(self.connected)
+        for connection in connections.all(initialized_only=True):
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def connected(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda fraction: values[min(len(values) - 1, int(len(values) * fraction))]
+    return {
+        'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99),
+        'max': values[-1], 'mean': statistics.fmean(values),
+    }
+
+
+def create_fixtures(rooms, clients):
+    # One group chat per room with its own members, each with a logged-in
+    # session. Returns [(group_name, [(user_id, session_key), ...]), ...]
+    fixtures = []
+    for r in range(rooms):
+        admin = None
+        members = []
+        for c in range(clients):
+            user = User.objects.create_user(f'bench-{r}-{c}', f'bench-{r}-{c}@example.com')
+            admin = admin or user
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            members.append((user, session.session_key))
+        chat_group = ChatGroup.objects.create(groupchat_name=f'bench room {r}', admin=admin)
+        chat_group.members.add(*[user for user, _ in members])
+        fixtures.append((chat_group.group_name, [(user.id, key) for user, key in members]))
+    return fixtures
+
+
+class Client:
+
+    def __init__(self, application, room, user_id, session_key, protocol='html'):
+        self.room = room
+        self.user_id = user_id
+        self.communicator = WebsocketCommunicator(
+            application,
+            f'/ws/chatroom/{room}' + ('?protocol=json' if protocol == 'json' else ''),
+            headers=[
+                (b'cookie', f'sessionid={session_key}'.encode()),
+                (b'origin', b'http://localhost'),
+                (b'host', b'localhost'),
+            ],
+        )
+        self.sent = 0
+        self.latencies = []
+        # Message frame bytes as sent, and as permessage-deflate would send
+        # them with the server's settings (see a_core/websocket.py)
+        self.frame_bytes = 0
+        self.deflated_bytes = 0
+        self.deflate = zlib.compressobj(
+            wbits=-getattr(settings, 'WEBSOCKET_DEFLATE_WINDOW_BITS', 12),
+            memLevel=getattr(settings, 'WEBSOCKET_DEFLATE_MEM_LEVEL', 5),
+        )
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout)
+        if not connected:
+            raise RuntimeError(f'Websocket connection to {self.room} was refused')
+
+    async def send(self, rate, duration, size):
+        padding = 'x' * size
+        interval = 1 / rate
+        # Spread clients out so they do not all send on the same tick
+        await asyncio.sleep(random.random() * interval)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            await self.communicator.send_json_to({
+                'body': f'bench {self.user_id} {self.sent} {time.perf_counter_ns()} {padding}',
+            })
+            self.sent += 1
+            await asyncio.sleep(interval)
+
+    async def receive(self, stop):
+        # Reads the output queue directly: a timed out receive_from() would
+        # cancel the application
+        while not stop.is_set():
+            try:
+                output = await asyncio.wait_for(self.communicator.output_queue.get(), 0.2)
+            except asyncio.TimeoutError:
+                continue
+            frame = output.get('text') or ''
+            match = BODY.search(frame)
+            if match:
+                self.latencies.append((time.perf_counter_ns() - int(match.group(3))) / 1e6)
+                data = frame.encode()
+                self.frame_bytes += len(data)
+                # The sync flush's trailing 00 00 ff ff is not sent (RFC 7692)
+                self.deflated_bytes += len(self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)) - 4
+            elif '"ping"' in frame:
+                await self.communicator.send_json_to({'type': 'pong'})
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+async def run(application, rooms=5, clients=10, rate=1.0, duration=10.0, size=64, drain=2.0, connect_timeout=10, protocol='html'):
+    # Connects rooms * clients websockets, has every client send `rate`
+    # messages per second for `duration` seconds and measures how long each
+    # message takes to reach every socket in its room (its author included).
+    counter = QueryCounter()
+    counter.install()
+    try:
+        fixtures = await database_sync_to_async(create_fixtures)(rooms, clients)
+        counter.count = 0
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        socket_clients = []
+        for room, members in fixtures:
+            for user_id, session_key in members:
+                client = Client(application, room, user_id, session_key, protocol)
+                await client.connect(connect_timeout)
+                socket_clients.append(client)
+        connect_seconds = time.perf_counter() - started
+        # Let presence broadcasts settle before measuring
+        await asyncio.sleep(getattr(settings, 'RTCHAT_PRESENCE_DEBOUNCE', 0.5) + 0.5)
+        memory_after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        connect_queries = counter.count
+
+        counter.count = 0
+        stop = asyncio.Event()
+        receivers = [asyncio.ensure_future(client.receive(stop)) for client in socket_clients]
+        started = time.perf_counter()
+        await asyncio.gather(*(client.send(rate, duration, size) for client in socket_clients))
+        send_seconds = time.perf_counter() - started
+        await asyncio.sleep(drain)
+        stop.set()
+        await asyncio.gather(*receivers)
+        traffic_seconds = time.perf_counter() - started
+        traffic_queries = counter.count
+
+        for client in socket_clients:
+            await client.disconnect()
+    finally:
+        counter.uninstall()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    connections_total = len(socket_clients)
+    sent = sum(client.sent for client in socket_clients)
+    latencies = [latency for client in socket_clients for latency in client.latencies]
+    frame_bytes = sum(client.frame_bytes for client in socket_clients)
+    deflated_bytes = sum(client.deflated_bytes for client in socket_clients)
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            'rooms': rooms, 'clients_per_room': clients, 'rate_per_client': rate,
+            'duration': duration, 'body_bytes': size, 'protocol': protocol,
+        },
+        'settings': {
+            name: getattr(settings, name, None) for name in (
+                'RTCHAT_CONSUMER', 'RTCHAT_BROADCAST_MODE', 'RTCHAT_WRITE_BEHIND',
+                'RTCHAT_WRITE_BEHIND_DURABILITY',
+            )
+        } | {'CHANNEL_LAYER': settings.CHANNEL_LAYERS['default']['BACKEND']},
+        'connect': {
+            'connections': connections_total,
+            'seconds': connect_seconds,
+            'queries': connect_queries,
+            'queries_per_connection': connect_queries / connections_total,
+            'memory_per_connection_bytes': (memory_after - memory_before) / connections_total,
+            'max_rss_growth_kb': rss_after - rss_before,
+        },
+        'traffic': {
+            'messages_sent': sent,
+            'messages_per_second': sent / send_seconds,
+            'deliveries': len(latencies),
+            'expected_deliveries': sent * clients,
+            'deliveries_per_second': len(latencies) / traffic_seconds,
+            'latency_ms': percentiles(latencies),
+            'queries': traffic_queries,
+            'queries_per_message': traffic_queries / sent if sent else 0,
+            'bytes_per_delivery': frame_bytes / len(latencies) if latencies else 0,
+            'deflated_bytes_per_delivery': deflated_bytes / len(latencies) if latencies else 0,
+        },
+    }
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from a_rtchat.models import GroupMessage
+
+METADATA_FIELDS = ['file_type', 'file_is_image', 'file_width', 'file_height', 'file_size']
+
+
+class Command(BaseCommand):
+    help = 'Store type, size and image dimensions for file messages uploaded before they were recorded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pending = GroupMessage.objects.exclude(file='').filter(file__isnull=False, file_type__isnull=True)
+        updated = missing = 0
+        batch = []
+        for message in pending.only('id', 'file').iterator(chunk_size=batch_size):
+            try:
+                with message.file.open('rb'):
+                    message.set_file_metadata()
+            except FileNotFoundError:
+                missing += 1
+                continue
+            batch.append(message)
+            if len(batch) >= batch_size:
+                updated += GroupMessage.objects.bulk_update(batch, METADATA_FIELDS)
+                batch = []
+        if batch:
+            updated += GroupMessage.objects.bulk_update(batch, METADATA_FIELDS)
+        self.stdout.write(self.style.SUCCESS(f'Updated {updated} messages ({missing} files missing)'))
@@ -0,0 +1,48 @@
+import asyncio
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+
+class Command(BaseCommand):
+    help = 'Load-test the chat websocket stack through the ASGI application on a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--clients', type=int, default=10, help='Websocket clients per room')
+        parser.add_argument('--rate', type=float, default=1.0, help='Messages per second per client')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic')
+        parser.add_argument('--size', type=int, default=64, help='Extra body bytes per message')
+        parser.add_argument('--protocol', choices=['html', 'json'], default='html', help='Websocket frames to ask for')
+        parser.add_argument('--output', help='Write the JSON report to this file as well')
+
+    def handle(self, *args, **options):
+        from a_core.asgi import application
+        from a_rtchat.loadtest import run
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # The server builds JSON frames only when pages ask for them
+        compact = override_settings(RTCHAT_COMPACT_PROTOCOL=options['protocol'] == 'json')
+        try:
+            with compact:
+                report = asyncio.run(run(
+                    application,
+                    rooms=options['rooms'],
+                    clients=options['clients'],
+                    rate=options['rate'],
+                    duration=options['duration'],
+                    size=options['size'],
+                    protocol=options['protocol'],
+                ))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            path = Path(options['output'])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(output)
+        self.stdout.write(output)
@@ -0,0 +1,46 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from a_rtchat.models import ChatGroup, GroupMessage
+from a_rtchat.search import index_messages
+
+
+class Command(BaseCommand):
+    help = 'Set private_key on 1:1 chats and merge duplicate rooms for the same pair of users into the oldest one'
+
+    def handle(self, *args, **options):
+        Members = ChatGroup.members.through
+        Online = ChatGroup.users_online.through
+
+        members = defaultdict(list)
+        rows = Members.objects.filter(chatgroup__is_private=True).values_list('chatgroup_id', 'user_id')
+        for group_id, user_id in rows.iterator():
+            members[group_id].append(user_id)
+
+        by_key = defaultdict(list)
+        for group_id, user_ids in members.items():
+            # Rooms whose other member deleted their account keep no key
+            if len(user_ids) == 2:
+                low, high = sorted(user_ids)
+                by_key[f'{low}:{high}'].append(group_id)
+
+        merged = keyed = 0
+        with transaction.atomic():
+            for private_key, group_ids in by_key.items():
+                keep, *duplicates = sorted(group_ids)
+                if duplicates:
+                    moved = list(GroupMessage.objects.filter(group_id__in=duplicates).values_list('id', flat=True))
+                    GroupMessage.objects.filter(id__in=moved).update(group_id=keep)
+                    # update() sends no signals; the search index keys each
+                    # message to its room, so re-index the moved ones
+                    index_messages(GroupMessage.objects.filter(id__in=moved))
+                    online = set(Online.objects.filter(chatgroup_id__in=group_ids).values_list('user_id', flat=True))
+                    Online.objects.filter(chatgroup_id__in=group_ids).delete()
+                    Online.objects.bulk_create([Online(chatgroup_id=keep, user_id=user_id) for user_id in online])
+                    ChatGroup.objects.filter(id__in=duplicates).delete()
+                    merged += len(duplicates)
+                ChatGroup.objects.filter(id=keep).update(private_key=private_key)
+                keyed += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Keyed {keyed} private chats, merged {merged} duplicates'))
@@ -0,0 +1,17 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from a_rtchat.presence import collect_presence, write_presence
+
+
+class Command(BaseCommand):
+    help = ('Make ChatGroup.users_online match the sockets the running websocket workers report, '
+            'removing rows left behind by crashed or stopped workers. Needs the shared channel layer '
+            'to see other processes; with none running every row is removed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wait', type=float, default=5, help='Seconds to wait for the workers to report (default 5)')
+
+    def handle(self, *args, **options):
+        snapshot, workers = async_to_sync(collect_presence)(options['wait'])
+        rows = write_presence(snapshot, repair=True)
+        self.stdout.write(self.style.SUCCESS(f'{workers} workers reported; repaired {rows} presence rows'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from a_rtchat.models import GroupMessage
+from a_rtchat import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the chat message full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not search.index.supported:
+            self.stderr.write('Message search needs an SQLite database with FTS5')
+            return
+        batch_size = options['batch_size']
+        count = 0
+        batch = []
+        messages = GroupMessage.objects.only('id', 'body', 'file', 'group_id').order_by('id')
+        # One transaction, so searches see the old index until the new one is complete
+        with transaction.atomic():
+            search.index.clear()
+            for message in messages.iterator(chunk_size=batch_size):
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    search.index_messages(batch)
+                    count += len(batch)
+                    batch = []
+            search.index_messages(batch)
+            count += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} messages'))
@@ -0,0 +1,67 @@
+import time
+
+from channels.layers import get_channel_layer
+
+from a_core.metrics import EVENT_BUCKETS, registry
+from .presence import presence
+
+event_seconds = registry.histogram(
+    'rtchat_event_duration_seconds', 'Chatroom consumer event time by phase; phase "total" is the whole event',
+    ('event', 'phase'), buckets=EVENT_BUCKETS)
+room_sockets = registry.gauge(
+    'rtchat_room_sockets', 'Open authenticated websockets per room in this process', ('room',))
+queued_messages = registry.gauge(
+    'rtchat_channel_layer_queued_messages', 'Messages waiting in this process\'s channel layer queues')
+max_queue_depth = registry.gauge(
+    'rtchat_channel_layer_max_queue_depth', 'Longest channel layer queue in this process')
+
+_series = {}
+
+
+def series(event, phase):
+    bound = _series.get((event, phase))
+    if bound is None:
+        bound = _series[(event, phase)] = event_seconds.labels(event=event, phase=phase)
+    return bound
+
+
+class Timer:
+    # Lap timer for one consumer event: lap(phase) records the time since the
+    # previous lap, done() the time since the event started.
+    #
+    #   timer = Timer('receive')
+    #   ...parse...
+    #   timer.lap('parse')
+
+    __slots__ = ('event', 'started', 'last')
+
+    def __init__(self, event):
+        self.event = event
+        self.started = self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        series(self.event, phase).observe(now - self.last)
+        self.last = now
+
+    def done(self):
+        series(self.event, 'total').observe(time.perf_counter() - self.started)
+
+
+def socket_counts():
+    # Every local socket holds one reference on its (room, user)
+    return {room: sum(users.values()) for room, users in list(presence.rooms.items())}
+
+
+def queue_depths():
+    # In-process layers only (InMemoryChannelLayer and subclasses); other
+    # layers keep their queues elsewhere
+    channels = getattr(get_channel_layer(), 'channels', None)
+    if not isinstance(channels, dict):
+        return []
+    return [queue.qsize() for queue in list(channels.values())]
+
+
+room_sockets.set_function(socket_counts)
+queued_messages.set_function(lambda: {(): sum(queue_depths())})
+max_queue_depth.set_function(lambda: {(): max(queue_depths(), default=0)})
@@ -1,8 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 import shortuuid
+import mimetypes
 import os
 from PIL import Image
+from .validators import validate_file_name, validate_file_size
 
 # Create your models here.
 class ChatGroup(models.Model):
@@ -12,9 +16,17 @@ class ChatGroup(models.Model):
     users_online = models.ManyToManyField(User, related_name='online_in_groups', blank=True)
     members = models.ManyToManyField(User, related_name='chat_groups', blank=True)
     is_private = models.BooleanField(default=False)
+    # "<lower user id>:<higher user id>" for 1:1 chats; the unique index makes
+    # lookup-or-create a single indexed query and rules out duplicate rooms
+    private_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
 
     def __str__(self):
         return self.group_name
+
+    @staticmethod
+    def private_key_for(user, other_user):
+        low, high = sorted([user.pk, other_user.pk])
+        return f'{low}:{high}'
     
     meeting_id = models.CharField(max_length=255, blank=True, null=True)
     
@@ -29,7 +41,16 @@ class GroupMessage(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     body = models.CharField(max_length=300, blank=True, null=True)
     file = models.FileField(upload_to='files/', blank=True, null=True)
-    created = models.DateTimeField(auto_now_add=True)
+    # Detected once at upload (see set_file_metadata) so rendering never
+    # has to open the file
+    file_type = models.CharField(max_length=100, blank=True, null=True)
+    file_is_image = models.BooleanField(default=False)
+    file_width = models.PositiveIntegerField(blank=True, null=True)
+    file_height = models.PositiveIntegerField(blank=True, null=True)
+    file_size = models.PositiveBigIntegerField(blank=True, null=True)
+    # Set in Python rather than auto_now_add so write-behind batches keep the
+    # timestamp that was broadcast
+    created = models.DateTimeField(default=timezone.now, editable=False)
 
     @property
     def filename(self):
@@ -45,21 +66,52 @@ class GroupMessage(models.Model):
             return f'{self.author.username} : {self.filename}'
     
     class Meta:
-        ordering = ['-created']
+        # id breaks ties between messages with the same timestamp so the
+        # (created, id) history cursor is stable
+        ordering = ['-created', '-id']
+        indexes = [
+            models.Index(fields=['group', '-created', '-id'], name='groupmessage_history_idx'),
+            # Media access checks look attachments up by file name
+            models.Index(fields=['file'], name='groupmessage_file_idx'),
+        ]
 
     @property    
     def is_image(self):
+        if self.file_type is not None:
+            return self.file_is_image
+        # Rows saved before metadata was stored; backfill_file_metadata fills these in
         try:
             image = Image.open(self.file) 
             image.verify()
             return True 
         except:
             return False
-        
-def clean(self):
-    if not self.body and not self.file:
-        raise ValidationError("Message must have either text or a file.")
-    if self.file:
-        # Validate file size (e.g., max 10MB)
-        if self.file.size > 10 * 1024 * 1024:
-            raise ValidationError("File size cannot exceed 10MB.")
\ No newline at end of file
+
+    def set_file_metadata(self):
+        if not self.file:
+            return
+        self.file_size = self.file.size
+        self.file_is_image = False
+        self.file_width = self.file_height = None
+        try:
+            self.file.seek(0)
+            image = Image.open(self.file)
+            self.file_width, self.file_height = image.size
+            self.file_type = Image.MIME.get(image.format)
+            image.verify()
+            self.file_is_image = True
+        except Exception:
+            self.file_type = None
+        finally:
+            self.file.seek(0)
+        if not self.file_type:
+            self.file_type = mimetypes.guess_type(self.file.name)[0] or 'application/octet-stream'
+        if not self.file_is_image:
+            self.file_width = self.file_height = None
+
+    def clean(self):
+        if not self.body and not self.file:
+            raise ValidationError("Message must have either text or a file.")
+        if self.file:
+            validate_file_name(self.file.name)
+            validate_file_size(self.file.size)
@@ -0,0 +1,332 @@
+import asyncio
+import contextvars
+import logging
+import random
+import string
+import sys
+import time
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .broadcast import online_count_event
+from .models import ChatGroup
+
+logger = logging.getLogger(__name__)
+
+# Every process running consumers joins this group to share its room state
+# with the others
+SYNC_GROUP = 'rtchat.presence'
+
+
+class Presence:
+    # Record of who is connected to which room. Every local socket holds one
+    # reference on (room, user), so several tabs count as one user. Other
+    # worker processes publish their rooms over the channel layer (see
+    # _sync_loop) and are counted too, until they go quiet for longer than
+    # the idle timeout. All state is changed from the event loop only: async
+    # consumers await join/leave directly, sync consumers go through
+    # async_to_sync.
+
+    def __init__(self):
+        self.node = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        self.rooms = defaultdict(lambda: defaultdict(int))
+        self.remote = {}
+        self.sockets = {}
+        self.dirty = set()
+        self._pending = {}
+        self._tasks = []
+        self._sync_channel = None
+
+    @property
+    def debounce(self):
+        return getattr(settings, 'RTCHAT_PRESENCE_DEBOUNCE', 0.5)
+
+    @property
+    def persist_interval(self):
+        return getattr(settings, 'RTCHAT_PRESENCE_PERSIST_INTERVAL', 30)
+
+    @property
+    def heartbeat_interval(self):
+        return getattr(settings, 'RTCHAT_HEARTBEAT_INTERVAL', 25)
+
+    @property
+    def idle_timeout(self):
+        return getattr(settings, 'RTCHAT_IDLE_TIMEOUT', 75)
+
+    @property
+    def repair_interval(self):
+        return getattr(settings, 'RTCHAT_PRESENCE_REPAIR_INTERVAL', 3600)
+
+    def online(self, room):
+        users = set(self.rooms.get(room, ()))
+        for node in self.remote.values():
+            users |= node['rooms'].get(room, set())
+        return users
+
+    def count(self, room):
+        return len(self.online(room))
+
+    def all_rooms(self):
+        rooms = set(self.rooms)
+        for node in self.remote.values():
+            rooms |= set(node['rooms'])
+        return rooms
+
+    async def join(self, room, user_id, channel_name):
+        self.ensure_started()
+        self.sockets[channel_name] = {'room': room, 'user_id': user_id, 'last_seen': time.monotonic()}
+        users = self.rooms[room]
+        users[user_id] += 1
+        if users[user_id] == 1:
+            self.changed(room)
+
+    async def leave(self, channel_name):
+        # Safe to call twice: the reaper may already have dropped the socket
+        socket = self.sockets.pop(channel_name, None)
+        if socket is None:
+            return
+        room, user_id = socket['room'], socket['user_id']
+        users = self.rooms[room]
+        users[user_id] -= 1
+        if users[user_id] <= 0:
+            del users[user_id]
+            if not users:
+                del self.rooms[room]
+            self.changed(room)
+
+    def touch(self, channel_name):
+        # Plain method so sync consumers can call it from their thread
+        socket = self.sockets.get(channel_name)
+        if socket is not None:
+            socket['last_seen'] = time.monotonic()
+
+    def changed(self, room):
+        self.dirty.add(room)
+        # Coalesce bursts of joins/leaves into one broadcast per room
+        if room not in self._pending:
+            loop = asyncio.get_running_loop()
+            self._pending[room] = loop.call_later(
+                self.debounce, spawn, self.broadcast(room), context=contextvars.Context()
+            )
+
+    async def broadcast(self, room):
+        self._pending.pop(room, None)
+        online_ids = self.online(room)
+        try:
+            await self.publish([room])
+            event = await database_sync_to_async(online_count_event)(room, online_ids)
+            if event is not None:
+                await get_channel_layer().group_send(room, event)
+        except Exception:
+            logger.exception('Presence broadcast failed for %s', room)
+
+    def ensure_started(self):
+        # Called at worker startup (start_with_server, lifespan) and again on
+        # every join, which restarts a loop that died
+        if not self._tasks or any(task.done() for task in self._tasks):
+            for task in self._tasks:
+                task.cancel()
+            self._tasks = [spawn(self._persist_loop()), spawn(self._reaper_loop()), spawn(self._sync_loop())]
+
+    async def publish(self, rooms=None):
+        # Tell the other processes which users this one has in the given
+        # rooms, or in all of them (a full snapshot replaces what they knew)
+        full = rooms is None
+        rooms = list(self.rooms) if full else rooms
+        await get_channel_layer().group_send(SYNC_GROUP, {
+            'type': 'presence.state',
+            'node': self.node,
+            'full': full,
+            'rooms': {room: list(self.rooms.get(room, ())) for room in rooms},
+        })
+
+    async def _sync_loop(self):
+        channel_layer = get_channel_layer()
+        self._sync_channel = await channel_layer.new_channel()
+        await channel_layer.group_add(SYNC_GROUP, self._sync_channel)
+        await self.publish()
+        while True:
+            event = await channel_layer.receive(self._sync_channel)
+            if event.get('type') == 'presence.state' and event['node'] != self.node:
+                self.receive_state(event)
+
+    def receive_state(self, event):
+        # Only recorded: the publishing process broadcasts the new count to
+        # the room itself, so it reaches every socket exactly once
+        if event['node'] not in self.remote:
+            # A process just started (or we did): bring it up to date now
+            # rather than at our next heartbeat
+            spawn(self.publish())
+        node = self.remote.setdefault(event['node'], {'rooms': {}})
+        node['seen'] = time.monotonic()
+        rooms = {room: set(users) for room, users in event['rooms'].items()}
+        if event['full']:
+            self.dirty |= set(node['rooms']) | set(rooms)
+            node['rooms'] = {room: users for room, users in rooms.items() if users}
+        else:
+            self.dirty |= set(rooms)
+            for room, users in rooms.items():
+                if users:
+                    node['rooms'][room] = users
+                else:
+                    node['rooms'].pop(room, None)
+
+    async def _persist_loop(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Presence persist failed')
+
+    async def _reaper_loop(self):
+        # Every pass writes the rooms that changed; a full repair, which
+        # also clears rows left behind by a crashed worker, runs after the
+        # first heartbeat interval and then every repair interval. Waiting
+        # that first interval lets the other processes publish their rooms,
+        # so their users' rows are not taken for ghosts.
+        next_repair = time.monotonic() + self.heartbeat_interval
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            repair = time.monotonic() >= next_repair
+            if repair:
+                next_repair = time.monotonic() + self.repair_interval
+            try:
+                await self.reap(repair=repair)
+            except Exception:
+                logger.exception('Presence reaper failed')
+
+    async def heartbeat(self):
+        channel_layer = get_channel_layer()
+        for room in list(self.rooms):
+            await channel_layer.group_send(room, {'type': 'heartbeat_handler'})
+        # Doubles as this process's keepalive for the others; re-joining keeps
+        # the sync channel clear of the layer's group expiry
+        if self._sync_channel is not None:
+            await channel_layer.group_add(SYNC_GROUP, self._sync_channel)
+        await self.publish()
+
+    async def reap(self, repair=False):
+        # Close sockets that have not answered a heartbeat within the idle
+        # timeout and write the rooms that changed; with repair=True make
+        # all of users_online match every known socket.
+        channel_layer = get_channel_layer()
+        deadline = time.monotonic() - self.idle_timeout
+        stale = [name for name, socket in self.sockets.items() if socket['last_seen'] < deadline]
+        for channel_name in stale:
+            await self.leave(channel_name)
+            await channel_layer.send(channel_name, {'type': 'heartbeat_expired'})
+
+        # Processes that stopped publishing are gone; nobody else will
+        # announce that their users left, so every survivor does
+        for node_id, node in list(self.remote.items()):
+            if node['seen'] < deadline:
+                del self.remote[node_id]
+                for room in node['rooms']:
+                    self.changed(room)
+
+        await self.heartbeat()
+        rows = await self.flush(repair=repair)
+        if stale or rows:
+            logger.info('Presence reaper closed %d stale connections and repaired %d rows', len(stale), rows)
+        return {'connections': len(stale), 'rows': rows}
+
+    async def flush(self, rooms=None, repair=False):
+        # Write the current state of dirty (or the given) rooms, across all
+        # known processes, to ChatGroup.users_online; with repair=True every
+        # room that has rows is rewritten too. Returns the number of rows
+        # added or removed.
+        rooms = set(self.dirty) if rooms is None else set(rooms)
+        if repair:
+            rooms |= self.all_rooms()
+        self.dirty -= rooms
+        snapshot = {room: self.online(room) for room in rooms}
+        return await database_sync_to_async(write_presence)(snapshot, repair)
+
+
+def spawn(coro):
+    # Background work must not inherit the context of the consumer call that
+    # scheduled it; sync consumers run inside a short-lived asgiref executor.
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+def start_with_server():
+    # Start the presence loops with the worker rather than its first socket,
+    # so a restarted worker repairs users_online even with no clients.
+    # Daphne runs the application on twisted's asyncio reactor and sends no
+    # ASGI lifespan events; other servers get `lifespan` below.
+    reactor = sys.modules.get('twisted.internet.reactor')
+    if reactor is not None:
+        # Startup triggers fire before the asyncio loop runs; callLater waits
+        # for it
+        reactor.callWhenRunning(reactor.callLater, 0, presence.ensure_started)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            presence.ensure_started()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def collect_presence(wait):
+    # Returns ({room: user ids}, number of workers) across the running
+    # workers, as they publish it over the channel layer. A node they have
+    # not seen makes each of them publish its full state at once; `wait`
+    # seconds bounds the wait.
+    observer = Presence()
+    channel_layer = get_channel_layer()
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(SYNC_GROUP, channel)
+    try:
+        await observer.publish()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                event = await asyncio.wait_for(channel_layer.receive(channel), remaining)
+            except asyncio.TimeoutError:
+                break
+            if event.get('type') == 'presence.state' and event['node'] != observer.node:
+                # Known up front, so the observer does not publish back
+                observer.remote.setdefault(event['node'], {'rooms': {}})
+                observer.receive_state(event)
+    finally:
+        await channel_layer.group_discard(SYNC_GROUP, channel)
+    return {room: observer.online(room) for room in observer.all_rooms()}, len(observer.remote)
+
+
+def write_presence(snapshot, repair=False):
+    Through = ChatGroup.users_online.through
+    snapshot = dict(snapshot)
+    if repair:
+        for group_name in ChatGroup.objects.filter(users_online__isnull=False).values_list('group_name', flat=True).distinct():
+            snapshot.setdefault(group_name, set())
+    if not snapshot:
+        return 0
+
+    changed = 0
+    groups = ChatGroup.objects.filter(group_name__in=snapshot).values_list('group_name', 'id')
+    with transaction.atomic():
+        for group_name, group_id in groups:
+            wanted = snapshot[group_name]
+            current = set(Through.objects.filter(chatgroup_id=group_id).values_list('user_id', flat=True))
+            if current - wanted:
+                changed += Through.objects.filter(chatgroup_id=group_id, user_id__in=current - wanted).delete()[0]
+            if wanted - current:
+                changed += len(Through.objects.bulk_create(
+                    [Through(chatgroup_id=group_id, user_id=user_id) for user_id in wanted - current],
+                    ignore_conflicts=True,
+                ))
+    return changed
+
+
+presence = Presence()
@@ -1,6 +1,12 @@
+from django.conf import settings
 from django.urls import path
 from . import consumers
 
+if getattr(settings, 'RTCHAT_CONSUMER', 'sync') == 'async':
+    ChatroomConsumer = consumers.AsyncChatroomConsumer
+else:
+    ChatroomConsumer = consumers.ChatroomConsumer
+
 websocket_urlpatterns = [
-    path('ws/chatroom/<str:chatroom_name>', consumers.ChatroomConsumer.as_asgi()),
+    path('ws/chatroom/<str:chatroom_name>', ChatroomConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,53 @@
+from django.conf import settings
+
+from a_core.fts import FTSIndex, match_query
+from .models import GroupMessage
+
+# `room` holds a single token per message, so restricting a search to a room
+# is one more posting list to intersect rather than a filter over every hit
+index = FTSIndex(
+    'a_rtchat_message_search',
+    columns=('body', 'filename', 'room'),
+)
+
+
+def room_token(group_id):
+    return f'room{group_id}'
+
+
+def message_values(message):
+    return {
+        'body': message.body,
+        'filename': message.filename if message.file else '',
+        'room': room_token(message.group_id),
+    }
+
+
+def index_messages(messages):
+    index.replace_many((message.id, message_values(message)) for message in messages)
+
+
+def search_messages(chat_group, query, cursor=None, page_size=None):
+    # Newest matches first, paged by message id: the cost of a page depends
+    # on the page size, not on how much history the room has. Returns the
+    # messages plus the cursor for the next (older) page.
+    page_size = page_size or getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 30)
+    terms = match_query(query)
+    if not terms:
+        return [], None
+    where, params = '', ()
+    try:
+        if cursor:
+            where, params = 'rowid < %s', (int(cursor),)
+    except ValueError:
+        pass
+    ids = index.search(
+        f'room:"{room_token(chat_group.id)}" AND {{body filename}}:({terms})',
+        limit=page_size + 1, where=where, params=params, newest_first=True,
+    )
+    next_cursor = ids[page_size - 1] if len(ids) > page_size else None
+    messages = (
+        GroupMessage.objects.filter(id__in=ids[:page_size], group=chat_group)
+        .select_related('author__profile').order_by('-id')
+    )
+    return list(messages), next_cursor
@@ -0,0 +1,26 @@
+from django.contrib.auth.models import User
+from django.db.models import Count, Prefetch
+from .models import ChatGroup
+
+
+def chat_sidebar(user):
+    # Everything the chat sidebar shows, in a fixed number of queries no
+    # matter how many rooms the user is in: private chats with the other
+    # member's profile and online state, group chats with member counts.
+    private_groups = user.chat_groups.filter(is_private=True).prefetch_related(
+        Prefetch('members', queryset=User.objects.exclude(pk=user.pk).select_related('profile'), to_attr='others'),
+        Prefetch('users_online', queryset=User.objects.only('id'), to_attr='online'),
+    )
+    private_chats = []
+    for group in private_groups:
+        online_ids = {member.id for member in group.online}
+        for other in group.others:
+            private_chats.append({'group': group, 'other': other, 'online': other.id in online_ids})
+
+    # Counted in a separate query; annotating user.chat_groups directly would
+    # count only the join row that matched the user
+    group_chats = ChatGroup.objects.filter(
+        pk__in=user.chat_groups.filter(is_private=False).values('pk')
+    ).annotate(member_count=Count('members'))
+
+    return private_chats, list(group_chats)
@@ -0,0 +1,16 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import GroupMessage
+from . import search
+
+
+# Write-behind batches use bulk_create, which sends no signals, so the
+# writer indexes those itself (see writebehind.MessageWriter._write)
+@receiver(post_save, sender=GroupMessage)
+def index_message(sender, instance, **kwargs):
+    search.index_messages([instance])
+
+
+@receiver(post_delete, sender=GroupMessage)
+def unindex_message(sender, instance, **kwargs):
+    search.index.delete(instance.id)
@@ -1,3 +1,851 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
+from django.http import Http404
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, resolve, reverse
+from django.utils import timezone
+from PIL import Image
+from a_core.media import MediaFiles
+from a_core.testing import Budget, BudgetTests
+from a_home.derivatives import get_derivative
+from .access import media_access
+from .broadcast import message_event, online_count_event, pick_message_json, render_message
+from .consumers import AsyncChatroomConsumer, ChatroomConsumer, MessageFrames
+from .history import decode_cursor, history_page
+from .metrics import event_seconds, max_queue_depth, queued_messages, room_sockets
+from .models import ChatGroup, GroupMessage
+from .presence import Presence, collect_presence
+from .search import search_messages
+from .uploads import ChunkedUpload, UploadRejected
+from .writebehind import MessageWriter, reserve_ids
+
+
+def busiest_group(test):
+    return test.group.group_name
+
+
+class ChatViewBudgets(BudgetTests, TestCase):
+    urlconf = 'a_rtchat.urls'
+    budgets = {
+        'home': Budget(9, 150, user=lambda t: t.member, path='/chat/'),
+        'start-chat': Budget(10, 50, user=lambda t: t.member, kwargs=lambda t: {'username': t.stranger.username}),
+        'chatroom': Budget(10, 300, user=lambda t: t.member, kwargs=lambda t: {'chatroom_name': busiest_group(t)}),
+        'chat-history': Budget(5, 100, user=lambda t: t.member, kwargs=lambda t: {'chatroom_name': busiest_group(t)}),
+        'chat-search': Budget(7, 100, user=lambda t: t.member, kwargs=lambda t: {'chatroom_name': busiest_group(t)},
+                              data={'q': 'project'}),
+        'new-groupchat': Budget(3, 50, user=lambda t: t.member),
+        'edit-chatroom': Budget(6, 150, user=lambda t: t.group.admin, kwargs=lambda t: {'chatroom_name': busiest_group(t)}),
+        'chatroom-delete': Budget(4, 50, user=lambda t: t.group.admin, kwargs=lambda t: {'chatroom_name': busiest_group(t)}),
+        'chat-file-upload': Budget(9, 100, user=lambda t: t.member, kwargs=lambda t: {'chatroom_name': busiest_group(t)},
+                                   method='post', headers={'HX-Request': 'true'},
+                                   data=lambda t: {'file': SimpleUploadedFile('notes.pdf', b'meeting notes')}),
+        'chat-file-upload-chunk': Budget(9, 100, user=lambda t: t.member, kwargs=lambda t: {'chatroom_name': busiest_group(t)},
+                                         method='post', data=b'meeting notes', content_type='application/octet-stream',
+                                         headers={'Upload-Id': '0' * 32, 'Upload-Name': 'notes.pdf',
+                                                  'Upload-Length': '13', 'Upload-Offset': '0'},
+                                         status=(201,)),
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        # The upload budgets store files
+        cls.media_root = tempfile.mkdtemp(prefix='budget-media-')
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.group = ChatGroup.objects.filter(groupchat_name__isnull=False).annotate(size=Count('members')).order_by('-size').first()
+        cls.member = cls.group.members.exclude(id=cls.group.admin_id).first()
+        cls.stranger = ChatGroup.objects.filter(is_private=True).exclude(members=cls.member).first().members.first()
+
+
+class HistoryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('historian')
+        cls.group = ChatGroup.objects.create(groupchat_name='History')
+        # Pairs of messages share a timestamp, so pages must break ties on id
+        start = timezone.now() - timedelta(days=1)
+        GroupMessage.objects.bulk_create([
+            GroupMessage(group=cls.group, author=author, body=str(i), created=start + timedelta(seconds=i // 2))
+            for i in range(25)
+        ])
+
+    def test_pages_cover_every_message_once_in_order(self):
+        bodies, cursor = [], None
+        while True:
+            page, cursor = history_page(self.group, cursor, page_size=4)
+            bodies = [message.body for message in page] + bodies
+            if cursor is None:
+                break
+        self.assertEqual(bodies, [str(i) for i in range(25)])
+
+    def test_page_query_bounds_created(self):
+        _, cursor = history_page(self.group, page_size=4)
+        with CaptureQueriesContext(connection) as queries:
+            history_page(self.group, cursor, page_size=4)
+        self.assertRegex(queries[0]['sql'], r'"created" <= ')
+
+    def test_bad_cursor_starts_at_the_newest_page(self):
+        newest, _ = history_page(self.group, page_size=4)
+        for cursor in ('junk', '1-2-3', f'{10 ** 30}-1', f'-{10 ** 30}'):
+            self.assertIsNone(decode_cursor(cursor))
+            self.assertEqual(history_page(self.group, cursor, page_size=4)[0], newest)
+
+
+class PrivateChatTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first, cls.second = User.objects.create_user('first'), User.objects.create_user('second')
+
+    def start_chat(self, user, other):
+        self.client.force_login(user)
+        response = self.client.get(reverse('start-chat', args=[other.username]))
+        return ChatGroup.objects.get(group_name=resolve(response.url).kwargs['chatroom_name'])
+
+    def test_one_room_per_pair_whoever_starts_it(self):
+        room = self.start_chat(self.second, self.first)
+        self.assertEqual(self.start_chat(self.first, self.second), room)
+        self.assertEqual(self.start_chat(self.second, self.first), room)
+        low, high = sorted([self.first.id, self.second.id])
+        self.assertEqual(room.private_key, f'{low}:{high}')
+        self.assertEqual(set(room.members.all()), {self.first, self.second})
+        self.assertEqual(ChatGroup.objects.filter(is_private=True).count(), 1)
+
+    def test_merge_keeps_the_oldest_room(self):
+        rooms = [ChatGroup.objects.create(is_private=True) for _ in range(3)]
+        for i, room in enumerate(rooms):
+            room.members.add(self.first, self.second)
+            GroupMessage.objects.create(group=room, author=self.first, body=f'message {i}')
+        rooms[1].users_online.add(self.first)
+        rooms[2].users_online.add(self.first, self.second)
+
+        call_command('merge_private_chats', stdout=io.StringIO())
+
+        kept = ChatGroup.objects.get(is_private=True)
+        self.assertEqual(kept.id, rooms[0].id)
+        low, high = sorted([self.first.id, self.second.id])
+        self.assertEqual(kept.private_key, f'{low}:{high}')
+        self.assertEqual(sorted(kept.chat_messages.values_list('body', flat=True)), ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(set(kept.users_online.all()), {self.first, self.second})
+        # A chat started afterwards lands in the kept room
+        self.assertEqual(self.start_chat(self.second, self.first), kept)
+
+
+class MessageSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('searcher')
+        cls.group = ChatGroup.objects.create(groupchat_name='Search')
+        cls.other_group = ChatGroup.objects.create(groupchat_name='Elsewhere')
+        for group in (cls.group, cls.other_group):
+            for i in range(5):
+                GroupMessage.objects.create(group=group, author=cls.author, body=f'deploying release {i}')
+        GroupMessage.objects.create(group=cls.group, author=cls.author, body='lunch?')
+
+    def bodies(self, query, **kwargs):
+        return [message.body for message in search_messages(self.group, query, **kwargs)[0]]
+
+    def test_finds_stemmed_prefixes_in_one_room_newest_first(self):
+        self.assertEqual(self.bodies('deploy rel'), [f'deploying release {i}' for i in reversed(range(5))])
+        self.assertEqual(self.bodies('lunch'), ['lunch?'])
+        self.assertEqual(self.bodies(''), [])
+
+    def test_pages_with_a_cursor(self):
+        first, cursor = search_messages(self.group, 'release', page_size=3)
+        second, last = search_messages(self.group, 'release', cursor, page_size=3)
+        self.assertEqual([m.body[-1] for m in first + second], ['4', '3', '2', '1', '0'])
+        self.assertIsNone(last)
+
+    def test_edits_and_deletes_update_the_index(self):
+        message = GroupMessage.objects.get(group=self.group, body='lunch?')
+        message.body = 'dinner?'
+        message.save()
+        self.assertEqual(self.bodies('lunch'), [])
+        self.assertEqual(self.bodies('dinner'), ['dinner?'])
+        message.delete()
+        self.assertEqual(self.bodies('dinner'), [])
+
+    def test_merged_messages_are_found_in_the_kept_room(self):
+        other = User.objects.create_user('other')
+        kept, duplicate = (ChatGroup.objects.create(is_private=True) for _ in range(2))
+        for room in (kept, duplicate):
+            room.members.add(self.author, other)
+        GroupMessage.objects.create(group=duplicate, author=other, body='merged reply')
+        call_command('merge_private_chats', stdout=io.StringIO())
+        self.assertEqual([m.body for m in search_messages(kept, 'merged')[0]], ['merged reply'])
+
+
+@override_settings(RTCHAT_COMPACT_PROTOCOL=True)
+class MessageFrameTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('writer')
+        cls.group = ChatGroup.objects.create(groupchat_name='Frames')
+        cls.group.members.add(cls.author)
+        cls.message = GroupMessage.objects.create(group=cls.group, author=cls.author, body='hello')
+
+    def test_socket_gets_author_details_once(self):
+        event = message_event(self.message)
+        sent_authors = set()
+        first = json.loads(pick_message_json(event, sent_authors))
+        second = json.loads(pick_message_json(event, sent_authors))
+        self.assertEqual(first['user']['username'], 'writer')
+        self.assertEqual(second, {
+            'type': 'message', 'id': self.message.id, 'author': self.author.id,
+            'created': int(self.message.created.timestamp() * 1000), 'body': 'hello',
+        })
+
+    @override_settings(RTCHAT_BROADCAST_MODE='per_socket')
+    def test_per_socket_mode_carries_no_frames(self):
+        self.assertIsNone(pick_message_json(message_event(self.message), set()))
+
+    @override_settings(RTCHAT_COMPACT_PROTOCOL=False)
+    def test_html_pages_do_not_pay_for_frames(self):
+        event = message_event(self.message)
+        self.assertNotIn('json', event)
+        # A socket asking for JSON anyway builds its own frame
+        socket = MessageFrames()
+        socket.scope, socket.user = {'query_string': b'protocol=json'}, self.author
+        socket.start_protocol()
+        self.assertIsNone(socket.pick_message(event))
+        self.assertEqual(json.loads(socket.frame_message(self.message, event))['body'], 'hello')
+
+    def test_online_frame_lists_user_ids(self):
+        event = online_count_event(self.group.group_name, {self.author.id})
+        self.assertEqual(json.loads(event['json']), {'type': 'online', 'count': 1, 'ids': [self.author.id]})
+
+    def test_protocol_is_chosen_per_socket(self):
+        event = message_event(self.message)
+        html_socket, json_socket = MessageFrames(), MessageFrames()
+        for socket, query_string in ((html_socket, b''), (json_socket, b'protocol=json')):
+            socket.scope = {'query_string': query_string}
+            socket.user = self.author
+            socket.start_protocol()
+        self.assertEqual(html_socket.pick_message(event), event['html_author'])
+        self.assertEqual(json_socket.pick_message(event), event['json_author'])
+
+
+class FileMetadataTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='metadata-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user('uploader')
+        self.group = ChatGroup.objects.create(groupchat_name='Files')
+
+    def post(self, name, content):
+        message = GroupMessage(group=self.group, author=self.user, file=ContentFile(content, name=name))
+        message.set_file_metadata()
+        message.save()
+        return message
+
+    def photo_bytes(self):
+        image = io.BytesIO()
+        Image.new('RGB', (640, 480), 'blue').save(image, 'PNG')
+        return image.getvalue()
+
+    def metadata(self, message):
+        return (message.file_type, message.file_is_image, message.file_width, message.file_height, message.file_size)
+
+    def test_metadata_is_detected_at_upload(self):
+        photo = self.photo_bytes()
+        self.assertEqual(self.metadata(self.post('photo.jpg', photo)), ('image/png', True, 640, 480, len(photo)))
+        self.assertEqual(self.metadata(self.post('notes.pdf', b'%PDF-1.4')), ('application/pdf', False, None, None, 8))
+        self.assertEqual(self.metadata(self.post('fake.jpg', b'not a jpeg')), ('image/jpeg', False, None, None, 10))
+
+    def test_is_image_reads_the_stored_metadata(self):
+        photo, document = self.post('photo.png', self.photo_bytes()), self.post('notes.pdf', b'%PDF-1.4')
+        photo, document = GroupMessage.objects.get(id=photo.id), GroupMessage.objects.get(id=document.id)
+        with mock.patch('a_rtchat.models.Image.open') as probe:
+            self.assertTrue(photo.is_image)
+            self.assertFalse(document.is_image)
+        probe.assert_not_called()
+
+    def test_backfill_fills_earlier_uploads(self):
+        photo, document = self.post('photo.png', self.photo_bytes()), self.post('notes.pdf', b'%PDF-1.4')
+        gone = self.post('gone.pdf', b'%PDF-1.4')
+        expected = {message.id: self.metadata(message) for message in [photo, document]}
+        GroupMessage.objects.update(file_type=None, file_is_image=False, file_width=None, file_height=None, file_size=None)
+        GroupMessage.objects.filter(id=gone.id).update(file='files/missing.pdf')
+        GroupMessage.objects.create(group=self.group, author=self.user, body='no file')
+
+        # Before the backfill, rows without metadata still probe the file
+        self.assertTrue(GroupMessage.objects.get(id=photo.id).is_image)
+        output = io.StringIO()
+        call_command('backfill_file_metadata', batch_size=1, stdout=output)
+
+        self.assertIn('Updated 2 messages (1 files missing)', output.getvalue())
+        for message in GroupMessage.objects.filter(id__in=expected):
+            self.assertEqual(self.metadata(message), expected[message.id])
+        self.assertIsNone(GroupMessage.objects.get(id=gone.id).file_type)
+
+
+async def not_found(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 418, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+class MediaFilesTests(TransactionTestCase):
+    # MediaFiles in front of a stand-in for Django; access checks run in a
+    # thread, hence TransactionTestCase
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='media-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.app = MediaFiles(not_found, access=media_access)
+
+        self.member, self.outsider = User.objects.create_user('member'), User.objects.create_user('outsider')
+        self.private = ChatGroup.objects.create(is_private=True)
+        self.private.members.add(self.member)
+        public = ChatGroup.objects.create(groupchat_name='Public')
+        self.document = GroupMessage.objects.create(
+            group=public, author=self.member, file=ContentFile(self.content, name='doc.pdf')).file
+        image = io.BytesIO()
+        Image.new('RGB', (800, 600), 'red').save(image, 'JPEG')
+        self.photo = GroupMessage.objects.create(
+            group=self.private, author=self.member, file=ContentFile(image.getvalue(), name='photo.jpg')).file
+
+    def session_cookie(self, user):
+        self.client.force_login(user)
+        return f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    async def get(self, url, headers=None, method='GET'):
+        path, _, query_string = url.partition('?')
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': query_string.encode(),
+            'headers': [(name.encode(), value.encode()) for name, value in (headers or {}).items()],
+        }
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+        return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+    async def test_ranges_and_conditional_requests(self):
+        path = self.document.url.partition('?')[0]
+        status, headers, body = await self.get(path)
+        self.assertEqual((status, body), (200, self.content))
+        etag = headers['etag']
+
+        status, headers, body = await self.get(path, {'range': 'bytes=10-19'})
+        self.assertEqual((status, headers['content-range'], body), (206, 'bytes 10-19/1024', self.content[10:20]))
+        self.assertEqual((await self.get(path, {'range': 'bytes=-5'}))[2], self.content[-5:])
+        self.assertEqual((await self.get(path, {'range': 'bytes=2000-'}))[0], 416)
+        # A range for an older version of the file gets the whole file
+        self.assertEqual((await self.get(path, {'range': 'bytes=0-1', 'if-range': '"old"'}))[2], self.content)
+        self.assertEqual((await self.get(path, {'if-none-match': etag}))[0], 304)
+
+        status, headers, body = await self.get(path, method='HEAD')
+        self.assertEqual((status, headers['content-length'], body), (200, '1024', b''))
+        self.assertEqual((await self.get(path, method='POST'))[0], 405)
+
+    async def test_versioned_urls_are_immutable(self):
+        _, headers, _ = await self.get(self.document.url)
+        self.assertIn('immutable', headers['cache-control'])
+        _, headers, _ = await self.get(self.document.url.partition('?')[0] + '?v=stale')
+        self.assertNotIn('immutable', headers['cache-control'])
+
+    async def test_private_attachments_and_thumbnails_go_to_members_only(self):
+        thumbnail = await database_sync_to_async(get_derivative)(self.photo, 'chat')
+        paths = ['/media/' + self.photo.name, '/media/' + thumbnail]
+        outsider = await database_sync_to_async(self.session_cookie)(self.outsider)
+        member = await database_sync_to_async(self.session_cookie)(self.member)
+        for path in paths:
+            self.assertEqual((await self.get(path))[0], 404)
+            self.assertEqual((await self.get(path, {'cookie': outsider}))[0], 404)
+            status, headers, _ = await self.get(path, {'cookie': member})
+            self.assertEqual(status, 200)
+            self.assertTrue(headers['cache-control'].startswith('private'))
+            self.assertEqual(headers['vary'], 'Cookie')
+
+    async def test_paths_outside_stored_names_are_refused(self):
+        with open(os.path.join(settings.MEDIA_ROOT, 'files', 'orphan.pdf'), 'wb') as f:
+            f.write(b'no message holds this')
+        for path in ('/media/files/orphan.pdf', '/media/cas/', '/media/files/../../x', '/media/.env',
+                     '/media/uploads/partial/x', '/media/files/missing.pdf'):
+            self.assertEqual((await self.get(path))[0], 404, path)
+        self.assertEqual((await self.get('/static/app.css'))[0], 418)
+
+
+class GatedStream:
+    # A request body whose first read waits for `gate`
+    def __init__(self, data, gate):
+        self.body = io.BytesIO(data)
+        self.gate = gate
+        self.reading = threading.Event()
+
+    def read(self, size):
+        self.reading.set()
+        self.gate.wait(5)
+        return self.body.read(size)
+
+
+@override_settings(CHAT_UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(TestCase):
+    upload_id = 'a' * 32
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('uploader')
+        cls.group = ChatGroup.objects.create(groupchat_name='Uploads')
+        cls.group.members.add(cls.user)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp(prefix='upload-test-')
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.partial_dir = os.path.join(media_root, 'uploads', 'partial')
+        self.client.force_login(self.user)
+        self.url = reverse('chat-file-upload-chunk', args=[self.group.group_name])
+
+    def send(self, data, offset, length=10, name='notes.pdf', upload_id=None):
+        return self.client.post(self.url, data, content_type='application/octet-stream', headers={
+            'Upload-Id': upload_id or self.upload_id, 'Upload-Name': name,
+            'Upload-Length': str(length), 'Upload-Offset': str(offset),
+        })
+
+    def test_resumes_from_the_reported_offset(self):
+        self.assertEqual(self.send(b'0123', 0).json(), {'offset': 4, 'complete': False})
+        # A chunk after a lost one, and a retry of one that did arrive
+        self.assertEqual(self.send(b'89', 8).json()['offset'], 4)
+        self.assertEqual(self.client.get(self.url, {'id': self.upload_id}).json(), {'offset': 4, 'length': 10})
+        self.send(b'4567', 4)
+        response = self.send(b'4567', 4)
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 8))
+
+        response = self.send(b'89', 8)
+        self.assertEqual(response.status_code, 201)
+        message = GroupMessage.objects.get(group=self.group)
+        with message.file.open('rb') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        self.assertEqual(os.listdir(self.partial_dir), [])
+
+    def test_refused_uploads_leave_nothing_behind(self):
+        self.assertEqual(self.send(b'01234', 0).status_code, 413)
+        self.assertEqual(self.send(b'0123', 0, name='tool.exe').status_code, 415)
+        self.assertEqual(self.send(b'0123', 0, length=100 * 1024 * 1024).status_code, 413)
+        self.assertFalse(os.path.exists(self.partial_dir) and os.listdir(self.partial_dir))
+        # None of them counts towards CHAT_UPLOAD_MAX_PARTIAL
+        for i in range(3):
+            self.assertEqual(self.send(b'0123', 0, upload_id=str(i) * 32).status_code, 200)
+        self.assertEqual(self.send(b'0123', 0, upload_id='f' * 32).status_code, 429)
+
+    def test_bad_content_length_is_a_client_error(self):
+        chunk = self.client.post(self.url, b'0123', content_type='application/octet-stream', CONTENT_LENGTH='four',
+                                 headers={'Upload-Id': self.upload_id, 'Upload-Name': 'notes.pdf',
+                                          'Upload-Length': '10', 'Upload-Offset': '0'})
+        self.assertEqual(chunk.status_code, 400)
+        multipart = self.client.post(reverse('chat-file-upload', args=[self.group.group_name]),
+                                     {'file': SimpleUploadedFile('notes.pdf', b'notes')}, CONTENT_LENGTH='lots',
+                                     headers={'HX-Request': 'true'})
+        self.assertEqual(multipart.status_code, 400)
+
+    def test_racing_retry_is_not_appended_twice(self):
+        upload = ChunkedUpload(self.user, self.upload_id)
+        upload.start('notes.pdf', 10, 4)
+        gate, results = threading.Event(), []
+
+        def append(stream):
+            try:
+                results.append(upload.append(stream, 0, 4, self.group))
+            except UploadRejected as error:
+                results.append((error.status, error.offset))
+
+        original = GatedStream(b'0123', gate)
+        first = threading.Thread(target=append, args=(original,))
+        first.start()
+        original.reading.wait(5)
+        retry = threading.Thread(target=append, args=(io.BytesIO(b'0123'),))
+        retry.start()
+        time.sleep(0.1)
+        gate.set()
+        first.join()
+        retry.join()
+        self.assertEqual(results, [(4, False), (409, 4)])
+        self.assertEqual(upload.offset, 4)
+
+
+# The writer inserts from its own thread, on its own connection
+@override_settings(RTCHAT_WRITE_BEHIND=True, RTCHAT_WRITE_BEHIND_BATCH_SIZE=5)
+class WriteBehindTests(TransactionTestCase):
+
+    def setUp(self):
+        self.author = User.objects.create_user('sender')
+        self.group = ChatGroup.objects.create(groupchat_name='Write-behind')
+
+    def message(self, body):
+        return GroupMessage(group=self.group, author=self.author, body=body)
+
+    def test_reserved_ids_are_skipped_by_ordinary_inserts(self):
+        before = GroupMessage.objects.create(group=self.group, author=self.author, body='before')
+        reserved = reserve_ids(GroupMessage, 3)
+        after = GroupMessage.objects.create(group=self.group, author=self.author, body='after')
+        self.assertEqual(reserved, [before.id + 1, before.id + 2, before.id + 3])
+        self.assertGreater(after.id, reserved[-1])
+
+    @override_settings(RTCHAT_WRITE_BEHIND_DURABILITY='commit')
+    def test_durable_message_is_stored_when_its_future_resolves(self):
+        writer = MessageWriter()
+        self.addCleanup(writer.stop)
+        message = self.message('hello')
+        future = writer.submit(message)
+        # The id is known before the insert, so the broadcast can carry it
+        self.assertIsNotNone(message.id)
+        self.assertTrue(future.result(5))
+        self.assertEqual(GroupMessage.objects.get(id=message.id).body, 'hello')
+
+    @override_settings(RTCHAT_WRITE_BEHIND_MAX_DELAY=60)
+    def test_stop_flushes_buffered_messages(self):
+        writer = MessageWriter()
+        messages = [self.message(str(i)) for i in range(7)]
+        futures = [writer.submit(message) for message in messages]
+        writer.stop()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(
+            sorted(GroupMessage.objects.filter(group=self.group).values_list('id', flat=True)),
+            sorted(message.id for message in messages),
+        )
+
+    @override_settings(RTCHAT_WRITE_BEHIND_MAX_DELAY=60)
+    def test_ids_are_reserved_outside_the_lock(self):
+        writer = MessageWriter()
+        free = []
+
+        def take_lock():
+            acquired = writer._cond.acquire(timeout=1)
+            if acquired:
+                writer._cond.release()
+            free.append(acquired)
+
+        def reserve(model, count):
+            # Another thread can take the lock while the block is reserved
+            probe = threading.Thread(target=take_lock)
+            probe.start()
+            probe.join()
+            # One id per block, so every message reserves
+            return reserve_ids(model, 1)
+
+        with mock.patch('a_rtchat.writebehind.reserve_ids', side_effect=reserve):
+            messages = [self.message(str(i)) for i in range(3)]
+            for message in messages:
+                writer.submit(message)
+        writer.stop()
+        self.assertEqual(free, [True, True, True])
+        self.assertEqual(GroupMessage.objects.filter(id__in=[message.id for message in messages]).count(), 3)
+
+    def test_exit_flush_is_registered_once(self):
+        writer = MessageWriter()
+        with mock.patch('a_rtchat.writebehind.atexit.register') as register:
+            for body in ['first', 'second']:
+                writer.submit(self.message(body)).result(5)
+                writer.stop()
+        register.assert_called_once_with(writer.stop)
+
+
+class QuietPresence(Presence):
+    # No background loops or count broadcasts: the tests drive reap and
+    # flush themselves
+    def ensure_started(self):
+        pass
+
+    def changed(self, room):
+        self.dirty.add(room)
+
+
+def online_rows(group):
+    return set(ChatGroup.users_online.through.objects.filter(chatgroup=group).values_list('user_id', flat=True))
+
+
+# Database access from async tests needs TransactionTestCase: a TestCase
+# transaction does not survive database_sync_to_async closing connections
+class PresenceTests(TransactionTestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'presence{i}') for i in range(3)]
+        self.group = ChatGroup.objects.create(groupchat_name='Presence')
+        self.other_group = ChatGroup.objects.create(groupchat_name='Quiet')
+        self.room = self.group.group_name
+        self.presence = QuietPresence()
+
+    async def test_tabs_of_one_user_count_once(self):
+        user_id = self.users[0].id
+        await self.presence.join(self.room, user_id, 'tab-1')
+        await self.presence.join(self.room, user_id, 'tab-2')
+        self.assertEqual(self.presence.count(self.room), 1)
+        await self.presence.leave('tab-1')
+        self.assertEqual(self.presence.online(self.room), {user_id})
+        await self.presence.leave('tab-2')
+        await self.presence.leave('tab-2')
+        self.assertEqual(self.presence.count(self.room), 0)
+        self.assertIn(self.room, self.presence.dirty)
+
+    async def test_reap_closes_stale_sockets(self):
+        channel_layer = get_channel_layer()
+        stale, live = await channel_layer.new_channel(), await channel_layer.new_channel()
+        await self.presence.join(self.room, self.users[0].id, stale)
+        await self.presence.join(self.room, self.users[1].id, live)
+        self.presence.sockets[stale]['last_seen'] = time.monotonic() - self.presence.idle_timeout - 1
+
+        result = await self.presence.reap()
+
+        self.assertEqual(result['connections'], 1)
+        self.assertEqual(self.presence.online(self.room), {self.users[1].id})
+        self.assertEqual((await channel_layer.receive(stale))['type'], 'heartbeat_expired')
+        self.assertEqual(await database_sync_to_async(online_rows)(self.group), {self.users[1].id})
+
+    async def test_only_repair_removes_rows_of_quiet_rooms(self):
+        ghost = self.users[2].id
+        await database_sync_to_async(self.other_group.users_online.add)(ghost)
+        await database_sync_to_async(self.group.users_online.add)(ghost)
+        await self.presence.join(self.room, self.users[0].id, 'local')
+        # A user connected to another worker
+        self.presence.receive_state({
+            'type': 'presence.state', 'node': 'worker-2', 'full': True, 'rooms': {self.room: [self.users[1].id]},
+        })
+
+        await self.presence.reap()
+        self.assertEqual(await database_sync_to_async(online_rows)(self.group), {self.users[0].id, self.users[1].id})
+        self.assertEqual(await database_sync_to_async(online_rows)(self.other_group), {ghost})
+
+        await self.presence.reap(repair=True)
+        self.assertEqual(await database_sync_to_async(online_rows)(self.other_group), set())
+
+    async def test_collect_presence_hears_running_workers(self):
+        worker = QuietPresence()
+        await worker.join(self.room, self.users[0].id, 'worker-socket')
+        sync = asyncio.ensure_future(worker._sync_loop())
+        try:
+            while worker._sync_channel is None:
+                await asyncio.sleep(0.01)
+            snapshot, workers = await collect_presence(0.3)
+        finally:
+            sync.cancel()
+        self.assertEqual(workers, 1)
+        self.assertEqual(snapshot, {self.room: {self.users[0].id}})
+
+    def test_reap_presence_without_workers_clears_rows(self):
+        self.group.users_online.add(*self.users)
+        call_command('reap_presence', wait=0.1, stdout=open(os.devnull, 'w'))
+        self.assertEqual(online_rows(self.group), set())
+
+
+def chat_socket(consumer, user, room, query=''):
+    application = URLRouter([path('ws/chatroom/<str:chatroom_name>', consumer.as_asgi())])
+    communicator = WebsocketCommunicator(application, f'/ws/chatroom/{room}{query}')
+    communicator.scope['user'] = user
+    return communicator
+
+
+def laps(event, phase):
+    series = event_seconds.series.get((event, phase))
+    return series[2] if series else 0
+
+
+def gauge(metric):
+    return {labels: value for _, labels, value in metric.samples()}
+
+
+class ConsumerMetricsTests(TransactionTestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'timed{i}') for i in range(2)]
+        self.group = ChatGroup.objects.create(groupchat_name='Timed')
+        self.room = self.group.group_name
+        self.presence = QuietPresence()
+        for module in ['a_rtchat.consumers', 'a_rtchat.metrics']:
+            patcher = mock.patch(f'{module}.presence', self.presence)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def check_laps(self, consumer, receive_phases):
+        phases = {
+            'connect': ['lookup', 'group_add', 'presence', 'accept', 'total'],
+            'receive': receive_phases + ['total'],
+            'message_handler': ['render', 'send', 'total'],
+        }
+        before = {(event, phase): laps(event, phase) for event, names in phases.items() for phase in names}
+        socket = chat_socket(consumer, self.users[0], self.room)
+        self.assertTrue((await socket.connect())[0])
+        await socket.send_json_to({'body': 'timed'})
+        await socket.receive_from()
+        await socket.disconnect()
+        for (event, phase), count in before.items():
+            self.assertEqual(laps(event, phase), count + 1, (event, phase))
+
+    async def test_sync_consumer_times_each_phase(self):
+        await self.check_laps(ChatroomConsumer, ['parse', 'insert', 'render', 'group_send'])
+
+    async def test_async_consumer_times_each_phase(self):
+        await self.check_laps(AsyncChatroomConsumer, ['parse', 'insert', 'group_send'])
+
+    async def test_pong_is_not_timed_as_a_message(self):
+        socket = chat_socket(AsyncChatroomConsumer, self.users[0], self.room)
+        await socket.connect()
+        parsed = laps('receive', 'parse')
+        await socket.send_json_to({'type': 'pong'})
+        await socket.disconnect()
+        self.assertEqual(laps('receive', 'parse'), parsed)
+
+    async def test_room_sockets_follow_connections(self):
+        sockets = [chat_socket(AsyncChatroomConsumer, user, self.room) for user in self.users]
+        for socket in sockets:
+            await socket.connect()
+        self.assertEqual(gauge(room_sockets)[f'{{room="{self.room}"}}'], 2)
+        await sockets[0].disconnect()
+        self.assertEqual(gauge(room_sockets)[f'{{room="{self.room}"}}'], 1)
+        await sockets[1].disconnect()
+        self.assertNotIn(f'{{room="{self.room}"}}', gauge(room_sockets))
+
+    async def test_queue_gauges_count_undelivered_messages(self):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        queued = gauge(queued_messages)['']
+        for number in range(3):
+            await channel_layer.send(channel, {'type': 'message_handler', 'number': number})
+        self.assertEqual(gauge(queued_messages)[''], queued + 3)
+        self.assertGreaterEqual(gauge(max_queue_depth)[''], 3)
+        for _ in range(3):
+            await channel_layer.receive(channel)
+        self.assertEqual(gauge(queued_messages)[''], queued)
+
+
+class ConsumerTests:
+    # The chat protocol, run against each consumer class
+
+    def setUp(self):
+        self.author, self.reader = User.objects.create_user('talker'), User.objects.create_user('listener')
+        self.group = ChatGroup.objects.create(groupchat_name='Talk')
+        self.room = self.group.group_name
+        self.presence = QuietPresence()
+        for module in ['a_rtchat.consumers', 'a_rtchat.metrics']:
+            patcher = mock.patch(f'{module}.presence', self.presence)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def connect(self, user, query=''):
+        socket = chat_socket(self.consumer, user, self.room, query)
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        return socket
+
+    async def exchange(self):
+        # The author's and another member's html sockets and a compact one;
+        # returns what each received for one message and how many bubbles
+        # the consumers rendered themselves
+        sockets = [await self.connect(self.author), await self.connect(self.reader),
+                   await self.connect(self.reader, '?protocol=json')]
+        with mock.patch('a_rtchat.consumers.render_message', wraps=render_message) as rendered:
+            await sockets[0].send_json_to({'body': 'hello there'})
+            received = [await socket.receive_from() for socket in sockets]
+        for socket in sockets:
+            await socket.disconnect()
+        return received, rendered.call_count
+
+    def check_bubbles(self, received):
+        own, other, compact = received
+        self.assertIn('justify-end', own)
+        self.assertNotIn('justify-start', own)
+        self.assertIn('justify-start', other)
+        self.assertIn('hello there', other)
+        frame = json.loads(compact)
+        self.assertEqual((frame['body'], frame['author'], frame['user']['username']), ('hello there', self.author.id, 'talker'))
+
+    async def test_render_once_picks_the_authors_bubble(self):
+        received, rendered = await self.exchange()
+        self.check_bubbles(received)
+        self.assertEqual(rendered, 0)
+        self.assertEqual(await database_sync_to_async(GroupMessage.objects.filter(group=self.group).count)(), 1)
+
+    @override_settings(RTCHAT_BROADCAST_MODE='per_socket')
+    async def test_per_socket_renders_in_each_consumer(self):
+        received, rendered = await self.exchange()
+        self.check_bubbles(received)
+        self.assertEqual(rendered, 2)
+
+    async def test_pong_only_marks_the_socket_alive(self):
+        socket = await self.connect(self.author)
+        [state] = self.presence.sockets.values()
+        state['last_seen'] -= 60
+        seen = state['last_seen']
+        await socket.send_json_to({'type': 'pong'})
+        self.assertTrue(await socket.receive_nothing())
+        self.assertGreater(state['last_seen'], seen)
+        self.assertFalse(await database_sync_to_async(GroupMessage.objects.exists)())
+        await socket.disconnect()
+        self.assertEqual(self.presence.sockets, {})
+
+    async def test_heartbeat_pings_and_closes_expired_sockets(self):
+        socket = await self.connect(self.author)
+        [channel] = self.presence.sockets
+        await get_channel_layer().send(channel, {'type': 'heartbeat_handler'})
+        self.assertEqual(await socket.receive_json_from(), {'type': 'ping'})
+        await get_channel_layer().send(channel, {'type': 'heartbeat_expired'})
+        self.assertEqual((await socket.receive_output())['type'], 'websocket.close')
+
+
+class ChatroomConsumerTests(ConsumerTests, TransactionTestCase):
+    consumer = ChatroomConsumer
+
+    async def test_missing_room_is_a_404(self):
+        with self.assertRaises(Http404):
+            await chat_socket(self.consumer, self.author, 'no-such-room').connect()
+        self.assertEqual(self.presence.sockets, {})
+
+
+class AsyncChatroomConsumerTests(ConsumerTests, TransactionTestCase):
+    consumer = AsyncChatroomConsumer
+
+    async def test_missing_room_closes_the_socket(self):
+        connected, code = await chat_socket(self.consumer, self.author, 'no-such-room').connect()
+        self.assertEqual((connected, code), (False, 1000))
+        self.assertEqual(self.presence.sockets, {})
@@ -0,0 +1,219 @@
+import fcntl
+import json
+import os
+import re
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from a_users.constants import MAX_FILE_SIZE
+from .broadcast import message_event
+from .models import GroupMessage
+from .validators import validate_file_name, validate_file_size
+
+# Multipart boundaries and headers around the one file field
+MULTIPART_OVERHEAD = 64 * 1024
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadRejected(Exception):
+
+    def __init__(self, message, status, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.offset = offset
+
+
+def rejected(error, status):
+    return UploadRejected(' '.join(error.messages), status)
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    # Goes first in request.upload_handlers. Refuses a file of a type we do
+    # not share as soon as its part headers arrive, and stops reading once
+    # MAX_FILE_SIZE bytes have come in. Chunks are passed on untouched to the
+    # default handlers, so memory and temp-disk use stay what they are for
+    # any upload below the limit. The reason is left in `error` for the view.
+
+    def __init__(self, request=None, max_size=MAX_FILE_SIZE):
+        super().__init__(request)
+        self.max_size = max_size
+        self.received = 0
+        self.error = None
+
+    def reject(self, error, status):
+        self.error = rejected(error, status)
+        raise StopUpload(connection_reset=True)
+
+    def refuses(self, content_length):
+        # For the view to call first: a body that cannot fit is refused
+        # before any of it is read
+        if content_length > self.max_size + MULTIPART_OVERHEAD:
+            self.error = rejected(ValidationError(f'File size cannot exceed {self.max_size // (1024 * 1024)}MB.'), 413)
+        return self.error is not None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        try:
+            validate_file_name(file_name)
+        except ValidationError as error:
+            self.reject(error, 415)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_size:
+            self.reject(ValidationError(f'File size cannot exceed {self.max_size // (1024 * 1024)}MB.'), 413)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def post_file_message(chat_group, user, file):
+    message = GroupMessage(
+        file = file,
+        author = user,
+        group = chat_group,
+    )
+    message.set_file_metadata()
+    message.save()
+    async_to_sync(get_channel_layer().group_send)(chat_group.group_name, message_event(message))
+    return message
+
+
+class ChunkedUpload:
+    # A resumable upload sent as a series of raw-body requests (see
+    # views.chat_file_upload_chunk). Bytes go to a partial file under
+    # MEDIA_ROOT/uploads/partial, named after the user and a client-chosen
+    # id, with the file name and total length in a .json file next to it;
+    # both live on disk, so any worker can take the next chunk. Name, type
+    # and total size are checked before the first byte is stored.
+
+    def __init__(self, user, upload_id):
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise UploadRejected('Missing or malformed Upload-Id.', 400)
+        self.user = user
+        self.directory = os.path.join(settings.MEDIA_ROOT, 'uploads', 'partial')
+        self.path = os.path.join(self.directory, f'{user.pk}-{upload_id}')
+        self.info_path = self.path + '.json'
+
+    @property
+    def chunk_size(self):
+        return getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def info(self):
+        try:
+            with open(self.info_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def check_chunk(self, length, current, chunk):
+        if chunk > self.chunk_size or current + chunk > length:
+            raise UploadRejected('Chunk too large.', 413)
+
+    def start(self, name, length, chunk):
+        # `chunk` is the length of the first chunk, checked before anything
+        # is stored so a refused upload leaves nothing behind
+        try:
+            validate_file_name(name)
+        except ValidationError as error:
+            raise rejected(error, 415)
+        try:
+            validate_file_size(length)
+        except ValidationError as error:
+            raise rejected(error, 413)
+        self.check_chunk(length, 0, chunk)
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove_stale()
+        in_progress = [entry for entry in os.listdir(self.directory)
+                       if entry.startswith(f'{self.user.pk}-') and entry.endswith('.json')]
+        if len(in_progress) >= getattr(settings, 'CHAT_UPLOAD_MAX_PARTIAL', 3):
+            raise UploadRejected('Too many uploads in progress.', 429)
+        with open(self.info_path, 'w') as f:
+            json.dump({'name': os.path.basename(name), 'length': length}, f)
+        # Never truncates: a retried first chunk may be racing the original
+        open(self.path, 'ab').close()
+        return self.info()
+
+    def append(self, stream, offset, length, chat_group):
+        # Returns (new offset, complete); the message is posted with the
+        # last byte. A chunk at the wrong offset (a retry of one that did
+        # arrive, or one after a lost chunk) is refused with 409, and the
+        # client resumes from the offset it gets back. An exclusive lock on
+        # the partial file spans the offset check, the write and the
+        # finish, so a retry racing its original is neither appended nor
+        # posted twice.
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            raise UploadRejected('Unknown upload.', 404)
+        with os.fdopen(fd, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            info = self.info()
+            stat = os.fstat(f.fileno())
+            if info is None or stat.st_nlink == 0:
+                # Finished or discarded while this request waited
+                raise UploadRejected('Unknown upload.', 404)
+            current = stat.st_size
+            if offset != current:
+                raise UploadRejected('Chunk is not at the upload offset.', 409, offset=current)
+            self.check_chunk(info['length'], current, length)
+            written = 0
+            while written < length:
+                data = stream.read(min(64 * 1024, length - written))
+                if not data:
+                    break
+                f.write(data)
+                written += len(data)
+            f.flush()
+            if written != length:
+                # The client went away mid-chunk; drop the partial chunk
+                f.truncate(current)
+                raise UploadRejected('Incomplete chunk.', 400)
+            if current + written < info['length']:
+                return current + written, False
+            self.finish(chat_group, info)
+            return current + written, True
+
+    def finish(self, chat_group, info):
+        with open(self.path, 'rb') as f:
+            message = post_file_message(chat_group, self.user, File(f, name=info['name']))
+        self.discard()
+        return message
+
+    def discard(self):
+        for path in (self.path, self.info_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove_stale(self):
+        # Abandoned uploads are dropped once nothing was added for a day
+        cutoff = time.time() - getattr(settings, 'CHAT_UPLOAD_PARTIAL_TTL', 24 * 3600)
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                continue
+            try:
+                stale = entry.stat().st_mtime < cutoff
+            except FileNotFoundError:
+                continue
+            if stale:
+                for path in (entry.path, entry.path + '.json'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
@@ -5,8 +5,11 @@ urlpatterns = [
     path('', chat_view, name="home"),
     path('chat/<username>', get_or_create_chatroom, name="start-chat"),
     path('chat/room/<chatroom_name>', chat_view, name="chatroom"),
+    path('chat/history/<chatroom_name>', chat_history, name="chat-history"),
+    path('chat/search/<chatroom_name>', chat_search, name="chat-search"),
     path('chat/new_groupchat/', create_groupchat, name="new-groupchat"),
     path('chat/edit/<chatroom_name>', chatroom_edit_view, name="edit-chatroom"),
     path('chat/delete/<chatroom_name>', chatroom_delete_view, name="chatroom-delete"),
     path('chat/fileupload/<chatroom_name>', chat_file_upload, name="chat-file-upload"),
+    path('chat/fileupload/<chatroom_name>/chunk', chat_file_upload_chunk, name="chat-file-upload-chunk"),
 ]
\ No newline at end of file
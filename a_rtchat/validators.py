@@ -0,0 +1,16 @@
+import os
+from django.core.exceptions import ValidationError
+from a_users.constants import MAX_FILE_SIZE, ALLOWED_IMAGE_TYPES, ALLOWED_DOCUMENT_TYPES, ALLOWED_VIDEO_TYPES
+
+ALLOWED_EXTENSIONS = set(ALLOWED_IMAGE_TYPES + ALLOWED_DOCUMENT_TYPES + ALLOWED_VIDEO_TYPES)
+
+
+def validate_file_name(name):
+    extension = os.path.splitext(name or '')[1].lstrip('.').lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise ValidationError(f"{extension or 'This'} files cannot be shared. Allowed: {', '.join(sorted(ALLOWED_EXTENSIONS))}.")
+
+
+def validate_file_size(size):
+    if size > MAX_FILE_SIZE:
+        raise ValidationError(f"File size cannot exceed {MAX_FILE_SIZE // (1024 * 1024)}MB.")
@@ -1,37 +1,45 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from channels.layers import get_channel_layer
 from django.contrib import messages
-from asgiref.sync import async_to_sync
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.http import Http404
+from django.db import transaction
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from urllib.parse import unquote
 from .models import *
 from .forms import *
+from .history import history_page
+from .search import search_messages
+from .sidebar import chat_sidebar
+from .uploads import ChunkedUpload, LimitedUploadHandler, UploadRejected, post_file_message
 
 # Create your views here.
 @login_required
 def chat_view(request, chatroom_name='public-chat'):
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    chat_messages = chat_group.chat_messages.all()[:30]
+    chat_group = get_object_or_404(ChatGroup.objects.select_related('admin'), group_name=chatroom_name)
     form = ChatmessageCreateForm()
 
     other_user = None
+    # Only private and named group chats list their members; the public
+    # room can have thousands, so it never loads them
+    members = []
+    if chat_group.is_private or chat_group.groupchat_name:
+        members = list(chat_group.members.select_related('profile'))
 
     if chat_group.is_private:
-        if request.user not in chat_group.members.all():
+        if request.user not in members:
             raise Http404()
-        for member in chat_group.members.all():
+        for member in members:
             if member != request.user:
                 other_user = member
                 break
 
-    private_chats = request.user.chat_groups.filter(is_private=True)
-    group_chats = request.user.chat_groups.filter(is_private=False)
-
     if chat_group.groupchat_name:
-        if request.user not in chat_group.members.all():
+        if request.user not in members:
             if request.user.emailaddress_set.filter(verified=True).exists():
                 chat_group.members.add(request.user)
+                members.append(request.user)
             else:
                 messages.warning(request, 'You need to verify your email to join the chat!')
                 return redirect('profile-settings')
@@ -49,38 +57,77 @@ def chat_view(request, chatroom_name='public-chat'):
                 'user' : request.user
             }
             return render(request, 'a_rtchat/partials/chat_message_p.html', context)
+
+    chat_messages, next_cursor = history_page(chat_group)
+    private_chats, group_chats = chat_sidebar(request.user)
         
     context = {
         'chat_messages': chat_messages,
+        'next_cursor': next_cursor,
         'form': form,
         'other_user': other_user,
         'chatroom_name': chatroom_name,
         'chat_group': chat_group,
+        'members': members,
         'private_chats': private_chats,
-        'group_chats': group_chats
+        'group_chats': group_chats,
+        'upload_chunk_size': getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024),
+        'compact_protocol': getattr(settings, 'RTCHAT_COMPACT_PROTOCOL', False),
     }
  
     return render(request, 'a_rtchat/chat.html', context)
 
+@login_required
+def chat_history(request, chatroom_name):
+    # Older messages for infinite scroll, one keyset page per request
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if chat_group.is_private or chat_group.groupchat_name:
+        if not chat_group.members.filter(pk=request.user.pk).exists():
+            raise Http404()
+
+    chat_messages, next_cursor = history_page(chat_group, request.GET.get('cursor'))
+    context = {
+        'chat_messages': chat_messages,
+        'next_cursor': next_cursor,
+        'chat_group': chat_group,
+        'user': request.user,
+    }
+    return render(request, 'a_rtchat/partials/chat_history.html', context)
+
+@login_required
+def chat_search(request, chatroom_name):
+    # Full-text search within one room, newest matches first
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if chat_group.is_private or chat_group.groupchat_name:
+        if not chat_group.members.filter(pk=request.user.pk).exists():
+            raise Http404()
+
+    query = request.GET.get('q', '').strip()
+    results, next_cursor = search_messages(chat_group, query, request.GET.get('cursor'))
+    context = {
+        'results': results,
+        'next_cursor': next_cursor,
+        'query': query,
+        'chat_group': chat_group,
+    }
+    return render(request, 'a_rtchat/partials/search_results.html', context)
+
 @login_required
 def get_or_create_chatroom(request, username):
     if request.user.username == username:
         return redirect('home')
 
-    other_user = User.objects.get(username = username)
-    my_chatrooms = request.user.chat_groups.filter(is_private=True)
+    other_user = get_object_or_404(User, username=username)
+    private_key = ChatGroup.private_key_for(request.user, other_user)
 
-    if my_chatrooms.exists():
-        for chatroom in my_chatrooms:
-            if other_user in chatroom.members.all():
-                chatroom = chatroom
-                break
-            else:
-                chatroom = ChatGroup.objects.create(is_private = True)
-                chatroom.members.add(other_user, request.user)
-    else:
-        chatroom = ChatGroup.objects.create(is_private = True)
-        chatroom.members.add(other_user, request.user)
+    # Room and members are committed together; a concurrent request that
+    # loses the race on the unique key picks up the finished room
+    with transaction.atomic():
+        chatroom, created = ChatGroup.objects.get_or_create(
+            private_key=private_key, defaults={'is_private': True}
+        )
+        if created:
+            chatroom.members.add(other_user, request.user)
         
     return redirect('chatroom', chatroom.group_name)
 
@@ -102,7 +149,9 @@ def create_groupchat(request):
 
 @login_required
 def chatroom_edit_view(request, chatroom_name):
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    chat_group = get_object_or_404(
+        ChatGroup.objects.select_related('admin').prefetch_related('members__profile'), group_name=chatroom_name
+    )
     if request.user != chat_group.admin:
         raise Http404()
     
@@ -114,9 +163,7 @@ def chatroom_edit_view(request, chatroom_name):
             form.save()
             
             remove_members = request.POST.getlist('remove_members')
-            for member_id in remove_members:
-                member = User.objects.get(id=member_id)
-                chat_group.members.remove(member)  
+            chat_group.members.remove(*User.objects.filter(id__in=remove_members))
                 
             return redirect('chatroom', chatroom_name) 
 
@@ -130,7 +177,7 @@ def chatroom_edit_view(request, chatroom_name):
 
 @login_required
 def chatroom_delete_view(request, chatroom_name):
-    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    chat_group = get_object_or_404(ChatGroup.objects.select_related('admin'), group_name=chatroom_name)
     if request.user != chat_group.admin:
         raise Http404()
     
@@ -142,26 +189,78 @@ def chatroom_delete_view(request, chatroom_name):
     return render(request, 'a_rtchat/chatroom_delete.html', {'chat_group':chat_group})
 
 
+@csrf_exempt
+@login_required
 def chat_file_upload(request, chatroom_name):
+    # The size and type checks have to be in place before anything reads
+    # request.POST, CSRF checking included, so CSRF is checked below instead
+    handler = LimitedUploadHandler(request)
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return HttpResponse('Invalid Content-Length.', status=400)
+    if handler.refuses(content_length):
+        return HttpResponse(handler.error.message, status=handler.error.status)
+    request.upload_handlers.insert(0, handler)
+    return receive_file_upload(request, chatroom_name, handler)
+
+
+@csrf_protect
+def receive_file_upload(request, chatroom_name, handler):
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
-    
-    if request.htmx and request.FILES:
-        file = request.FILES['file']
-        message = GroupMessage.objects.create(
-            file = file,
-            author = request.user, 
-            group = chat_group,
-        )
-        channel_layer = get_channel_layer()
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-        }
-        async_to_sync(channel_layer.group_send)(
-            chatroom_name, event
-        )
+    if chat_group.is_private or chat_group.groupchat_name:
+        if not chat_group.members.filter(pk=request.user.pk).exists():
+            raise Http404()
+
+    if request.htmx and request.method == 'POST':
+        files = request.FILES
+        if handler.error is not None:
+            return HttpResponse(handler.error.message, status=handler.error.status)
+        if 'file' in files:
+            post_file_message(chat_group, request.user, files['file'])
     return HttpResponse()
 
+
+@login_required
+def chat_file_upload_chunk(request, chatroom_name):
+    # Resumable upload, one raw-body request per chunk. GET ?id= returns how
+    # much of an upload has arrived; POST sends the chunk at Upload-Offset,
+    # with Upload-Id, Upload-Name and Upload-Length describing the file. The
+    # message is posted when the last byte is in.
+    chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
+    if chat_group.is_private or chat_group.groupchat_name:
+        if not chat_group.members.filter(pk=request.user.pk).exists():
+            raise Http404()
+
+    try:
+        if request.method == 'GET':
+            upload = ChunkedUpload(request.user, request.GET.get('id'))
+            info = upload.info()
+            if info is None:
+                raise UploadRejected('Unknown upload.', 404)
+            return JsonResponse({'offset': upload.offset, 'length': info['length']})
+
+        if request.method != 'POST':
+            return HttpResponse(status=405)
+        upload = ChunkedUpload(request.user, request.headers.get('Upload-Id'))
+        try:
+            length = int(request.headers['Upload-Length'])
+            offset = int(request.headers['Upload-Offset'])
+            chunk = int(request.headers.get('Content-Length') or 0)
+        except (KeyError, ValueError):
+            raise UploadRejected('Upload-Length and Upload-Offset are required.', 400)
+        if upload.info() is None:
+            upload.start(unquote(request.headers.get('Upload-Name', '')), length, chunk)
+        offset, complete = upload.append(request, offset, chunk, chat_group)
+        if complete:
+            return JsonResponse({'offset': offset, 'complete': True}, status=201)
+        return JsonResponse({'offset': offset, 'complete': False})
+    except UploadRejected as error:
+        body = {'error': error.message}
+        if error.offset is not None:
+            body['offset'] = error.offset
+        return JsonResponse(body, status=error.status)
+
 @login_required
 def manage_chat_members(request, chatroom_name):
     chat_group = get_object_or_404(ChatGroup, group_name=chatroom_name)
@@ -0,0 +1,161 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+
+from .models import GroupMessage
+from .search import index_messages
+
+logger = logging.getLogger(__name__)
+
+
+def reserve_ids(model, count):
+    # Claim a block of primary keys up front so messages can be broadcast
+    # before they are inserted. Ordinary inserts elsewhere keep working: the
+    # sequence has already moved past the reserved block.
+    table = model._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # UPDATE first so the write lock is held before seq is read
+            cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s', [count, table])
+            if cursor.rowcount:
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                last = cursor.fetchone()[0]
+            else:
+                cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM "{table}"')
+                last = cursor.fetchone()[0] + count
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, last])
+            return list(range(last - count + 1, last + 1))
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                [table, 'id', count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+    raise ImproperlyConfigured(f'RTCHAT_WRITE_BEHIND is not supported on {connection.vendor}')
+
+
+class MessageWriter:
+    # Buffers new GroupMessages and inserts them with bulk_create from a
+    # background thread, one transaction per batch. A batch is written once it
+    # reaches RTCHAT_WRITE_BEHIND_BATCH_SIZE or has waited
+    # RTCHAT_WRITE_BEHIND_MAX_DELAY seconds, whichever comes first.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._ids = []
+        self._thread = None
+        self._stopping = False
+        self._registered = False
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'RTCHAT_WRITE_BEHIND', False)
+
+    @property
+    def durable(self):
+        # Per-socket broadcasts fetch the row, so they have to wait for it
+        if getattr(settings, 'RTCHAT_BROADCAST_MODE', 'render_once') == 'per_socket':
+            return True
+        return getattr(settings, 'RTCHAT_WRITE_BEHIND_DURABILITY', 'async') == 'commit'
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'RTCHAT_WRITE_BEHIND_BATCH_SIZE', 200)
+
+    @property
+    def max_delay(self):
+        return getattr(settings, 'RTCHAT_WRITE_BEHIND_MAX_DELAY', 0.05)
+
+    def submit(self, message):
+        future = Future()
+        message.id = self._next_id()
+        with self._cond:
+            if self._thread is None:
+                self._start()
+            self._queue.append((message, future))
+            self._cond.notify()
+        return future
+
+    def _next_id(self):
+        # A new block is reserved without holding the lock, so other senders
+        # and the writer thread do not wait on the round trip. Senders that
+        # run out together each reserve one; the spare ids are used up later.
+        with self._cond:
+            if self._ids:
+                return self._ids.pop(0)
+        ids = reserve_ids(GroupMessage, self.batch_size)
+        with self._cond:
+            self._ids += ids
+            return self._ids.pop(0)
+
+    def _start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='rtchat-writebehind', daemon=True)
+        self._thread.start()
+        if not self._registered:
+            atexit.register(self.stop)
+            self._registered = True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                # Senders wait on durable batches, so write those at once and
+                # let the next batch fill up while this one commits
+                deadline = time.monotonic() + (0 if self.durable else self.max_delay)
+                while len(self._queue) < self.batch_size and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.batch_size]
+                self._queue = self._queue[self.batch_size:]
+            self._write(batch)
+        connection.close()
+
+    def _write(self, batch):
+        try:
+            messages = [message for message, _ in batch]
+            with transaction.atomic():
+                GroupMessage.objects.bulk_create(messages)
+                index_messages(messages)
+        except Exception as exc:
+            logger.exception('Write-behind lost %d chat messages', len(batch))
+            for _, future in batch:
+                future.set_exception(exc)
+        else:
+            for _, future in batch:
+                future.set_result(True)
+
+    def stop(self, timeout=10):
+        # Flush everything still buffered; registered with atexit so a clean
+        # worker shutdown does not drop messages.
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+
+
+writer = MessageWriter()
+
+
+def save_message(message):
+    # Returns a future to wait on before broadcasting, or None when the
+    # message can be broadcast right away.
+    if not writer.enabled:
+        message.save()
+        return None
+    future = writer.submit(message)
+    return future if writer.durable else None
@@ -34,7 +34,7 @@ class MentorRegistrationForm(UserCreationForm):
 class ProfileForm(forms.ModelForm):
     class Meta:
         model = Profile
-        fields = ['image', 'displayname', 'info', 'linkedin_url', 'github_url', 'resume', 'terms_accepted']
+        fields = ['image', 'displayname', 'info', 'expertise', 'linkedin_url', 'github_url', 'resume', 'terms_accepted']
         widgets = {
             'linkedin_url': forms.URLInput(attrs={'class': 'mt-1 block w-full rounded-md border-gray-300 shadow-sm'}),
             'github_url': forms.URLInput(attrs={'class': 'mt-1 block w-full rounded-md border-gray-300 shadow-sm'}),
@@ -101,7 +101,7 @@ class MenteeRegistrationForm(UserCreationForm):
 class ProfileEditForm(forms.ModelForm):
     class Meta:
         model = Profile
-        fields = ['phone_number', 'working_status', 'organization', 'designation', 
+        fields = ['phone_number', 'working_status', 'organization', 'designation', 'expertise',
                   'linkedin_url', 'github_url', 'resume', 'terms_accepted']
         
     def __init__(self, *args, **kwargs):
@@ -127,7 +127,7 @@ class MentorProfileForm(forms.ModelForm):
     class Meta:
         model = Profile
         fields = ['image', 'displayname', 'info', 'working_status', 'organization', 
-                  'designation', 'linkedin_url', 'github_url', 'resume', 'terms_accepted']
+                  'designation', 'expertise', 'linkedin_url', 'github_url', 'resume', 'terms_accepted']
         labels = {
             'image': 'Profile Picture',
             'displayname': 'Display Name',
@@ -135,6 +135,7 @@ class MentorProfileForm(forms.ModelForm):
             'working_status': 'Working Status',
             'organization': 'Organization',
             'designation': 'Designation',
+            'expertise': 'Expertise',
             'linkedin_url': 'LinkedIn URL',
             'github_url': 'GitHub URL (Optional)',
             'resume': 'Resume',
@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.templatetags.static import static
+from .constants import EXPERTISE_CHOICES
 
 class Profile(models.Model):
     USER_TYPES = (
@@ -34,6 +35,16 @@ class Profile(models.Model):
     resume = models.FileField(upload_to='resumes/', null=True, blank=True)
     terms_accepted = models.BooleanField(default=False)
     user_type = models.CharField(max_length=6, choices=USER_TYPES, default='MENTEE')
+    expertise = models.CharField(max_length=20, choices=EXPERTISE_CHOICES, null=True, blank=True)
+
+    class Meta:
+        # Mentor directory filters; each also serves plain user_type lookups
+        indexes = [
+            models.Index(fields=['user_type', 'id'], name='profile_type_idx'),
+            models.Index(fields=['user_type', 'working_status', 'id'], name='profile_type_status_idx'),
+            models.Index(fields=['user_type', 'organization', 'id'], name='profile_type_org_idx'),
+            models.Index(fields=['user_type', 'expertise', 'id'], name='profile_type_expertise_idx'),
+        ]
 
     def __str__(self):
         return str(self.user)
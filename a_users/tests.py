@@ -1,3 +1,26 @@
 from django.test import TestCase
+from a_core.testing import Budget, BudgetTests
+from .models import Profile
 
-# Create your tests here.
+
+class ProfileViewBudgets(BudgetTests, TestCase):
+    urlconf = 'a_users.urls'
+    budgets = {
+        'register-mentor': Budget(0, 50),
+        'register-mentee': Budget(0, 50),
+        'profile-onboarding': Budget(3, 50, user=lambda t: t.mentor),
+        'profile-edit': Budget(3, 50, user=lambda t: t.mentor),
+        'profile-settings': Budget(5, 50, user=lambda t: t.mentor),
+        'profile-emailchange': Budget(2, 25, user=lambda t: t.mentor),
+        'profile-emailverify': Budget(3, 25, user=lambda t: t.mentor),
+        'profile-delete': Budget(3, 25, user=lambda t: t.mentor),
+        'manage-profile': Budget(3, 50, user=lambda t: t.mentor),
+        'profile': Budget(3, 25, user=lambda t: t.mentor),
+        'profile-detail': Budget(5, 50, user=lambda t: t.mentee, kwargs=lambda t: {'username': t.mentor.username}),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.mentor = Profile.objects.filter(user_type='MENTOR').select_related('user').first().user
+        cls.mentee = Profile.objects.filter(user_type='MENTEE').select_related('user').first().user